@@ -81,6 +81,8 @@ class Airport:
         )  # Make initial date "old"
         self.__observation = None
         self.__observation_time = None
+        # observation_time as epoch seconds ; parsed once at ingest
+        self.__observation_epoch = None
         self.__runway_dataset = None
 
         # Application Status for Airport
@@ -97,7 +99,8 @@ class Airport:
 
         # Airport Weather Data
         self.__metar_type = None
-        self.__wx_conditions = ()
+        self.__wx_string = ""
+        self.__wx_conditions = 0
         self.wx_visibility = None
         self.__visibility_statute_mi = None
         self.wx_ceiling = None
@@ -108,6 +111,8 @@ class Airport:
         self.wx_category = None
         self.__wx_category_str = "UNSET"
         self.__ceiling = None
+        # Weather restored from the warm start state file ; not yet refreshed
+        self.__wx_stale = False
 
         # HeatMap
         self.hm_index = 0
@@ -139,6 +144,10 @@ class Airport:
         """Return Airport Purpose."""
         self.__purpose = purpose
 
+    def set_flightcategory(self, flight_category):
+        """Set flight category data."""
+        self.__flight_category = flight_category
+
     def flightcategory(self):
         """Return flight category data."""
         return self.__flight_category
@@ -169,6 +178,7 @@ class Airport:
         self.__metar_prev = self.__metar
         self.__metar = metartext
         self.__metar_date = datetime.now()
+        self.__wx_stale = False
         self.updated_time = datetime.now()
 
     def get_raw_metar(self):
@@ -179,10 +189,22 @@ class Airport:
         """Return Timestamp of METAR."""
         return self.__metar_date
 
+    def observation_epoch(self):
+        """Return METAR observation time as epoch seconds ; None if unknown."""
+        return self.__observation_epoch
+
     def wxconditions(self):
-        """Return list of weather conditions at Airport."""
+        """Return weather effect bits (utils_wx.WX_*) at Airport."""
         return self.__wx_conditions
 
+    def set_wxconditions(self, wx_effects):
+        """Set weather effect bits (utils_wx.WX_*) ; decoded from wx_string."""
+        self.__wx_conditions = wx_effects
+
+    def wx_string(self):
+        """Return METAR present weather string ; eg: -RA BR."""
+        return self.__wx_string
+
     def get_ca_metar(self):
         """Try get Fresh METAR data for Canadian Airports."""
         # TODO:
@@ -262,7 +284,8 @@ class Airport:
         return best_runway
 
     def set_wx_category(self, wx_category_str):
-        """Set WX Category to ENUM based on current wx_category_str."""
+        """Set WX Category string, and the matching ENUM."""
+        self.__wx_category_str = wx_category_str
         # Calculate Flight Category
         if wx_category_str == "UNKN":
             self.wx_category = AirportFlightCategory.UNKN
@@ -287,60 +310,164 @@ class Airport:
         """Return reported windspeed."""
         return self.__wind_speed_kt
 
-    def get_adds_metar(self, metar_dict):
+    def get_adds_metar(self, metar_dict, station_id=None):
         """Try get Fresh METAR data from local Aviation Digital Data Service (ADDS) download."""
-        debugging.info("get_adds_metar WX from adds for " + self.__icao)
-        if self.__icao in ("ksea", "kbfi"):
-            debugging.info(f"{self.__icao}\n****\n{metar_dict}\n****\n")
-        if self.__icao not in metar_dict:
+        # station_id is the reporting station for neighbour wxsrc airports
+        if station_id is None:
+            station_id = self.__icao
+        debugging.debug("get_adds_metar WX from adds for %s", station_id)
+        if station_id not in metar_dict:
             # TODO: If METAR data is missing from the ADDS dataset, then it hasn't been updated
             # We have the option to try a direct query for the data ; but don't have any hint
             # on which alternative source to use.
             # We also need to wonder if we want to copy over data from the previous record
             # to this record... so we have some persistance of data rather than losing the airport completely.
-            debugging.info("metar_dict WX for " + self.__icao + " missing")
+            debugging.info("metar_dict WX for %s missing", self.__icao)
             self.wx_category = AirportFlightCategory.UNKN
             self.__wx_category_str = "UNKN"
             self.set_metar(None)
             return False
-        debugging.info("get_adds_metar WX from adds for (1) " + self.__icao)
-        debugging.info(metar_dict[self.__icao])
+        debugging.debug("get_adds_metar %s : %s", self.__icao, metar_dict[station_id])
         # Don't need to worry about these entries existing
         # We check for valid data when we create the Airport data
-        raw_metar = metar_dict[self.__icao]["raw_text"]
-        debugging.info("get_adds_metar WX from adds for (1b) " + self.__icao)
+        raw_metar = metar_dict[station_id]["raw_text"]
         self.set_metar(raw_metar)
-        debugging.info("get_adds_metar WX from adds for (1c) " + self.__icao)
-        self.wx_visibility = metar_dict[self.__icao]["visibility"]
-        self.wx_ceiling = metar_dict[self.__icao]["ceiling"]
-        self.__wind_speed_kt = metar_dict[self.__icao]["wind_speed_kt"]
-        self.__wind_dir_degrees = metar_dict[self.__icao]["wind_dir_degrees"]
-        self.wx_windgust = metar_dict[self.__icao]["wind_gust_kt"]
-        self.__wx_category_str = metar_dict[self.__icao]["flight_category"]
-        self.__latitude = float(metar_dict[self.__icao]["latitude"])
-        self.__longitude = float(metar_dict[self.__icao]["longitude"])
-        if self.__latitude == "Missing" or self.__longitude == "Missing":
-            self.__coordinates = False
-            debugging.info(f"Coordinates missing for {self.__icao}")
-        else:
-            self.__coordinates = True
-        debugging.info("get_adds_metar WX from adds for (2) " + self.__icao)
+        self.wx_visibility = metar_dict[station_id]["visibility"]
+        self.wx_ceiling = metar_dict[station_id]["ceiling"]
+        self.__wind_speed_kt = metar_dict[station_id]["wind_speed_kt"]
+        self.__wind_dir_degrees = metar_dict[station_id]["wind_dir_degrees"]
+        self.wx_windgust = metar_dict[station_id]["wind_gust_kt"]
+        self.__wx_category_str = metar_dict[station_id]["flight_category"]
+        if station_id == self.__icao:
+            # A neighbour's position isn't this airport's position
+            self.__latitude = float(metar_dict[station_id]["latitude"])
+            self.__longitude = float(metar_dict[station_id]["longitude"])
+            if self.__latitude == "Missing" or self.__longitude == "Missing":
+                self.__coordinates = False
+                debugging.info("Coordinates missing for %s", self.__icao)
+            else:
+                self.__coordinates = True
         self.set_wx_category(self.__wx_category_str)
-        debugging.info("get_adds_metar WX from adds for (3) " + self.__icao)
         try:
-            debugging.info("get_adds_metar WX from adds for (4) " + self.__icao)
             utils_wx.calculate_wx_from_metar(self)
             return True
         except Exception as err:
-            debug_string = f"Error: get_adds_metar processing {self.__icao} metar:{self.get_raw_metar()}:"
-            debugging.debug(debug_string)
-            debugging.debug(err)
+            debugging.debug(
+                "Error: get_adds_metar processing %s metar:%s: %s",
+                self.__icao,
+                self.get_raw_metar(),
+                err,
+            )
         return False
 
+    def set_wx_from(self, source_airport):
+        """Copy the weather observation from source_airport ; for neighbour wxsrc."""
+        # Identity, position, configuration and runway data stay with this airport
+        self.__metar_prev = self.__metar
+        self.__metar = source_airport.__metar
+        self.__metar_date = source_airport.__metar_date
+        self.__wx_stale = source_airport.__wx_stale
+        self.updated_time = source_airport.updated_time
+        self.__observation_time = source_airport.__observation_time
+        self.__observation_epoch = source_airport.__observation_epoch
+        self.__metar_type = source_airport.__metar_type
+        self.__flight_category = source_airport.__flight_category
+        self.__sky_condition = source_airport.__sky_condition
+        self.__ceiling = source_airport.__ceiling
+        self.__visibility_statute_mi = source_airport.__visibility_statute_mi
+        self.__wx_string = source_airport.__wx_string
+        self.__wx_conditions = source_airport.__wx_conditions
+        self.__wind_dir_degrees = source_airport.__wind_dir_degrees
+        self.__wind_speed_kt = source_airport.__wind_speed_kt
+        self.__wind_gust_kt = source_airport.__wind_gust_kt
+        self.__wx_category_str = source_airport.__wx_category_str
+        self.wx_visibility = source_airport.wx_visibility
+        self.wx_ceiling = source_airport.wx_ceiling
+        self.wx_windgust = source_airport.wx_windgust
+        self.wx_category = source_airport.wx_category
+
+    def set_wx_unknown(self):
+        """Drop the weather observation ; flight category UNKN until a new report."""
+        self.set_metar(None)
+        self.__observation_time = None
+        self.__observation_epoch = None
+        self.__metar_type = None
+        self.__flight_category = None
+        self.__sky_condition = None
+        self.__ceiling = None
+        self.__visibility_statute_mi = None
+        self.__wx_string = ""
+        self.__wx_conditions = 0
+        self.__wind_dir_degrees = None
+        self.__wind_speed_kt = None
+        self.__wind_gust_kt = None
+        self.__wx_category_str = "UNKN"
+        self.wx_visibility = None
+        self.wx_ceiling = None
+        self.wx_windgust = None
+        self.wx_category = AirportFlightCategory.UNKN
+
+    def wx_stale(self):
+        """Weather is from the warm start state file and hasn't been refreshed yet."""
+        return self.__wx_stale
+
+    def wx_state(self):
+        """Return the weather observation as a JSON serializable dict."""
+        return {
+            "metar": self.__metar,
+            "metar_date": self.__metar_date.timestamp(),
+            "observation_time": self.__observation_time,
+            "observation_epoch": self.__observation_epoch,
+            "metar_type": self.__metar_type,
+            "flight_category": self.__flight_category,
+            "sky_condition": self.__sky_condition,
+            "ceiling": self.__ceiling,
+            "visibility_statute_mi": self.__visibility_statute_mi,
+            "wx_string": self.__wx_string,
+            "wx_conditions": self.__wx_conditions,
+            "wind_dir_degrees": self.__wind_dir_degrees,
+            "wind_speed_kt": self.__wind_speed_kt,
+            "wind_gust_kt": self.__wind_gust_kt,
+            "wx_category_str": self.__wx_category_str,
+            "wx_visibility": self.wx_visibility,
+            "wx_ceiling": self.wx_ceiling,
+            "wx_windgust": self.wx_windgust,
+            "latitude": self.__latitude,
+            "longitude": self.__longitude,
+            "coordinates": self.__coordinates,
+        }
+
+    def set_wx_state(self, wx_state):
+        """Restore a wx_state() observation ; marked stale until the next refresh."""
+        self.__metar = wx_state["metar"]
+        self.__metar_date = datetime.fromtimestamp(wx_state["metar_date"])
+        self.__observation_time = wx_state["observation_time"]
+        self.__observation_epoch = wx_state.get("observation_epoch")
+        self.__metar_type = wx_state["metar_type"]
+        self.__flight_category = wx_state["flight_category"]
+        self.__sky_condition = wx_state["sky_condition"]
+        self.__ceiling = wx_state["ceiling"]
+        self.__visibility_statute_mi = wx_state["visibility_statute_mi"]
+        self.__wx_string = wx_state["wx_string"]
+        self.__wx_conditions = wx_state["wx_conditions"]
+        self.__wind_dir_degrees = wx_state["wind_dir_degrees"]
+        self.__wind_speed_kt = wx_state["wind_speed_kt"]
+        self.__wind_gust_kt = wx_state["wind_gust_kt"]
+        self.__wx_category_str = wx_state["wx_category_str"]
+        self.wx_visibility = wx_state["wx_visibility"]
+        self.wx_ceiling = wx_state["wx_ceiling"]
+        self.wx_windgust = wx_state["wx_windgust"]
+        self.__latitude = wx_state["latitude"]
+        self.__longitude = wx_state["longitude"]
+        self.__coordinates = wx_state["coordinates"]
+        self.set_wx_category(self.__wx_category_str)
+        self.__wx_stale = True
+
     def update_raw_metar(self, raw_metar_text):
         """Roll over the metar data."""
         self.__metar_prev = self.__metar
         self.__metar_date = datetime.now()
+        self.__wx_stale = False
         self.__metar = raw_metar_text
 
     def update_airport_xml(self, station_id, metar_data):
@@ -358,6 +485,7 @@ class Airport:
             self.__observation_time = next_object.text
         else:
             self.__observation_time = "Missing"
+        self.__observation_epoch = utils_wx.observation_epoch(self.__observation_time)
 
         next_object = metar_data.find("wind_dir_degrees")
         if next_object is not None:
@@ -372,7 +500,8 @@ class Airport:
             else:
                 # FIXME: Hack to handle complex wind definitions (eg: VRB)
                 debugging.debug(
-                    f"GRR: wind_dir_degrees parse mismatch - setting to zero; actual:{next_object.text}:"
+                    "GRR: wind_dir_degrees parse mismatch - setting to zero; actual:%s:",
+                    next_object.text,
                 )
                 self.__wind_dir_degrees = 0
         else:
@@ -391,7 +520,8 @@ class Airport:
             else:
                 # FIXME: Hack to handle complex wind definitions (eg: VRB)
                 debugging.debug(
-                    f"GRR: wind_speed_kt parse mismatch - setting to zero; actual:{next_object.text}:"
+                    "GRR: wind_speed_kt parse mismatch - setting to zero; actual:%s:",
+                    next_object.text,
                 )
                 self.__wind_speed_kt = 0
         else:
@@ -416,12 +546,19 @@ class Airport:
             else:
                 # FIXME: Hack to handle complex wind definitions (eg: VRB)
                 debugging.debug(
-                    f"GRR: wind_gust_kt parse mismatch - setting to zero; actual:{next_object.text}:"
+                    "GRR: wind_gust_kt parse mismatch - setting to zero; actual:%s:",
+                    next_object.text,
                 )
                 self.__wind_gust_kt = 0
         else:
             self.__wind_gust_kt = 0
 
+        next_object = metar_data.find("wx_string")
+        if next_object is not None and next_object.text:
+            self.__wx_string = next_object.text
+        else:
+            self.__wx_string = ""
+
         next_object = metar_data.find("sky_condition")
         if next_object is not None:
             self.__sky_condition = next_object.text
@@ -483,12 +620,12 @@ class Airport:
             # Get METAR data from alternative Airport
             strparts = self.__wxsrc.split(":")
             alt_aprt = strparts[1]
-            debugging.info(f"{self.__icao} needs metar for {alt_aprt}")
+            debugging.info("%s needs metar for %s", self.__icao, alt_aprt)
             try:
                 debugging.info(
-                    f"Update USA Metar(neighbor): ADDS {self.__icao} ({alt_aprt})"
+                    "Update USA Metar(neighbor): ADDS %s (%s)", self.__icao, alt_aprt
                 )
-                freshness = self.get_adds_metar(alt_aprt)
+                freshness = self.get_adds_metar(metar_xml_dict, alt_aprt)
                 # freshness = True
             except Exception as err:
                 debugging.error(err)
@@ -498,7 +635,7 @@ class Airport:
             # adds data is missing.
             # If the adds data is missing, then we need to find stable reliable and free sources of metar data for all geographies
             debugging.info(
-                f"Update USA Metar: {self.__icao} - {self.__wx_category_str}"
+                "Update USA Metar: %s - %s", self.__icao, self.__wx_category_str
             )
             freshness = utils_wx.get_usa_metar(self)
             if freshness:
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*- #
+"""
+Flight category classifier benchmark ; scalar vs batch.
+
+Times utils_wx.flight_category() called once per station against a single
+utils_wx.classify_flight_categories() call over the whole batch, and checks
+that both give the same categories.
+
+Usage:
+    python3 benchmarks/bench_flight_category.py --stations 10000
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np  # noqa: E402
+
+import utils_wx  # noqa: E402
+
+# Reported visibility (statute miles) ; covers every category boundary
+VISIBILITY_VALUES = (0.25, 0.5, 1.0, 1.5, 2.0, 3.0, 4.0, 5.0, 6.0, 10.0)
+
+
+def random_conditions(count, seed):
+    """Return (ceiling, visibility) lists with a mix of categories, no ceiling and unknowns."""
+    rng = random.Random(seed)
+    ceiling = []
+    visibility = []
+    for dummy in range(count):
+        roll = rng.random()
+        if roll < 0.4:
+            ceiling.append(math.inf)
+        elif roll < 0.42:
+            ceiling.append(math.nan)
+        else:
+            ceiling.append(float(rng.randrange(1, 120) * 100))
+        roll = rng.random()
+        if roll < 0.03:
+            visibility.append(math.nan)
+        else:
+            visibility.append(rng.choice(VISIBILITY_VALUES))
+    return ceiling, visibility
+
+
+def best_time(function, repeat):
+    """Return the fastest of repeat runs of function() in seconds, and the last result."""
+    best = None
+    result = None
+    for dummy in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start_time
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="LiveMap flight category benchmark")
+    parser.add_argument("--stations", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    ceiling, visibility = random_conditions(args.stations, args.seed)
+
+    def scalar():
+        return [
+            utils_wx.flight_category(station_ceiling, station_visibility)
+            for station_ceiling, station_visibility in zip(ceiling, visibility)
+        ]
+
+    def batch():
+        # Include building the arrays from lists ; that's what the ingest code does
+        return utils_wx.classify_flight_categories(
+            np.array(ceiling), np.array(visibility)
+        )
+
+    scalar_time, scalar_result = best_time(scalar, args.repeat)
+    batch_time, batch_codes = best_time(batch, args.repeat)
+
+    batch_result = [utils_wx.FLIGHT_CATEGORIES[code] for code in batch_codes]
+    mismatches = sum(1 for a, b in zip(scalar_result, batch_result) if a != b)
+
+    print(f"{args.stations} stations (best of {args.repeat})")
+    print(f"  scalar  {scalar_time * 1000:8.3f}ms")
+    print(f"  batch   {batch_time * 1000:8.3f}ms  ({scalar_time / batch_time:.1f}x)")
+    for code, category in enumerate(utils_wx.FLIGHT_CATEGORIES):
+        print(f"  {category:5} {int(np.count_nonzero(batch_codes == code)):8}")
+    if mismatches:
+        print(f"  MISMATCH: {mismatches} stations differ between scalar and batch")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*- #
+"""
+Per LedMode frame cost benchmark using the null LED backend.
+
+Builds an airport database from a synthetic METAR feed, then times frame
+generation (ledmode_*), frame commit (update_ledstring) and backend show()
+for every LED mode. No LED hardware is required.
+
+Usage:
+    python3 benchmarks/bench_ledmodes.py --leds 500 --frames 200
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+os.chdir(REPO_DIR)
+
+import conf  # noqa: E402
+import utils  # noqa: E402
+import update_airports  # noqa: E402
+import update_leds  # noqa: E402
+from update_leds import LedMode  # noqa: E402
+import synthetic_wx  # noqa: E402
+from bench_pipeline import write_airports_json  # noqa: E402
+
+
+def mode_frame_functions(led_mgmt):
+    """Return LedMode -> frame generator ; mirrors the dispatch in UpdateLEDs.update_loop()."""
+    return {
+        LedMode.METAR: led_mgmt.ledmode_metar,
+        LedMode.HEATMAP: led_mgmt.ledmode_heatmap,
+        LedMode.FADE: led_mgmt.ledmode_fade,
+        LedMode.TEST: led_mgmt.ledmode_test,
+        LedMode.SHUFFLE: led_mgmt.ledmode_shuffle,
+        LedMode.RAINBOW: led_mgmt.ledmode_rainbow,
+        LedMode.RABBIT: led_mgmt.ledmode_rabbit,
+        LedMode.RADARWIPE: led_mgmt.ledmode_rabbit,
+        LedMode.SQUAREWIPE: led_mgmt.ledmode_rabbit,
+        LedMode.WHEELWIPE: led_mgmt.ledmode_rabbit,
+        LedMode.CIRCLEWIPE: led_mgmt.ledmode_rabbit,
+    }
+
+
+def bench_mode(led_mgmt, frame_function, frames):
+    """Time frames of a single mode ; return (generate_us, commit_us, show_us) per frame."""
+    strip = led_mgmt.strip
+    generate_time = 0.0
+    commit_time = 0.0
+    show_before = strip.show_time_total
+    for clocktick in range(frames):
+        start_time = time.perf_counter()
+        led_color_dict = frame_function(clocktick)
+        generated_time = time.perf_counter()
+        led_mgmt.update_ledstring(led_color_dict)
+        commit_time += time.perf_counter() - generated_time
+        generate_time += generated_time - start_time
+    show_time = strip.show_time_total - show_before
+    scale = 1_000_000 / frames
+    return generate_time * scale, commit_time * scale, show_time * scale
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="LiveMap LED mode benchmark")
+    parser.add_argument("--leds", type=int, default=500)
+    parser.add_argument("--stations", type=int, default=5000)
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="livemap-ledbench-")
+    failed_modes = []
+    try:
+        os.makedirs(os.path.join(workdir, "data"))
+        bench_config = conf.Conf()
+        bench_config.set_string("filenames", "basedir", workdir)
+        bench_config.set_string("default", "led_count", args.leds)
+        bench_config.set_string("lights", "led_backend", "null")
+        bench_config.set_string("lights", "led_frame_ring_slots", 0)
+
+        feed = synthetic_wx.SyntheticFeed(args.stations, seed=args.seed)
+        feed.write(workdir, tafs=False)
+        utils.decompress_file_gz(
+            os.path.join(workdir, synthetic_wx.METAR_FILENAME),
+            bench_config.get_string("filenames", "metar_xml_data"),
+        )
+        write_airports_json(
+            bench_config.get_string("filenames", "airports_json"),
+            feed.station_ids(),
+            min(args.leds, args.stations),
+        )
+
+        airport_database = update_airports.AirportDB(bench_config, None)
+        airport_database.update_airportdb_metar_xml()
+        led_mgmt = update_leds.UpdateLEDs(bench_config, airport_database)
+        led_mgmt.update_active_led_list()
+        led_mgmt.init_rainbow()
+
+        print(f"{args.leds} LEDs / {args.frames} frames per mode (microseconds per frame)")
+        print(f"  {'mode':12} {'generate':>10} {'commit':>10} {'show':>10}")
+        for mode, frame_function in mode_frame_functions(led_mgmt).items():
+            try:
+                generate_us, commit_us, show_us = bench_mode(
+                    led_mgmt, frame_function, args.frames
+                )
+            except Exception as err:  # pylint: disable=broad-except
+                print(f"  {mode.name:12} failed: {err!r}")
+                failed_modes.append(mode.name)
+                continue
+            print(
+                f"  {mode.name:12} {generate_us:10.1f} {commit_us:10.1f} {show_us:10.1f}"
+            )
+        print(led_mgmt.strip.stats())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failed_modes:
+        print(f"Failed modes: {', '.join(failed_modes)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*- #
+"""
+End to end pipeline benchmark ; download -> parse -> LED colour frame.
+
+Runs the real DataSets download helper, AirportDB parsers and UpdateLEDs
+frame builder against synthetic ADDS feeds served from a local HTTP server.
+Wall time, CPU time and memory are recorded for each stage, and appended to
+benchmarks/results.jsonl so that regressions show up between runs.
+
+Usage:
+    python3 benchmarks/bench_pipeline.py --stations 1000 5000 20000
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_FILE = os.path.join(BENCH_DIR, "results.jsonl")
+
+# The application modules expect to be run from the install directory
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+os.chdir(REPO_DIR)
+
+import conf  # noqa: E402
+import utils  # noqa: E402
+import update_airports  # noqa: E402
+import synthetic_wx  # noqa: E402
+
+
+def current_rss_kb():
+    """Return current resident set size in kB (Linux only, else 0)."""
+    try:
+        with open("/proc/self/statm", encoding="utf8") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return 0
+
+
+def peak_rss_kb():
+    """Return the process peak resident set size so far in kB ; cumulative, never per stage."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # macOS reports bytes, Linux reports kB
+        peak = peak // 1024
+    return peak
+
+
+class StageTimer:
+    """Context manager recording wall / cpu / memory for a benchmark stage."""
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.start_wall = 0
+        self.start_cpu = 0
+        self.start_rss = 0
+
+    def __enter__(self):
+        self.start_rss = current_rss_kb()
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        rss = current_rss_kb()
+        self.results[self.name] = {
+            "wall_s": round(wall, 4),
+            "cpu_s": round(cpu, 4),
+            "rss_kb": rss,
+            "rss_delta_kb": rss - self.start_rss,
+            "peak_rss_kb": peak_rss_kb(),
+        }
+        return False
+
+
+def start_feed_server(feed_dir):
+    """Start the synthetic feed server in a subprocess ; return (process, base_url)."""
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(BENCH_DIR, "synthetic_wx.py"),
+            "serve",
+            "--dir",
+            feed_dir,
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    port_line = server.stdout.readline().split()
+    if len(port_line) != 2 or port_line[0] != "PORT":
+        server.kill()
+        raise RuntimeError("Synthetic feed server failed to start")
+    return server, f"http://127.0.0.1:{port_line[1]}"
+
+
+def write_airports_json(filename, station_list, led_count):
+    """Write an airports.json mapping the first led_count stations to LEDs."""
+    airports = []
+    for led_index, station_id in enumerate(station_list[:led_count]):
+        airports.append(
+            {
+                "active": "True",
+                "heatmap": "0",
+                "icao": station_id.lower(),
+                "led": str(led_index),
+                "purpose": "all",
+                "wxsrc": "adds",
+            }
+        )
+    with open(filename, "w", encoding="utf8") as json_file:
+        json.dump({"airports": airports}, json_file)
+
+
+def bench_conf(workdir, base_url, led_count):
+    """Return a Conf with file locations and URLs pointed at the benchmark sandbox."""
+    bench_config = conf.Conf()
+    bench_config.set_string("filenames", "basedir", workdir)
+    bench_config.set_string(
+        "urls", "metar_xml_gz", f"{base_url}/{synthetic_wx.METAR_FILENAME}"
+    )
+    bench_config.set_string(
+        "urls", "tafs_xml_gz", f"{base_url}/{synthetic_wx.TAF_FILENAME}"
+    )
+    bench_config.set_string("default", "led_count", led_count)
+    bench_config.set_string("schedule", "usetimer", "False")
+    bench_config.set_string("lights", "led_backend", "null")
+    bench_config.set_string("lights", "led_frame_ring_slots", 0)
+    return bench_config
+
+
+def download_stage(bench_config, session):
+    """Fetch METAR and TAF files using the production download helper."""
+    downloads = {}
+    for url_key, file_key in (
+        ("metar_xml_gz", "metar_xml_data"),
+        ("tafs_xml_gz", "tafs_xml_data"),
+    ):
+        ret, validator = utils.download_if_changed(
+            session,
+            bench_config.get_string("urls", url_key),
+            bench_config.get_string("filenames", file_key),
+            decompress=True,
+        )
+        downloads[file_key] = {"downloaded": ret, "validator": validator}
+    return downloads
+
+
+def load_led_manager(bench_config, airport_database):
+    """Return an UpdateLEDs instance, or None if the LED stack is unavailable."""
+    try:
+        import update_leds  # pylint: disable=import-outside-toplevel
+    except ImportError as err:
+        print(f"  frame stage skipped ; LED stack not importable ({err})")
+        return None
+    return update_leds.UpdateLEDs(bench_config, airport_database)
+
+
+def frame_stage(led_mgmt, frames):
+    """Build and commit a number of METAR colour frames."""
+    for clocktick in range(frames):
+        led_color_dict = led_mgmt.ledmode_metar(clocktick)
+        led_mgmt.update_ledstring(led_color_dict)
+
+
+def run_pass(bench_config, session, led_mgmt, airport_database, frames):
+    """Run one download / parse / frame pass ; return stage results."""
+    stages = {}
+    with StageTimer(stages, "download"):
+        download_stage(bench_config, session)
+    with StageTimer(stages, "parse_metar"):
+        airport_database.update_airportdb_metar_xml()
+    with StageTimer(stages, "parse_taf"):
+        airport_database.update_airport_taf_xml()
+    if led_mgmt is not None:
+        with StageTimer(stages, "led_frames"):
+            frame_stage(led_mgmt, frames)
+        stages["led_frames"]["frames"] = frames
+        stages["led_frames"]["per_frame_ms"] = round(
+            stages["led_frames"]["wall_s"] * 1000 / frames, 4
+        )
+    stages["end_to_end"] = {
+        "wall_s": round(sum(stage["wall_s"] for stage in stages.values()), 4),
+        "cpu_s": round(sum(stage["cpu_s"] for stage in stages.values()), 4),
+        "peak_rss_kb": peak_rss_kb(),
+    }
+    return stages
+
+
+def run_benchmark(station_count, led_count, frames, changed_fraction, seed):
+    """Run cold and warm passes for one feed size ; return result record."""
+    import requests  # pylint: disable=import-outside-toplevel
+
+    record = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_rev": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "stations": station_count,
+        "leds": led_count,
+        "frames": frames,
+        "changed_fraction": changed_fraction,
+    }
+    with tempfile.TemporaryDirectory(prefix="livemap-bench-") as workdir:
+        feed_dir = os.path.join(workdir, "feed")
+        os.makedirs(os.path.join(workdir, "data"))
+        os.makedirs(os.path.join(workdir, "logs"))
+
+        feed = synthetic_wx.SyntheticFeed(station_count, seed=seed)
+        with StageTimer(record, "generate"):
+            feed.write(feed_dir)
+        record["feed_bytes"] = sum(
+            os.path.getsize(os.path.join(feed_dir, name))
+            for name in os.listdir(feed_dir)
+        )
+
+        server, base_url = start_feed_server(feed_dir)
+        session = requests.Session()
+        try:
+            bench_config = bench_conf(workdir, base_url, led_count)
+            write_airports_json(
+                bench_config.get_string("filenames", "airports_json"),
+                feed.station_ids(),
+                led_count,
+            )
+            airport_database = update_airports.AirportDB(bench_config, None)
+            led_mgmt = load_led_manager(bench_config, airport_database)
+
+            record["cold"] = run_pass(
+                bench_config, session, led_mgmt, airport_database, frames
+            )
+
+            # Second refresh - only a fraction of stations issue new observations
+            record["changed_stations"] = feed.advance(changed_fraction)
+            # Make sure the regenerated files look newer to the timestamp check
+            time.sleep(1.1)
+            feed.write(feed_dir)
+            record["warm"] = run_pass(
+                bench_config, session, led_mgmt, airport_database, frames
+            )
+        finally:
+            session.close()
+            server.terminate()
+            server.wait()
+    return record
+
+
+def git_revision():
+    """Return short git revision of the tree being benchmarked."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=REPO_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous_result(record):
+    """Find the last recorded run with the same shape as record."""
+    if not os.path.isfile(RESULTS_FILE):
+        return None
+    match = None
+    with open(RESULTS_FILE, encoding="utf8") as results_file:
+        for line in results_file:
+            try:
+                old = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if (
+                old.get("stations") == record["stations"]
+                and old.get("leds") == record["leds"]
+                and old.get("frames") == record["frames"]
+                and old.get("machine") == record["machine"]
+            ):
+                match = old
+    return match
+
+
+def report(record, baseline, threshold):
+    """Print stage results and deltas against baseline ; return list of regressions."""
+    regressions = []
+    print(
+        f"\n{record['stations']} stations / {record['leds']} LEDs "
+        f"({record['feed_bytes'] // 1024} kB feed, {record['changed_stations']} changed on refresh)"
+    )
+    for pass_name in ("cold", "warm"):
+        for stage, values in record[pass_name].items():
+            line = (
+                f"  {pass_name:4} {stage:12} wall {values['wall_s']:8.3f}s"
+                f"  cpu {values['cpu_s']:8.3f}s  process peak rss {values['peak_rss_kb'] // 1024:5d}MB"
+            )
+            old = (baseline or {}).get(pass_name, {}).get(stage)
+            if old and old.get("wall_s"):
+                change = (values["wall_s"] - old["wall_s"]) / old["wall_s"] * 100
+                line += f"  ({change:+.1f}% vs {baseline['git_rev']})"
+                if change > threshold:
+                    regressions.append(f"{pass_name}/{stage} {change:+.1f}%")
+            print(line)
+    return regressions
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="LiveMap pipeline benchmark")
+    parser.add_argument(
+        "--stations", type=int, nargs="+", default=[1000, 5000, 20000]
+    )
+    parser.add_argument("--leds", type=int, default=500)
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--changed-fraction", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=20.0,
+        help="Percent wall time increase reported as a regression",
+    )
+    parser.add_argument(
+        "--fail-on-regression", action="store_true", help="Exit non-zero on regression"
+    )
+    parser.add_argument(
+        "--no-record", action="store_true", help="Do not append to results.jsonl"
+    )
+    args = parser.parse_args(argv)
+
+    all_regressions = []
+    for station_count in args.stations:
+        led_count = min(args.leds, station_count)
+        record = run_benchmark(
+            station_count, led_count, args.frames, args.changed_fraction, args.seed
+        )
+        all_regressions += report(record, previous_result(record), args.threshold)
+        if not args.no_record:
+            with open(RESULTS_FILE, "a", encoding="utf8") as results_file:
+                results_file.write(json.dumps(record, sort_keys=True) + "\n")
+
+    if all_regressions:
+        print("\nRegressions over threshold:")
+        for regression in all_regressions:
+            print(f"  {regression}")
+        if args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*- #
+"""
+Synthetic ADDS METAR/TAF feeds for offline load testing.
+
+Generates metars.cache.xml.gz / tafs.cache.xml.gz files that look like the
+aviationweather.gov cache files, and serves them from a local HTTP server
+so the download / parse / LED pipeline can be exercised without the Internet.
+
+Usage:
+    python3 benchmarks/synthetic_wx.py generate --stations 5000 --outdir /tmp/wx
+    python3 benchmarks/synthetic_wx.py serve --dir /tmp/wx --port 8080
+"""
+
+import argparse
+import gzip
+import hashlib
+import http.server
+import os
+import random
+import socketserver
+import sys
+from datetime import datetime, timedelta, timezone
+
+METAR_FILENAME = "metars.cache.xml.gz"
+TAF_FILENAME = "tafs.cache.xml.gz"
+
+# Station id prefixes ; each prefix provides 26^3 unique station ids
+STATION_PREFIXES = "KCPEL"
+
+# Present weather samples ; weighted towards no weather
+WX_SAMPLES = [
+    "",
+    "",
+    "",
+    "",
+    "-RA",
+    "RA BR",
+    "+TSRA",
+    "VCTS",
+    "-SN",
+    "SN BLSN",
+    "-FZRA",
+    "FZDZ",
+    "HZ",
+    "BR",
+    "FG",
+    "VCSH",
+]
+
+VIS_SAMPLES = ["10", "10", "10", "7", "5", "4", "3", "2", "1 1/2", "1", "1/2", "1/4"]
+
+SKY_COVERS = ["FEW", "SCT", "BKN", "OVC"]
+
+
+def station_ids(count):
+    """Return a list of count unique, deterministic, 4 letter station ids."""
+    per_prefix = 26**3
+    if count > per_prefix * len(STATION_PREFIXES):
+        raise ValueError(f"Too many stations requested: {count}")
+    result = []
+    for index in range(count):
+        prefix = STATION_PREFIXES[index // per_prefix]
+        offset = index % per_prefix
+        letters = ""
+        for dummy in range(3):
+            letters = chr(ord("A") + offset % 26) + letters
+            offset //= 26
+        result.append(prefix + letters)
+    return result
+
+
+def visibility_value(vis_text):
+    """Convert METAR visibility text (eg: 1 1/2) to float."""
+    total = 0.0
+    for part in vis_text.split():
+        if "/" in part:
+            numerator, denominator = part.split("/")
+            total += int(numerator) / int(denominator)
+        else:
+            total += float(part)
+    return total
+
+
+def flight_category(ceiling, visibility):
+    """Compute flight category from ceiling (ft AGL, None = unlimited) and visibility (sm)."""
+    if ceiling is None:
+        ceiling = 100000
+    if visibility < 1 or ceiling < 500:
+        return "LIFR"
+    if visibility < 3 or ceiling < 1000:
+        return "IFR"
+    if visibility <= 5 or ceiling <= 3000:
+        return "MVFR"
+    return "VFR"
+
+
+def metar_temp(value):
+    """Format METAR temperature."""
+    if value < 0:
+        return f"M{abs(value):02d}"
+    return f"{value:02d}"
+
+
+class SyntheticStation:
+    """Observation generator for a single synthetic station."""
+
+    def __init__(self, station_id, rng):
+        self.station_id = station_id
+        self.latitude = round(rng.uniform(18.0, 65.0), 3)
+        self.longitude = round(rng.uniform(-160.0, -65.0), 3)
+        self.elevation_m = rng.randint(0, 2500)
+        self.observation = None
+        self.new_observation(rng, datetime.now(timezone.utc))
+
+    def new_observation(self, rng, now):
+        """Generate a fresh observation for this station."""
+        obs_time = now - timedelta(minutes=rng.randint(0, 90))
+        obs_time = obs_time.replace(second=0, microsecond=0)
+        wind_dir = rng.randrange(0, 360, 10)
+        wind_speed = rng.choice([0, 3, 5, 8, 10, 12, 15, 18, 22, 30])
+        wind_gust = 0
+        if wind_speed >= 12 and rng.random() < 0.4:
+            wind_gust = wind_speed + rng.randint(5, 15)
+        vis_text = rng.choice(VIS_SAMPLES)
+        wx_string = rng.choice(WX_SAMPLES)
+        temp = rng.randint(-20, 35)
+        dewpoint = temp - rng.randint(0, 15)
+        altim = rng.randint(2950, 3050)
+
+        sky = []
+        ceiling = None
+        layer_base = rng.choice([2, 5, 8, 12, 25, 40, 80])
+        for dummy in range(rng.randint(0, 3)):
+            cover = rng.choice(SKY_COVERS)
+            sky.append((cover, layer_base * 100))
+            if cover in ("BKN", "OVC") and ceiling is None:
+                ceiling = layer_base * 100
+            layer_base += rng.randint(5, 40)
+
+        gust_text = f"G{wind_gust:02d}" if wind_gust else ""
+        sky_text = " ".join(f"{cover}{base // 100:03d}" for cover, base in sky)
+        if not sky_text:
+            sky_text = "CLR"
+        raw_parts = [
+            self.station_id,
+            obs_time.strftime("%d%H%MZ"),
+            f"{wind_dir:03d}{wind_speed:02d}{gust_text}KT",
+            f"{vis_text}SM",
+        ]
+        if wx_string:
+            raw_parts.append(wx_string)
+        raw_parts.append(sky_text)
+        raw_parts.append(f"{metar_temp(temp)}/{metar_temp(dewpoint)}")
+        raw_parts.append(f"A{altim}")
+
+        self.observation = {
+            "raw_text": " ".join(raw_parts),
+            "observation_time": obs_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "temp_c": temp,
+            "dewpoint_c": dewpoint,
+            "wind_dir_degrees": wind_dir,
+            "wind_speed_kt": wind_speed,
+            "wind_gust_kt": wind_gust,
+            "visibility_statute_mi": "10+" if vis_text == "10" else vis_text,
+            "altim_in_hg": altim / 100,
+            "wx_string": wx_string,
+            "sky": sky,
+            "flight_category": flight_category(ceiling, visibility_value(vis_text)),
+        }
+
+    def metar_xml(self):
+        """Return ADDS style METAR XML record."""
+        obs = self.observation
+        lines = [
+            "<METAR>",
+            f"<raw_text>{obs['raw_text']}</raw_text>",
+            f"<station_id>{self.station_id}</station_id>",
+            f"<observation_time>{obs['observation_time']}</observation_time>",
+            f"<latitude>{self.latitude}</latitude>",
+            f"<longitude>{self.longitude}</longitude>",
+            f"<temp_c>{obs['temp_c']}</temp_c>",
+            f"<dewpoint_c>{obs['dewpoint_c']}</dewpoint_c>",
+            f"<wind_dir_degrees>{obs['wind_dir_degrees']}</wind_dir_degrees>",
+            f"<wind_speed_kt>{obs['wind_speed_kt']}</wind_speed_kt>",
+        ]
+        if obs["wind_gust_kt"]:
+            lines.append(f"<wind_gust_kt>{obs['wind_gust_kt']}</wind_gust_kt>")
+        lines.append(
+            f"<visibility_statute_mi>{obs['visibility_statute_mi']}</visibility_statute_mi>"
+        )
+        lines.append(f"<altim_in_hg>{obs['altim_in_hg']:.2f}</altim_in_hg>")
+        if obs["wx_string"]:
+            lines.append(f"<wx_string>{obs['wx_string']}</wx_string>")
+        if not obs["sky"]:
+            lines.append('<sky_condition sky_cover="CLR" />')
+        for cover, base in obs["sky"]:
+            lines.append(f'<sky_condition sky_cover="{cover}" cloud_base_ft_agl="{base}" />')
+        lines.append(f"<flight_category>{obs['flight_category']}</flight_category>")
+        lines.append("<metar_type>METAR</metar_type>")
+        lines.append(f"<elevation_m>{self.elevation_m}</elevation_m>")
+        lines.append("</METAR>")
+        return "\n".join(lines)
+
+    def taf_xml(self, rng, now):
+        """Return ADDS style TAF XML record."""
+        issue_time = now.replace(minute=0, second=0, microsecond=0)
+        valid_from = issue_time
+        valid_to = issue_time + timedelta(hours=24)
+        lines = [
+            "<TAF>",
+            f"<raw_text>TAF {self.station_id} {issue_time.strftime('%d%H%MZ')} SYNTHETIC</raw_text>",
+            f"<station_id>{self.station_id}</station_id>",
+            f"<issue_time>{issue_time.strftime('%Y-%m-%dT%H:%M:%SZ')}</issue_time>",
+            f"<bulletin_time>{issue_time.strftime('%Y-%m-%dT%H:%M:%SZ')}</bulletin_time>",
+            f"<valid_time_from>{valid_from.strftime('%Y-%m-%dT%H:%M:%SZ')}</valid_time_from>",
+            f"<valid_time_to>{valid_to.strftime('%Y-%m-%dT%H:%M:%SZ')}</valid_time_to>",
+            f"<latitude>{self.latitude}</latitude>",
+            f"<longitude>{self.longitude}</longitude>",
+            f"<elevation_m>{self.elevation_m}</elevation_m>",
+        ]
+        fcst_start = valid_from
+        for period in range(rng.randint(2, 6)):
+            fcst_end = min(fcst_start + timedelta(hours=rng.randint(3, 8)), valid_to)
+            lines.append("<forecast>")
+            lines.append(
+                f"<fcst_time_from>{fcst_start.strftime('%Y-%m-%dT%H:%M:%SZ')}</fcst_time_from>"
+            )
+            lines.append(
+                f"<fcst_time_to>{fcst_end.strftime('%Y-%m-%dT%H:%M:%SZ')}</fcst_time_to>"
+            )
+            if period > 0:
+                lines.append(
+                    f"<change_indicator>{rng.choice(['FM', 'TEMPO', 'BECMG'])}</change_indicator>"
+                )
+            lines.append(
+                f"<wind_dir_degrees>{rng.randrange(0, 360, 10)}</wind_dir_degrees>"
+            )
+            lines.append(f"<wind_speed_kt>{rng.randint(0, 25)}</wind_speed_kt>")
+            vis_text = rng.choice(VIS_SAMPLES)
+            if vis_text == "10":
+                vis_text = "6+"
+            lines.append(f"<visibility_statute_mi>{vis_text}</visibility_statute_mi>")
+            wx_string = rng.choice(WX_SAMPLES)
+            if wx_string:
+                lines.append(f"<wx_string>{wx_string}</wx_string>")
+            layer_base = rng.choice([3, 6, 10, 15, 30, 50])
+            for dummy in range(rng.randint(1, 3)):
+                cover = rng.choice(SKY_COVERS)
+                lines.append(
+                    f'<sky_condition sky_cover="{cover}" cloud_base_ft_agl="{layer_base * 100}" />'
+                )
+                layer_base += rng.randint(5, 30)
+            lines.append("</forecast>")
+            fcst_start = fcst_end
+            if fcst_start >= valid_to:
+                break
+        lines.append("</TAF>")
+        return "\n".join(lines)
+
+
+class SyntheticFeed:
+    """A set of synthetic stations that can be written out as ADDS cache files."""
+
+    def __init__(self, station_count, seed=1):
+        self._rng = random.Random(seed)
+        self.stations = [
+            SyntheticStation(station_id, self._rng)
+            for station_id in station_ids(station_count)
+        ]
+
+    def station_ids(self):
+        """Return list of station ids in this feed."""
+        return [station.station_id for station in self.stations]
+
+    def advance(self, changed_fraction):
+        """Issue new observations for a fraction of the stations."""
+        now = datetime.now(timezone.utc)
+        changed = 0
+        for station in self.stations:
+            if self._rng.random() < changed_fraction:
+                station.new_observation(self._rng, now)
+                changed += 1
+        return changed
+
+    def metar_document(self):
+        """Return the full METAR XML document."""
+        header = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<response xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+            'xmlns:xsi="http://www.w3.org/2001/XML-Schema-instance" version="1.2" '
+            'xsi:noNamespaceSchemaLocation="http://www.aviationweather.gov/static/adds/schema/metar1_2.xsd">',
+            "<request_index>1</request_index>",
+            '<data_source name="metars" />',
+            '<request type="retrieve" />',
+            "<errors />",
+            "<warnings />",
+            "<time_taken_ms>1</time_taken_ms>",
+            f'<data num_results="{len(self.stations)}">',
+        ]
+        body = [station.metar_xml() for station in self.stations]
+        return "\n".join(header + body + ["</data>", "</response>"])
+
+    def taf_document(self):
+        """Return the full TAF XML document."""
+        now = datetime.now(timezone.utc)
+        header = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<response xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+            'xmlns:xsi="http://www.w3.org/2001/XML-Schema-instance" version="1.2" '
+            'xsi:noNamespaceSchemaLocation="http://www.aviationweather.gov/static/adds/schema/taf1_2.xsd">',
+            "<request_index>1</request_index>",
+            '<data_source name="tafs" />',
+            '<request type="retrieve" />',
+            "<errors />",
+            "<warnings />",
+            "<time_taken_ms>1</time_taken_ms>",
+            f'<data num_results="{len(self.stations)}">',
+        ]
+        body = [station.taf_xml(self._rng, now) for station in self.stations]
+        return "\n".join(header + body + ["</data>", "</response>"])
+
+    def write(self, outdir, tafs=True):
+        """Write gzip compressed cache files into outdir ; return list of paths."""
+        os.makedirs(outdir, exist_ok=True)
+        written = []
+        documents = [(METAR_FILENAME, self.metar_document)]
+        if tafs:
+            documents.append((TAF_FILENAME, self.taf_document))
+        for filename, generator in documents:
+            path = os.path.join(outdir, filename)
+            tmp_path = path + ".tmp"
+            with gzip.open(tmp_path, "wb", compresslevel=6) as gz_file:
+                gz_file.write(generator().encode("utf-8"))
+            # Atomic replace so a concurrently running server never serves a partial file
+            os.replace(tmp_path, path)
+            written.append(path)
+        return written
+
+
+class FeedRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file handler that adds an ETag header like the real server."""
+
+    def log_message(self, format, *args):
+        """Keep the benchmark output quiet."""
+        return
+
+    def file_etag(self):
+        """Return the ETag for the requested file, or None."""
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        tag = hashlib.md5(f"{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+        return f'"{tag}"'
+
+    def send_head(self):
+        """Answer If-None-Match with 304 Not Modified."""
+        etag = self.file_etag()
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return None
+        return super().send_head()
+
+    def end_headers(self):
+        """Add ETag based on file size and mtime."""
+        etag = self.file_etag()
+        if etag is not None:
+            self.send_header("ETag", etag)
+        super().end_headers()
+
+
+class FeedServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Threaded local stand-in for the aviationweather.gov cache server."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(directory, port=0, host="127.0.0.1"):
+    """Create a FeedServer serving files from directory."""
+
+    def handler(*args, **kwargs):
+        return FeedRequestHandler(*args, directory=directory, **kwargs)
+
+    return FeedServer((host, port), handler)
+
+
+def main(argv=None):
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    gen_parser = subparsers.add_parser("generate", help="Write synthetic feed files")
+    gen_parser.add_argument("--stations", type=int, default=5000)
+    gen_parser.add_argument("--seed", type=int, default=1)
+    gen_parser.add_argument("--outdir", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Serve feed files over HTTP")
+    serve_parser.add_argument("--dir", required=True)
+    serve_parser.add_argument("--port", type=int, default=0)
+    serve_parser.add_argument("--host", default="127.0.0.1")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        feed = SyntheticFeed(args.stations, seed=args.seed)
+        for path in feed.write(args.outdir):
+            print(f"{path} {os.path.getsize(path)} bytes")
+        return 0
+
+    server = make_server(args.dir, port=args.port, host=args.host)
+    # Print the bound port first so a parent process can find us when using port 0
+    print(f"PORT {server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,121 +6,189 @@ import sys
 import datetime
 import logging
 import logging.handlers
+import queue
+
+# Messages are logged to a per module (subsystem) logger ; livemap.<module>
+# so that the log level can be tuned for each part of the system from the
+# [logging] section of config.ini, eg:
+#   update_leds = warning
+#
+# All the logging calls accept %-style arguments, which are only formatted
+# if the message is going to be emitted, eg:
+#   debugging.debug("Airport %s : %s", icao, flightcategory)
+# rather than an f-string that is always formatted.
+
+LOGGER_ROOT = "livemap"
+
+# Modules can be used before loginit() is called (eg: from the benchmarks) ;
+# loginit() adds the queue, file and console handlers.
+logger = logging.getLogger(LOGGER_ROOT)
+
+_subsystem_loggers = {}
+_log_listener = None
+# Lowest level enabled on any subsystem ; calls below it return before the
+# caller's frame is looked up. Set by loginit()
+_min_level = logging.NOTSET
+
+
+def subsystem(name):
+    """Return the logger for subsystem name."""
+    sublogger = _subsystem_loggers.get(name)
+    if sublogger is None:
+        # livemap.py runs as __main__
+        logger_name = "main" if name == "__main__" else name
+        sublogger = logging.getLogger(f"{LOGGER_ROOT}.{logger_name}")
+        _subsystem_loggers[name] = sublogger
+    return sublogger
+
+
+def _caller_logger():
+    """Return the subsystem logger for the module calling into debugging."""
+    # Frame 0 is this function, 1 is debug() / info() etc., 2 is the caller
+    return subsystem(sys._getframe(2).f_globals.get("__name__", LOGGER_ROOT))
+
+
+def loginit(conf=None):
+    """Init logging data.
+
+    Log records are put on a queue and written to file / console by a listener
+    thread, so logging IO doesn't block the LED or parsing threads.
+    """
+    global _log_listener, _min_level
+    logfile = "logs/debugging.log"
+    default_level = "info"
+    file_level = "info"
+    console_level = "info"
+    subsystem_levels = {}
+
+    if conf is not None and conf.configfile.has_section("logging"):
+        for key, value in conf.configfile.items("logging"):
+            if key == "logfile":
+                logfile = value
+            elif key == "default_level":
+                default_level = value
+            elif key == "file_level":
+                file_level = value
+            elif key == "console_level":
+                console_level = value
+            else:
+                subsystem_levels[key] = value
+
+    logger.setLevel(default_level.upper())
+    for name, level in subsystem_levels.items():
+        subsystem(name).setLevel(level.upper())
+    _min_level = min(
+        [logger.getEffectiveLevel()]
+        + [subsystem(name).getEffectiveLevel() for name in subsystem_levels]
+    )
 
-
-# FIXME: Move these flags to configuration
-DEBUG_MSGS = False
-PRINT_MSGS = True
-INFO_MSGS = True
-WARN_MSGS = True
-ERR_MSGS = True
-
-logger = None
-
-
-def loginit():
-    """Init logging data."""
-    global logger
-    # FIXME: Move filename to config
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-
-    # logging.basicConfig(filename="logs/debugging.log", level=logging.DEBUG)
     logfilehandler = logging.handlers.TimedRotatingFileHandler(
-        "logs/debugging.log", when="midnight", interval=1, backupCount=5, utc=True
+        logfile, when="midnight", interval=1, backupCount=5, utc=True
     )
-    logfilehandler.setLevel(logging.DEBUG)
-    logger.addHandler(logfilehandler)
+    logfilehandler.setLevel(file_level.upper())
 
     logconsolehandler = logging.StreamHandler(sys.stdout)
-    logconsolehandler.setLevel(logging.INFO)
-    logger.addHandler(logconsolehandler)
+    logconsolehandler.setLevel(console_level.upper())
 
-    formatter = logging.Formatter("%(asctime)s livemap: %(message)s", "%b %d %H:%M:%S")
+    formatter = logging.Formatter(
+        "%(asctime)s %(name)s: %(message)s", "%b %d %H:%M:%S"
+    )
     formatter.converter = time.gmtime
 
     logfilehandler.setFormatter(formatter)
     logconsolehandler.setFormatter(formatter)
 
+    logstop()
+    # The queue handler is on the root logger ; livemap.* propagates to it, and
+    # so do library loggers (werkzeug / Flask etc.) at their own levels
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root_logger.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, logfilehandler, logconsolehandler, respect_handler_level=True
+    )
+    _log_listener.start()
+
     # Disable PIL debug logs by default
     # Should eliminate STREAM b'IHDR' and STREAM b'IDAT' unnecessary logs
     logging.getLogger("PIL").setLevel(logging.WARNING)
 
 
+def logstop():
+    """Flush queued messages and stop the log writer thread."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+def debug_enabled():
+    """Return True if debug messages from the calling module will be logged."""
+    if logging.DEBUG < _min_level:
+        return False
+    return _caller_logger().isEnabledFor(logging.DEBUG)
+
+
 def crash(args):
     """Handle Crash Data - Append to crash.log."""
-    global logger
     # FIXME: Move filename to config
     appname = "LIVEMAP:"
     logtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    logger.debug(args)
+    _caller_logger().error("Crash: %s", args)
 
     with open("logs/crash.log", "w+", encoding="utf8") as log_file:
         log_file.write("***********************************************************")
         log_file.write(appname)
         log_file.write(logtime)
-        log_file.write(args)
+        log_file.write(str(args))
         log_file.write("-----------------------------------------------------------")
         log_file.flush()
 
 
-def dprint(args):
-    """Passthrough call to print() if DEBUG_MSGS is enabled."""
-    global logger
-    if PRINT_MSGS:
-        logger.info(args)
-        appname = "LIVEMAP:"
-        logtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(logtime, appname, "PRINT:", args, flush=True)
-    else:
-        return
+def dprint(msg, *args):
+    """Log at info level and print() to stdout."""
+    _caller_logger().info(msg, *args)
+    appname = "LIVEMAP:"
+    logtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if args:
+        msg = msg % args
+    print(logtime, appname, "PRINT:", msg, flush=True)
 
 
-def info(args):
-    """Passthrough call to print() if DEBUG_MSGS is enabled."""
-    global logger
-    if INFO_MSGS:
-        logger.info(args)
-        # appname = "LIVEMAP:"
-        # logtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # print(logtime, appname, "INFO:", args, flush=True)
-    else:
+def info(msg, *args):
+    """Log info message ; args are only formatted if the message is emitted."""
+    if logging.INFO < _min_level:
         return
+    sublogger = _caller_logger()
+    if sublogger.isEnabledFor(logging.INFO):
+        sublogger.info(msg, *args)
 
 
-def warn(args):
-    """Passthrough call to print() if WARN_MSGS is enabled."""
-    global logger
-    if WARN_MSGS:
-        logger.warning(args)
-        # appname = "LIVEMAP:"
-        # logtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # print(logtime, appname, "WARN:", args, flush=True)
-    else:
+def warn(msg, *args):
+    """Log warning message ; args are only formatted if the message is emitted."""
+    if logging.WARNING < _min_level:
         return
+    sublogger = _caller_logger()
+    if sublogger.isEnabledFor(logging.WARNING):
+        sublogger.warning(msg, *args)
 
 
-def error(args):
-    """Passthrough call to print() if ERR_MSGS is enabled."""
-    global logger
-    if ERR_MSGS:
-        logger.error(args)
-        # appname = "LIVEMAP:"
-        # logtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # logging.error(args)
-        # print(logtime, appname, "ERROR:", args, flush=True)
-    else:
+def error(msg, *args):
+    """Log error message ; args are only formatted if the message is emitted."""
+    if logging.ERROR < _min_level:
         return
+    sublogger = _caller_logger()
+    if sublogger.isEnabledFor(logging.ERROR):
+        sublogger.error(msg, *args)
 
 
-def debug(args):
-    """Passthrough call to print() if ERR_MSGS is enabled."""
-    global logger
-    if DEBUG_MSGS:
-        logger.debug(args)
-        # appname = "LIVEMAP:"
-        # logtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        # logging.debug(args)
-        # print(logtime, appname, "DEBUG:", args, flush=True)
-    else:
+def debug(msg, *args):
+    """Log debug message ; args are only formatted if the message is emitted."""
+    if logging.DEBUG < _min_level:
         return
+    sublogger = _caller_logger()
+    if sublogger.isEnabledFor(logging.DEBUG):
+        sublogger.debug(msg, *args)
@@ -0,0 +1,615 @@
+# -*- coding: utf-8 -*- #
+"""
+LED strip output backends.
+
+UpdateLEDs talks to the LED hardware through a small strip interface that
+mirrors the rpi_ws281x PixelStrip API (begin / setPixelColor / setBrightness / show).
+
+- WS281xBackend - real hardware via rpi_ws281x (only imported when used)
+- NullBackend   - in memory strip ; records frames and show() timing, and can
+                  optionally publish frames into a shared memory ring so another
+                  process can visualise them.
+- ShardedBackend - one logical strip spread across several physical strips
+                  (PWM pair / SPI / PCM) ; see [lights] led_strips.
+
+This keeps the LED engine runnable and profilable on machines without the
+Raspberry Pi PWM/DMA hardware.
+"""
+
+import abc
+import atexit
+import bisect
+import collections
+import struct
+import time
+
+import debugging
+import metrics
+
+# Strip type and colour ordering - matches the rpi_ws281x ws.* constants
+WS2811_STRIP_RGB = 0x00100800
+WS2811_STRIP_RBG = 0x00100008
+WS2811_STRIP_GRB = 0x00081000
+WS2811_STRIP_GBR = 0x00080010
+WS2811_STRIP_BRG = 0x00001008
+WS2811_STRIP_BGR = 0x00000810
+
+# WS281x wire timing ; 24 data bits per LED, then the latch (reset) gap
+LED_BITS_PER_PIXEL = 24
+LED_RESET_SECONDS = 55e-6
+
+# GPIO pin -> PWM channel ; both PWM channels are driven by the one PWM block
+PWM_CHANNEL_PINS = {12: 0, 18: 0, 40: 0, 52: 0, 13: 1, 19: 1, 41: 1, 45: 1, 53: 1}
+
+
+def pixel_color(red, green, blue, white=0):
+    """Convert red, green, blue (and white) components to a 24bit packed color ; same as rpi_ws281x Color()."""
+    return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+class LedBackend(abc.ABC):
+    """Strip interface used by the LED engine ; follows the PixelStrip method names."""
+
+    def __init__(self, num_pixels, brightness=255):
+        self._num_pixels = num_pixels
+        self._brightness = brightness
+
+    @abc.abstractmethod
+    def begin(self):
+        """Initialize the output device."""
+
+    def numPixels(self):  # pylint: disable=invalid-name
+        """Return number of pixels on the strip."""
+        return self._num_pixels
+
+    @abc.abstractmethod
+    def setPixelColor(self, index, color):  # pylint: disable=invalid-name
+        """Set pixel index to 24bit packed color."""
+
+    @abc.abstractmethod
+    def getPixelColor(self, index):  # pylint: disable=invalid-name
+        """Return 24bit packed color of pixel index."""
+
+    def set_pixels(self, indexes, colors):
+        """Set each pixel in indexes (ascending) to the matching 24bit packed color."""
+        for index, color in zip(indexes, colors):
+            self.setPixelColor(index, color)
+
+    def setBrightness(self, brightness):  # pylint: disable=invalid-name
+        """Set global brightness (0-255)."""
+        self._brightness = brightness
+
+    def getBrightness(self):  # pylint: disable=invalid-name
+        """Return global brightness (0-255)."""
+        return self._brightness
+
+    @abc.abstractmethod
+    def show(self):
+        """Push the current pixel data out to the strip."""
+
+    def gpio_pins(self):
+        """Return the GPIO pins driving the LEDs ; none unless on real hardware."""
+        return frozenset()
+
+    def transfer_seconds(self, freq_hz=800_000):
+        """Return the time needed to clock one frame out to the LEDs."""
+        return self._num_pixels * LED_BITS_PER_PIXEL / freq_hz + LED_RESET_SECONDS
+
+    def stats(self):
+        """Return string containing pertinant stats."""
+        return f"LED backend {self.__class__.__name__}: {self._num_pixels} pixels"
+
+
+class WS281xBackend(LedBackend):
+    """rpi_ws281x hardware output ; one ws2811_t driving one or both PWM channels.
+
+    PWM channels 0 and 1 share one PWM block and DMA channel, so strips on
+    both (eg: GPIO 18 and GPIO 13) have to be driven from a single ws2811_t ;
+    each show() then renders the two channels in one DMA transfer.
+    """
+
+    def __init__(
+        self,
+        num_pixels,
+        pin,
+        freq_hz=800_000,
+        dma=10,
+        invert=False,
+        brightness=255,
+        channel=0,
+        strip_type=None,
+        gamma=None,
+        second_channel=None,
+    ):
+        """second_channel is (pin, channel, num_pixels) for the other PWM channel ;
+        its LEDs follow the LEDs on the first channel."""
+        channels = [(pin, channel, num_pixels)]
+        if second_channel is not None:
+            channels.append(second_channel)
+        super().__init__(sum(count for _pin, _channel, count in channels), brightness)
+        # Imported here so that the rest of the system can run without the
+        # hardware library installed
+        import _rpi_ws281x as ws  # pylint: disable=import-outside-toplevel
+
+        if strip_type is None:
+            strip_type = WS2811_STRIP_GRB
+        self._ws = ws
+        self._leds = ws.new_ws2811_t()
+        # Both channels always exist in ws2811_t ; unused ones have no LEDs
+        for channum in range(2):
+            chan = ws.ws2811_channel_get(self._leds, channum)
+            ws.ws2811_channel_t_count_set(chan, 0)
+            ws.ws2811_channel_t_gpionum_set(chan, 0)
+            ws.ws2811_channel_t_invert_set(chan, 0)
+            ws.ws2811_channel_t_brightness_set(chan, 0)
+        self._channels = []
+        for chan_pin, chan_num, chan_count in channels:
+            chan = ws.ws2811_channel_get(self._leds, chan_num)
+            if gamma is not None:
+                ws.ws2811_channel_t_gamma_set(chan, gamma)
+            ws.ws2811_channel_t_count_set(chan, chan_count)
+            ws.ws2811_channel_t_gpionum_set(chan, chan_pin)
+            ws.ws2811_channel_t_invert_set(chan, 1 if invert else 0)
+            ws.ws2811_channel_t_brightness_set(chan, brightness)
+            ws.ws2811_channel_t_strip_type_set(chan, strip_type)
+            self._channels.append(chan)
+        self._first_count = num_pixels
+        self._channel_counts = [count for _pin, _channel, count in channels]
+        self._pins = frozenset(chan_pin for chan_pin, _channel, _count in channels)
+        ws.ws2811_t_freq_set(self._leds, freq_hz)
+        ws.ws2811_t_dmanum_set(self._leds, dma)
+        # Release the DMA buffers and restore the pins on exit
+        atexit.register(self._cleanup)
+
+    def _cleanup(self):
+        """Free the ws2811_t ; same as PixelStrip._cleanup()."""
+        if self._leds is not None:
+            self._ws.ws2811_fini(self._leds)
+            self._ws.delete_ws2811_t(self._leds)
+            self._leds = None
+            self._channels = []
+
+    def _check(self, resp, call):
+        """Raise RuntimeError if a ws2811_* call failed."""
+        if resp != 0:
+            str_resp = self._ws.ws2811_get_return_t_str(resp)
+            raise RuntimeError(f"{call} failed with code {resp} ({str_resp})")
+
+    def _locate(self, index):
+        """Return (channel, index on that channel) for pixel index."""
+        if index < self._first_count:
+            return self._channels[0], index
+        return self._channels[1], index - self._first_count
+
+    def begin(self):
+        """Initialize the PWM/DMA hardware."""
+        self._check(self._ws.ws2811_init(self._leds), "ws2811_init")
+
+    def setPixelColor(self, index, color):  # pylint: disable=invalid-name
+        """Set pixel index to 24bit packed color."""
+        chan, chan_index = self._locate(index)
+        self._ws.ws2811_led_set(chan, chan_index, color)
+
+    def getPixelColor(self, index):  # pylint: disable=invalid-name
+        """Return 24bit packed color of pixel index."""
+        chan, chan_index = self._locate(index)
+        return self._ws.ws2811_led_get(chan, chan_index)
+
+    def set_pixels(self, indexes, colors):
+        """Set each pixel in indexes (ascending) to the matching 24bit packed color."""
+        # Straight into the channel buffers ; no per pixel method dispatch
+        led_set = self._ws.ws2811_led_set
+        first_chan = self._channels[0]
+        if len(self._channels) == 1:
+            for index, color in zip(indexes, colors):
+                led_set(first_chan, index, color)
+            return
+        second_chan = self._channels[1]
+        first_count = self._first_count
+        for index, color in zip(indexes, colors):
+            if index < first_count:
+                led_set(first_chan, index, color)
+            else:
+                led_set(second_chan, index - first_count, color)
+
+    def setBrightness(self, brightness):  # pylint: disable=invalid-name
+        """Set global brightness (0-255) on each channel in use."""
+        self._brightness = brightness
+        for chan in self._channels:
+            self._ws.ws2811_channel_t_brightness_set(chan, brightness)
+
+    def show(self):
+        """Push the current pixel data out to the strip ; all channels in one render."""
+        self._check(self._ws.ws2811_render(self._leds), "ws2811_render")
+
+    def gpio_pins(self):
+        """Return the GPIO pins driving the LEDs."""
+        return self._pins
+
+    def transfer_seconds(self, freq_hz=800_000):
+        """Return the time needed to clock one frame out ; channels run in parallel."""
+        pixels = max(self._channel_counts)
+        return pixels * LED_BITS_PER_PIXEL / freq_hz + LED_RESET_SECONDS
+
+
+class FrameRing:
+    """Shared memory ring of LED frames for out-of-process viewers.
+
+    Layout: header (magic, slots, pixel count, frame serial) followed by
+    slots * pixel count uint32 packed colors. A reader polls the serial and
+    reads slot (serial - 1) % slots.
+    """
+
+    MAGIC = 0x4C454446  # 'LEDF'
+    HEADER = struct.Struct("<IIIQ")
+
+    def __init__(self, name, slots, num_pixels):
+        # Imported here ; only needed when the ring is enabled
+        from multiprocessing import shared_memory  # pylint: disable=import-outside-toplevel
+
+        self._slots = slots
+        self._num_pixels = num_pixels
+        self._frame_format = struct.Struct(f"<{num_pixels}I")
+        size = self.HEADER.size + slots * self._frame_format.size
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a previous run ; reuse it if it is big enough
+            self._shm = shared_memory.SharedMemory(name=name)
+            if self._shm.size < size:
+                self._shm.close()
+                self._shm.unlink()
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self._serial = 0
+        self.HEADER.pack_into(self._shm.buf, 0, self.MAGIC, slots, num_pixels, 0)
+
+    def write(self, pixels):
+        """Write one frame of packed colors into the next slot."""
+        offset = self.HEADER.size + (self._serial % self._slots) * self._frame_format.size
+        self._frame_format.pack_into(self._shm.buf, offset, *pixels)
+        self._serial += 1
+        # Serial is written last so readers never see a partially written slot as current
+        self.HEADER.pack_into(
+            self._shm.buf, 0, self.MAGIC, self._slots, self._num_pixels, self._serial
+        )
+
+    def close(self):
+        """Release the shared memory segment."""
+        self._shm.close()
+        self._shm.unlink()
+
+
+class NullBackend(LedBackend):
+    """In memory strip ; keeps the last N frames and per show() timing."""
+
+    def __init__(self, num_pixels, brightness=255, history=100, frame_ring=None):
+        super().__init__(num_pixels, brightness)
+        self._pixels = [0] * num_pixels
+        self.frames = collections.deque(maxlen=history)
+        self.frame_count = 0
+        self.show_time_total = 0.0
+        self.last_show_time = None
+        self._frame_ring = frame_ring
+
+    def begin(self):
+        """Nothing to initialize."""
+        debugging.info("Null LED backend - %s pixels", self._num_pixels)
+
+    def setPixelColor(self, index, color):  # pylint: disable=invalid-name
+        """Set pixel index to 24bit packed color."""
+        self._pixels[index] = color
+
+    def getPixelColor(self, index):  # pylint: disable=invalid-name
+        """Return 24bit packed color of pixel index."""
+        return self._pixels[index]
+
+    def set_pixels(self, indexes, colors):
+        """Set each pixel in indexes (ascending) to the matching 24bit packed color."""
+        pixels = self._pixels
+        for index, color in zip(indexes, colors):
+            pixels[index] = color
+
+    def pixels(self):
+        """Return copy of current (uncommitted) pixel data."""
+        return list(self._pixels)
+
+    def show(self):
+        """Record the current frame."""
+        start_time = time.perf_counter()
+        frame = tuple(self._pixels)
+        self.frames.append((time.monotonic(), self._brightness, frame))
+        if self._frame_ring is not None:
+            self._frame_ring.write(frame)
+        self.frame_count += 1
+        self.last_show_time = time.perf_counter() - start_time
+        self.show_time_total += self.last_show_time
+
+    def stats(self):
+        """Return string containing pertinant stats."""
+        avg_show = 0
+        if self.frame_count:
+            avg_show = self.show_time_total / self.frame_count * 1_000_000
+        return (
+            f"LED backend NullBackend: {self._num_pixels} pixels"
+            f" / {self.frame_count} frames / avg show {avg_show:.1f}us"
+        )
+
+
+class ShardedBackend(LedBackend):
+    """One logical LED index space sharded across several physical strips.
+
+    Logical LEDs are assigned to the strips in order ; eg: strips of 500 and
+    600 pixels hold LEDs 0-499 and 500-1099. show() commits every strip back
+    to back. ws2811_render first waits for that strip's previous DMA
+    transfer to finish, then starts the new one and returns ; so a strip's
+    transfer runs while the following strips are committed, but a show()
+    that comes sooner than the last transfer took blocks for the remainder.
+    The per strip show() call time is recorded, along with the transfer time
+    the LED count implies.
+    """
+
+    def __init__(self, strips, brightness=255, freq_hz=800_000):
+        """strips is a list of (name, backend) ; name labels the per strip metrics."""
+        super().__init__(sum(strip.numPixels() for _name, strip in strips), brightness)
+        self._strips = strips
+        self._freq_hz = freq_hz
+        # Logical index -> (strip, index on that strip)
+        self._pixel_map = []
+        # (first logical index, strip) ; for slicing set_pixels() by strip
+        self._strip_starts = []
+        for _name, strip in strips:
+            self._strip_starts.append((len(self._pixel_map), strip))
+            self._pixel_map.extend((strip, index) for index in range(strip.numPixels()))
+        self._show_time_total = dict.fromkeys((name for name, _strip in strips), 0.0)
+        self._show_count = 0
+
+    def begin(self):
+        """Initialize each strip."""
+        for name, strip in self._strips:
+            debugging.info("LED strip %s : %s pixels", name, strip.numPixels())
+            strip.begin()
+
+    def setPixelColor(self, index, color):  # pylint: disable=invalid-name
+        """Set pixel index to 24bit packed color."""
+        strip, strip_index = self._pixel_map[index]
+        strip.setPixelColor(strip_index, color)
+
+    def getPixelColor(self, index):  # pylint: disable=invalid-name
+        """Return 24bit packed color of pixel index."""
+        strip, strip_index = self._pixel_map[index]
+        return strip.getPixelColor(strip_index)
+
+    def set_pixels(self, indexes, colors):
+        """Set each pixel in indexes (ascending) to the matching 24bit packed color.
+
+        The indexes are sliced by strip, and each strip gets one set_pixels call.
+        """
+        for start, strip in self._strip_starts:
+            low = bisect.bisect_left(indexes, start)
+            high = bisect.bisect_left(indexes, start + strip.numPixels())
+            if low < high:
+                strip.set_pixels(
+                    [index - start for index in indexes[low:high]], colors[low:high]
+                )
+
+    def setBrightness(self, brightness):  # pylint: disable=invalid-name
+        """Set global brightness (0-255) on every strip."""
+        self._brightness = brightness
+        for _name, strip in self._strips:
+            strip.setBrightness(brightness)
+
+    def show(self):
+        """Push the current pixel data out to every strip ; timing each show() call."""
+        for name, strip in self._strips:
+            start_time = time.perf_counter()
+            strip.show()
+            show_time = time.perf_counter() - start_time
+            self._show_time_total[name] += show_time
+            metrics.observe("led_show_call_seconds", show_time, strip=name)
+        self._show_count += 1
+
+    def gpio_pins(self):
+        """Return the GPIO pins driving the LEDs on every strip."""
+        return frozenset().union(*(strip.gpio_pins() for _name, strip in self._strips))
+
+    def transfer_seconds(self, freq_hz=800_000):
+        """Return the time needed to clock one frame out ; strips run in parallel."""
+        return max(strip.transfer_seconds(freq_hz) for _name, strip in self._strips)
+
+    def stats(self):
+        """Return string containing pertinant stats."""
+        strip_stats = []
+        for name, strip in self._strips:
+            avg_show = 0
+            if self._show_count:
+                avg_show = self._show_time_total[name] / self._show_count * 1_000_000
+            transfer = strip.transfer_seconds(self._freq_hz) * 1_000_000
+            strip_stats.append(
+                f"{name} {strip.numPixels()} pixels avg show() call {avg_show:.1f}us"
+                f" transfer {transfer:.0f}us"
+            )
+        return f"LED backend ShardedBackend: {' / '.join(strip_stats)}"
+
+
+def parse_led_strips(led_strips, num_pixels, dma):
+    """Parse [lights] led_strips ; returns [(pin, channel, dma, count), ...] or None.
+
+    Entries are pin/channel/dma/count separated by commas, eg:
+    18/0/10/500, 13/1/10/400, 10/0/11 ; a count may be left off the last
+    strip, which then takes the remaining LEDs. DMA defaults to dma.
+
+    GPIO 12/18 are PWM channel 0 and GPIO 13/19 PWM channel 1 ; there is
+    one PWM block, so at most one strip per PWM channel, and a strip on
+    each channel must be listed next to each other with the same DMA.
+    Other strips (SPI GPIO 10, PCM GPIO 21) use channel 0 and need a DMA
+    channel of their own.
+    """
+    if not led_strips or not led_strips.strip():
+        return None
+    strips = []
+    assigned = 0
+    entries = [entry.strip() for entry in led_strips.split(",") if entry.strip()]
+    for position, entry in enumerate(entries):
+        fields = [field.strip() for field in entry.split("/")]
+        try:
+            strip_pin = int(fields[0])
+            strip_channel = int(fields[1]) if len(fields) > 1 and fields[1] else 0
+            strip_dma = int(fields[2]) if len(fields) > 2 and fields[2] else dma
+            if len(fields) > 3 and fields[3]:
+                strip_count = int(fields[3])
+            elif position == len(entries) - 1:
+                strip_count = num_pixels - assigned
+            else:
+                raise ValueError("count is required on all but the last strip")
+        except ValueError as err:
+            debugging.error("led_strips entry :%s: invalid - %s", entry, err)
+            return None
+        if strip_count <= 0:
+            debugging.error("led_strips entry :%s: has no LEDs", entry)
+            return None
+        if strip_channel != PWM_CHANNEL_PINS.get(strip_pin, 0):
+            debugging.error(
+                "led_strips entry :%s: GPIO %s is channel %s",
+                entry,
+                strip_pin,
+                PWM_CHANNEL_PINS.get(strip_pin, 0),
+            )
+            return None
+        strips.append((strip_pin, strip_channel, strip_dma, strip_count))
+        assigned += strip_count
+    if assigned != num_pixels:
+        debugging.error(
+            "led_strips has %s LEDs ; led_count is %s", assigned, num_pixels
+        )
+        return None
+
+    pwm_positions = [
+        position
+        for position, (strip_pin, _channel, _dma, _count) in enumerate(strips)
+        if strip_pin in PWM_CHANNEL_PINS
+    ]
+    if len(pwm_positions) == 2:
+        first, second = (strips[position] for position in pwm_positions)
+        if first[1] == second[1]:
+            debugging.error("led_strips has two strips on PWM channel %s", first[1])
+            return None
+        if pwm_positions[1] != pwm_positions[0] + 1 or first[2] != second[2]:
+            debugging.error(
+                "led_strips PWM channel 0 and 1 strips must be listed next to"
+                " each other with the same DMA"
+            )
+            return None
+    elif len(pwm_positions) > 2:
+        debugging.error("led_strips has more than two PWM strips")
+        return None
+    dma_channels = [device[0][2] for device in strip_devices(strips)]
+    if len(set(dma_channels)) != len(dma_channels):
+        debugging.error("led_strips needs a separate DMA channel for each strip")
+        return None
+    return strips
+
+
+def strip_devices(strips):
+    """Group parsed led_strips by ws2811_t ; a PWM channel 0/1 pair shares one."""
+    devices = []
+    for strip in strips:
+        if (
+            devices
+            and len(devices[-1]) == 1
+            and devices[-1][0][0] in PWM_CHANNEL_PINS
+            and strip[0] in PWM_CHANNEL_PINS
+        ):
+            devices[-1].append(strip)
+        else:
+            devices.append([strip])
+    return devices
+
+
+def create_backend(
+    conf, num_pixels, pin, freq_hz, dma, invert, brightness, channel, strip_type
+):
+    """Create the LED backend selected by [lights] led_backend (ws281x / null / auto).
+
+    If [lights] led_strips needs more than one ws2811_t the LEDs are sharded
+    across them with a ShardedBackend ; a PWM channel 0/1 pair is one strip.
+    """
+    led_strips = parse_led_strips(
+        conf.get_string("lights", "led_strips"), num_pixels, dma
+    )
+    if led_strips is None:
+        return create_strip_backend(
+            conf, num_pixels, pin, freq_hz, dma, invert, brightness, channel, strip_type
+        )
+    devices = strip_devices(led_strips)
+    strips = []
+    for device in devices:
+        pin, channel, dma, num_pixels = device[0]
+        second_channel = None
+        if len(device) > 1:
+            second_pin, second_ch, _dma, second_count = device[1]
+            second_channel = (second_pin, second_ch, second_count)
+        strip = create_strip_backend(
+            conf,
+            num_pixels,
+            pin,
+            freq_hz,
+            dma,
+            invert,
+            brightness,
+            channel,
+            strip_type,
+            frame_ring=len(devices) == 1,
+            second_channel=second_channel,
+        )
+        name = "+".join(f"{strip[0]}/{strip[1]}" for strip in device)
+        strips.append((name, strip))
+    if len(strips) == 1:
+        return strips[0][1]
+    return ShardedBackend(strips, brightness, freq_hz)
+
+
+def create_strip_backend(
+    conf,
+    num_pixels,
+    pin,
+    freq_hz,
+    dma,
+    invert,
+    brightness,
+    channel,
+    strip_type,
+    frame_ring=True,
+    second_channel=None,
+):
+    """Create the backend for one ws2811_t ; optionally without a frame ring.
+
+    second_channel is (pin, channel, num_pixels) for the other PWM channel.
+    """
+    backend_name = conf.get_string("lights", "led_backend").lower()
+    if backend_name in ("ws281x", "auto"):
+        try:
+            return WS281xBackend(
+                num_pixels,
+                pin,
+                freq_hz=freq_hz,
+                dma=dma,
+                invert=invert,
+                brightness=brightness,
+                channel=channel,
+                strip_type=strip_type,
+                second_channel=second_channel,
+            )
+        except (ImportError, RuntimeError) as err:
+            if backend_name == "ws281x":
+                raise
+            debugging.warn("LED hardware not available (%s) - using null backend", err)
+    elif backend_name != "null":
+        debugging.warn("Unknown led_backend :%s: - using null backend", backend_name)
+
+    if second_channel is not None:
+        num_pixels += second_channel[2]
+    ring = None
+    ring_slots = conf.get_int("lights", "led_frame_ring_slots")
+    if ring_slots > 0 and frame_ring:
+        ring = FrameRing("livemap_leds", ring_slots, num_pixels)
+    return NullBackend(num_pixels, brightness, frame_ring=ring)
@@ -13,15 +13,9 @@ import math
 
 from enum import Enum
 
-import board
-from rpi_ws281x import (
-    Color,
-    PixelStrip,
-    ws,
-)  # works with python 3.7. sudo pip3 install rpi_ws281x
-
 import random
 import debugging
+from led_backend import WS281xBackend, pixel_color
 
 
 class LedStrip:
@@ -204,7 +198,7 @@ class LedStrip:
 
     def start(self):
         """Initialize LED string"""
-        self._leds = PixelStrip(
+        self._leds = WS281xBackend(
             self._pixelcount,
             self.pin,
             freq_hz=self.freq,
@@ -219,7 +213,7 @@ class LedStrip:
 
     def colorcode(self, color):
         """Convert (RGB) color code to Color datatype"""
-        return Color(color[0], color[1], color[2])
+        return pixel_color(color[0], color[1], color[2])
 
     def brightness(self):
         """Current Brightness"""
@@ -301,13 +295,13 @@ class LedStrip:
     def wheel(self, pos):
         """Generate rainbow colors across 0-255 positions."""
         if pos < 85:
-            return Color(pos * 3, 255 - pos * 3, 0)
+            return pixel_color(pos * 3, 255 - pos * 3, 0)
         elif pos < 170:
             pos -= 85
-            return Color(255 - pos * 3, 0, pos * 3)
+            return pixel_color(255 - pos * 3, 0, pos * 3)
         else:
             pos -= 170
-            return Color(0, pos * 3, 255 - pos * 3)
+            return pixel_color(0, pos * 3, 255 - pos * 3)
 
     def rainbowCycle(self, led_indexations, wait=0.1):
         """Draw rainbow that uniformly distributes itself across all pixels."""
@@ -316,7 +310,7 @@ class LedStrip:
                 if (
                     str(led_index) in self.nullpins
                 ):  # exclude NULL and LGND pins from wipe
-                    self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                    self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
                 else:
                     self._leds.setPixelColor(
                         led_index,
@@ -355,7 +349,7 @@ class LedStrip:
         else:
             data = [grn, red, blu]
 
-        xcolor = Color(data[0], data[1], data[2])
+        xcolor = pixel_color(data[0], data[1], data[2])
         return xcolor
 
     # range to loop through floats, rather than integers. Used to loop through lat/lons.
@@ -672,7 +666,7 @@ class LedStrip:
     def allonoff_wipes(self, color1, delay):
         for led_index in range(self._leds.numPixels()):
             if str(led_index) in self.nullpins:  # exclude NULL and LGND pins from wipe
-                self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
             else:
                 color = self.rgbtogrb_wipes(led_index, color1, self.rgb_grb)
                 self._leds.setPixelColor(led_index, color)
@@ -687,7 +681,7 @@ class LedStrip:
                 if (
                     str(led_index) in self.nullpins
                 ):  # exclude NULL and LGND pins from wipe
-                    self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                    self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
                 else:
                     color2 = self.dimwipe(color1, val)
                     color = self.rgbtogrb_wipes(led_index, color2, self.rgb_grb)
@@ -700,7 +694,7 @@ class LedStrip:
                 if (
                     str(led_index) in self.nullpins
                 ):  # exclude NULL and LGND pins from wipe
-                    self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                    self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
                 else:
                     color2 = self.dimwipe(color1, val)
                     color = self.rgbtogrb_wipes(led_index, color2, self.rgb_grb)
@@ -732,7 +726,7 @@ class LedStrip:
         random.shuffle(l)
         for led_index in l:
             if str(led_index) in self.nullpins:  # exclude NULL and LGND pins from wipe
-                self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
             else:
                 color = self.rgbtogrb_wipes(led_index, color1, self.rgb_grb)
                 self._leds.setPixelColor(led_index, color)
@@ -743,7 +737,7 @@ class LedStrip:
         random.shuffle(l)
         for led_index in l:
             if str(led_index) in self.nullpins:  # exclude NULL and LGND pins from wipe
-                self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
             else:
                 color = self.rgbtogrb_wipes(led_index, color2, self.rgb_grb)
                 self._leds.setPixelColor(led_index, color)
@@ -782,7 +776,7 @@ class LedStrip:
                         if (
                             str(led_index) in self.nullpins
                         ):  # exclude NULL and LGND pins from wipe
-                            self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                            self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
                         else:
                             color = self.rgbtogrb_wipes(led_index, color1, self.rgb_grb)
                             self._leds.setPixelColor(led_index, color)
@@ -793,7 +787,7 @@ class LedStrip:
                         if (
                             str(led_index) in self.nullpins
                         ):  # exclude NULL and LGND pins from wipe
-                            self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                            self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
                         else:
                             color = self.rgbtogrb_wipes(led_index, color2, self.rgb_grb)
                             self._leds.setPixelColor(led_index, color)
@@ -819,7 +813,7 @@ class LedStrip:
                             if (
                                 str(led_index) in self.nullpins
                             ):  # exclude NULL and LGND pins from wipe
-                                self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                                self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
                             else:
                                 color = self.rgbtogrb_wipes(
                                     led_index, color1, self.rgb_grb
@@ -834,7 +828,7 @@ class LedStrip:
                             if (
                                 str(led_index) in self.nullpins
                             ):  # exclude NULL and LGND pins from wipe
-                                self._leds.setPixelColor(led_index, Color(0, 0, 0))
+                                self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
                             else:
                                 color = self.rgbtogrb_wipes(
                                     led_index, color2, self.rgb_grb
@@ -857,8 +851,8 @@ class LedStrip:
             if (
                 str(led_index) in self.nullpins or str(rabbit) in self.nullpins
             ):  # exclude NULL and LGND pins from wipe
-                self._leds.setPixelColor(led_index, Color(0, 0, 0))
-                self._leds.setPixelColor(rabbit, Color(0, 0, 0))
+                self._leds.setPixelColor(led_index, pixel_color(0, 0, 0))
+                self._leds.setPixelColor(rabbit, pixel_color(0, 0, 0))
 
             else:
 
@@ -879,8 +873,8 @@ class LedStrip:
             if (
                 str(rabbit) in self.nullpins or str(erase_pin) in self.nullpins
             ):  # exclude NULL and LGND pins from wipe
-                self._leds.setPixelColor(rabbit, Color(0, 0, 0))
-                self._leds.setPixelColor(erase_pin, Color(0, 0, 0))
+                self._leds.setPixelColor(rabbit, pixel_color(0, 0, 0))
+                self._leds.setPixelColor(erase_pin, pixel_color(0, 0, 0))
                 self._leds.show()
             else:
 
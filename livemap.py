@@ -13,152 +13,248 @@ Start individual threads
  d) Web interface for config and maps
  e) Light Sensor thread
 
+Startup is staged ; the LED strip is lit first from the warm start state,
+then the remaining subsystems are imported and initialized in parallel.
+Subsystems disabled in [modules] are never imported.
 """
 
 # livemap.py - Main engine ; running threads to keep the data updated
 
-# import os
-# import sys
+import os
+import signal
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # import logging
 import debugging
+import metrics
 import conf  # Config.py holds user settings used by the various scripts
 
-# import admin
+# Everything else is imported by the startup stage that needs it ;
+# webviews (Flask / folium), update_oled (luma / PIL) and sysinfo (psutil)
+# take seconds to import on a Pi Zero
+# pylint: disable=import-outside-toplevel
+
+
+class StartupStage:
+    """Context manager that logs and records the time taken by a startup stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.timer = metrics.timer("startup_stage_seconds", stage=name)
+
+    def __enter__(self):
+        debugging.info("Startup stage %s : starting", self.name)
+        self.timer.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timer.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None:
+            debugging.info(
+                "Startup stage %s : complete in %.2fs", self.name, self.timer.elapsed
+            )
+        else:
+            debugging.error(
+                "Startup stage %s : failed after %.2fs - %s",
+                self.name,
+                self.timer.elapsed,
+                exc_value,
+            )
+        return False
+
+
+def start_thread(target, name, args=()):
+    """Create and start a named thread."""
+    debugging.info("Starting %s thread", name)
+    thread = threading.Thread(target=target, name=name, args=args)
+    thread.start()
+    return thread
+
+
+def stage_leds(app_conf):
+    """Airport DB (warm start) and the LED strip ; then the data refresh threads."""
+    with StartupStage("leds"):
+        import update_datasets
+        import update_airports
+        import update_leds
+
+        dataset_sync = update_datasets.DataSets(app_conf)
+        airport_database = update_airports.AirportDB(app_conf, dataset_sync)
+        led_mgmt = update_leds.UpdateLEDs(app_conf, airport_database)
+        start_thread(led_mgmt.update_loop, "led management")
+        start_thread(dataset_sync.update_loop, "datasetsync", (app_conf,))
+        start_thread(airport_database.update_loop, "airportdb", (app_conf,))
+    return dataset_sync, airport_database, led_mgmt
+
+
+def stage_sysinfo():
+    """System information ; used by the OLEDs and the web interface."""
+    with StartupStage("sysinfo"):
+        import sysinfo
+
+        sysdata = sysinfo.SystemData()
+        sysdata.refresh()
+    return sysdata
 
-# from flask import Flask
 
-import utils
-import utils_i2c
-import sysinfo
+def stage_i2c(app_conf):
+    """I2C bus ; shared by the OLEDs and the light sensor."""
+    with StartupStage("i2c"):
+        import utils_i2c
 
-# import appinfo
+        i2cbus = utils_i2c.I2CBus(app_conf)
+    return i2cbus
 
-import update_datasets
-import update_airports
-import update_leds
-import update_gpio
-import update_oled
-import update_lightsensor
-import appinfo
-import webviews
 
-# import update_oled
+def stage_gpio(app_conf, airport_database, led_mgmt):
+    """Rotary switch and refresh button monitoring."""
+    with StartupStage("gpio"):
+        import update_gpio
 
-if __name__ == "__main__":
-    # Startup and run the threads to operate the LEDs, Displays etc.
+        gpio_mon = update_gpio.UpdateGPIO(app_conf, airport_database, led_mgmt)
+        start_thread(gpio_mon.update_loop, "gpio monitoring")
+    return gpio_mon
 
-    # Initialize configuration
-    app_conf = conf.Conf()
-    app_info = appinfo.AppInfo()
 
-    # Setup Logging
-    debugging.loginit()
+def stage_lightsensor(app_conf, i2c_future, led_mgmt):
+    """Light sensor ; waits for the i2c stage."""
+    i2cbus = i2c_future.result()
+    with StartupStage("lightsensor"):
+        import update_lightsensor
 
-    # Check for working Internet
-    if utils.wait_for_internet():
-        # Check for working Internet access
-        debugging.info("Internet Available")
-    else:
-        debugging.warn("Internet NOT Available")
+        lux_sensor = update_lightsensor.LightSensor(app_conf, i2cbus, led_mgmt)
+        start_thread(lux_sensor.update_loop, "lightsensor", (app_conf,))
+    return lux_sensor
 
-    # Generate System Data
-    sysdata = sysinfo.SystemData()
-    sysdata.refresh()
-    ipaddr = sysdata.local_ip()
 
-    i2cbus = utils_i2c.I2CBus(app_conf)
+def stage_oled(app_conf, sysdata_future, i2c_future, airport_database):
+    """OLED panels ; waits for the sysinfo and i2c stages."""
+    sysdata = sysdata_future.result()
+    i2cbus = i2c_future.result()
+    with StartupStage("oled"):
+        import update_oled
 
-    # Download Datasets
-    dataset_sync = update_datasets.DataSets(app_conf)
+        oled_mgmt = update_oled.UpdateOLEDs(app_conf, sysdata, airport_database, i2cbus)
+        start_thread(oled_mgmt.update_loop, "oled management")
+    return oled_mgmt
 
-    # Setup Airport DB
-    airport_database = update_airports.AirportDB(app_conf, dataset_sync)
 
-    # Setup LED Management
-    LEDmgmt = update_leds.UpdateLEDs(app_conf, airport_database)
+def stage_web(app_conf, sysdata_future, airport_database, led_mgmt):
+    """Flask web interface ; waits for the sysinfo stage."""
+    sysdata = sysdata_future.result()
+    with StartupStage("web"):
+        import appinfo
+        import webviews
 
-    # Setup LightSensor Management
-    LuxSensor = update_lightsensor.LightSensor(app_conf, i2cbus, LEDmgmt)
+        app_info = appinfo.AppInfo()
+        web_app = webviews.WebViews(
+            app_conf, sysdata, airport_database, app_info, led_mgmt
+        )
+        start_thread(web_app.run, "flask web server")
+    return web_app
 
-    # Setup GPIO Monitoring
-    GPIOmon = update_gpio.UpdateGPIO(app_conf, airport_database)
 
-    # Setup OLED Management
-    OLEDmgmt = update_oled.UpdateOLEDs(app_conf, sysdata, airport_database, i2cbus)
+def install_shutdown_handler(airport_database):
+    """SIGTERM (systemctl stop) ; write pending airports.json edits, then exit.
 
-    # Setup Flask APP
-    web_app = webviews.WebViews(app_conf, sysdata, airport_database, app_info, LEDmgmt)
+    The worker threads never return, so the interpreter would wait for them
+    forever and atexit handlers wouldn't run ; flush here and exit directly.
+    """
 
-    # Almost Setup
-    debugging.info(f"Livemap Startup - IP: {ipaddr}")
-    debugging.info(f'Base Directory : {app_conf.get_string("filenames", "basedir")}')
+    def shutdown(signum, _frame):
+        debugging.info("Livemap shutdown : signal %s", signum)
+        airport_database.flush_save()
+        debugging.logstop()
+        os._exit(0)  # pylint: disable=protected-access
 
-    #
-    # Setup Threads
-    #
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
 
-    # Get datasets
-    debugging.info("Starting DataSet download thread")
-    dataset_thread = threading.Thread(
-        target=dataset_sync.update_loop, name="datasetsync", args=(app_conf,)
-    )
 
-    # Load Airports
-    debugging.info("Starting Airport data management thread")
-    airport_thread = threading.Thread(
-        target=airport_database.update_loop,
-        name="airportdb",
-        args=(
-            app_conf,
-        ),
-    )
+def stage_result(name, future):
+    """Return the result of a startup stage, or None if it failed."""
+    try:
+        return future.result()
+    except Exception as err:
+        debugging.error("Startup stage %s unavailable : %s", name, err)
+        return None
 
-    # Updating LEDs
-    debugging.info("Starting LED updating thread")
-    led_thread = threading.Thread(
-        target=LEDmgmt.update_loop, name="led management", args=()
-    )
 
-    # Updating LightSensor
-    debugging.info("Starting Light Sensor thread")
-    lightsensor_thread = threading.Thread(
-        target=LuxSensor.update_loop, name="lightsensor", args=(app_conf,)
-    )
+if __name__ == "__main__":
+    # Startup and run the threads to operate the LEDs, Displays etc.
 
-    # Updating OLEDs
-    debugging.info("Starting OLED updating thread")
-    oled_thread = threading.Thread(
-        target=OLEDmgmt.update_loop, name="oled management", args=()
-    )
+    # Initialize configuration
+    app_conf = conf.Conf()
 
-    # Monitoring GPIO pins
-    debugging.info("Starting GPIO monitoring thread")
-    gpio_thread = threading.Thread(
-        target=GPIOmon.update_loop, name="gpio monitoring", args=()
+    # Setup Logging
+    debugging.loginit(app_conf)
+    startup_start = time.perf_counter()
+
+    # Internet access is checked by the DataSets thread ; the LEDs start
+    # from the last known state rather than waiting for the network
+    dataset_sync, airport_database, LEDmgmt = stage_leds(app_conf)
+    install_shutdown_handler(airport_database)
+
+    use_oled = app_conf.get_bool("modules", "use_oled_panels")
+    use_lightsensor = app_conf.get_bool("modules", "use_light_sensor")
+    use_web = app_conf.get_bool("modules", "use_web_interface")
+    use_gpio = app_conf.get_bool("modules", "use_gpio")
+
+    # Everything else is independent of the LEDs ; import and start in parallel.
+    # Stages block on other stages' futures, so each stage needs its own worker
+    # or a queued prerequisite could never run.
+    stage_count = sum(
+        (
+            True,  # sysinfo
+            use_oled or use_lightsensor,  # i2c
+            use_gpio,
+            use_lightsensor,
+            use_oled,
+            use_web,
+        )
     )
+    stages = {}
+    with ThreadPoolExecutor(
+        max_workers=stage_count, thread_name_prefix="startup"
+    ) as executor:
+        sysdata_future = executor.submit(stage_sysinfo)
+        stages["sysinfo"] = sysdata_future
+        if use_oled or use_lightsensor:
+            i2c_future = executor.submit(stage_i2c, app_conf)
+            stages["i2c"] = i2c_future
+        if use_gpio:
+            stages["gpio"] = executor.submit(
+                stage_gpio, app_conf, airport_database, LEDmgmt
+            )
+        if use_lightsensor:
+            stages["lightsensor"] = executor.submit(
+                stage_lightsensor, app_conf, i2c_future, LEDmgmt
+            )
+        if use_oled:
+            stages["oled"] = executor.submit(
+                stage_oled, app_conf, sysdata_future, i2c_future, airport_database
+            )
+        if use_web:
+            stages["web"] = executor.submit(
+                stage_web, app_conf, sysdata_future, airport_database, LEDmgmt
+            )
+    subsystems = {name: stage_result(name, future) for name, future in stages.items()}
+    sysdata = subsystems["sysinfo"]
+    i2cbus = subsystems.get("i2c")
 
-    # Flask Thread
-    debugging.info("Creating Flask Thread")
-    flask_thread = threading.Thread(
-        target=web_app.run, name="flask web server", args=()
+    # Almost Setup
+    if sysdata is not None:
+        debugging.info("Livemap Startup - IP: %s", sysdata.local_ip())
+    debugging.info("Base Directory : %s", app_conf.get_string("filenames", "basedir"))
+    started = [name for name, obj in subsystems.items() if obj is not None]
+    debugging.info(
+        "Livemap Startup complete in %.2fs - stages: leds, %s",
+        time.perf_counter() - startup_start,
+        ", ".join(started),
     )
 
-    #
-    # Start Executing Threads
-    #
-
-    debugging.info("Starting threads")
-    dataset_thread.start()
-    airport_thread.start()
-    led_thread.start()
-    gpio_thread.start()
-    oled_thread.start()
-    flask_thread.start()
-    lightsensor_thread.start()
-
     MAIN_LOOP_SLEEP = 5
 
     while True:
@@ -167,13 +263,15 @@ if __name__ == "__main__":
         debugging.info(info_msg)
 
         for thread_obj in threading.enumerate():
-            debugging.info(f"ID:{thread_obj.ident}/name:{thread_obj.name}")
+            debugging.info("ID:%s/name:%s", thread_obj.ident, thread_obj.name)
 
-        sysdata.refresh()
+        if sysdata is not None:
+            sysdata.refresh()
         # TODO: We should get around to generating and reporting health
         # metrics in this loop.
         debugging.info(airport_database.stats())
-        debugging.info(i2cbus.stats())
+        if i2cbus is not None:
+            debugging.info(i2cbus.stats())
         debugging.info(dataset_sync.stats())
 
         time.sleep(MAIN_LOOP_SLEEP * 60)
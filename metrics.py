@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*- #
+"""
+Lightweight instrumentation for the livemap threads.
+
+Counters, gauges and timers are kept in a single process wide registry,
+protected by a lock, and exported as Prometheus text or JSON (see /metrics).
+
+Usage:
+    metrics.inc("download_bytes_total", nbytes, source="metar")
+    metrics.set_gauge("stations_parsed", count)
+    with metrics.timer("metar_parse_seconds"):
+        ...
+
+All metric names are exported with a livemap_ prefix.
+"""
+
+import threading
+import time
+
+PREFIX = "livemap_"
+
+# Help text for the exported metrics
+METRIC_HELP = {
+    "startup_stage_seconds": "Time taken by each livemap startup stage",
+    "download_seconds": "Time taken by each dataset download attempt",
+    "download_bytes_total": "Bytes written by dataset downloads",
+    "download_total": "Dataset download attempts by result",
+    "datasets_cycle_seconds": "DataSets update loop cycle time",
+    "download_failures": "Consecutive failed downloads per source ; 0 when healthy",
+    "airportdb_cycle_seconds": "AirportDB update loop processing time",
+    "metar_parse_seconds": "METAR XML parse and airport update time",
+    "taf_parse_seconds": "TAF XML parse time",
+    "stations_parsed": "Stations found in the last parsed dataset",
+    "stations_changed": "Stations with a new observation in the last parsed dataset",
+    "stations_nearest_fallback": "LED airports showing the nearest reporting station",
+    "stations_old": "Active airports with an observation older than metar_age",
+    "metar_parse_cache_total": "Parsed METAR cache lookups by result",
+    "airportdb_save_seconds": "airports.json write time",
+    "airportdb_save_requests_total": "airports.json save requests (coalesced)",
+    "airportdb_state_save_seconds": "Warm start weather state write time",
+    "led_frame_seconds": "LED frame generation and commit time",
+    "led_frames_total": "LED frames committed",
+    "led_show_call_seconds": "Time in show() per strip ; includes waiting for its last DMA",
+    "led_frames_late_total": "LED frames that took longer than the frame interval",
+    "led_frames_unchanged_total": "LED frames identical to the previous frame",
+    "led_brightness": "Current LED strip brightness (0-255)",
+    "light_sensor_lux": "Last light sensor reading",
+    "oled_render_seconds": "OLED panel render time",
+    "oled_cycle_seconds": "OLED update loop cycle time",
+    "oled_frames_total": "OLED frames by result ; unchanged frames aren't sent",
+    "i2c_lock_wait_seconds": "Time spent acquiring the i2c bus lock",
+    "i2c_lock_hold_seconds": "Time the i2c bus lock was held",
+    "i2c_lock_busy_total": "i2c bus lock requests queued because the lock was held",
+    "i2c_lock_timeout_total": "i2c bus lock requests that timed out in the queue",
+    "i2c_mux_writes_total": "i2c MUX channel writes by result",
+    "i2c_scan_total": "Full i2c bus scans used to refresh the device map",
+}
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timers = {}
+
+
+def _key(name, labels):
+    """Registry key for name + labels."""
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increment counter name by value."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Set gauge name to value."""
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def observe(name, seconds, **labels):
+    """Record a duration for timer name."""
+    key = _key(name, labels)
+    with _lock:
+        stats = _timers.get(key)
+        if stats is None:
+            # count, sum, max, last
+            _timers[key] = [1, seconds, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] = seconds
+
+
+class timer:  # pylint: disable=invalid-name
+    """Context manager that records the elapsed time of the block to a timer."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start_time = 0
+        self.elapsed = 0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.perf_counter() - self.start_time
+        observe(self.name, self.elapsed, **self.labels)
+        return False
+
+
+def reset():
+    """Clear all metrics."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timers.clear()
+
+
+def snapshot():
+    """Return a JSON serializable copy of all metrics."""
+    with _lock:
+        counters = list(_counters.items())
+        gauges = list(_gauges.items())
+        timers = [(key, list(stats)) for key, stats in _timers.items()]
+
+    def entry(key, **values):
+        name, labels = key
+        return {"name": PREFIX + name, "labels": dict(labels), **values}
+
+    return {
+        "counters": [entry(key, value=value) for key, value in counters],
+        "gauges": [entry(key, value=value) for key, value in gauges],
+        "timers": [
+            entry(key, count=stats[0], sum=stats[1], max=stats[2], last=stats[3])
+            for key, stats in timers
+        ],
+    }
+
+
+def _label_text(labels):
+    """Format prometheus label set."""
+    if not labels:
+        return ""
+    label_list = ",".join(f'{label}="{value}"' for label, value in labels)
+    return "{" + label_list + "}"
+
+
+def prometheus_text():
+    """Return all metrics in Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        timers = sorted((key, list(stats)) for key, stats in _timers.items())
+
+    lines = []
+    described = set()
+
+    def describe(name, metric_type):
+        if name in described:
+            return
+        described.add(name)
+        if name in METRIC_HELP:
+            lines.append(f"# HELP {PREFIX}{name} {METRIC_HELP[name]}")
+        lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+
+    for (name, labels), value in counters:
+        describe(name, "counter")
+        lines.append(f"{PREFIX}{name}{_label_text(labels)} {value}")
+    for (name, labels), value in gauges:
+        describe(name, "gauge")
+        lines.append(f"{PREFIX}{name}{_label_text(labels)} {value}")
+    for (name, labels), (count, total, _maximum, _last) in timers:
+        describe(name, "summary")
+        lines.append(f"{PREFIX}{name}_count{_label_text(labels)} {count}")
+        lines.append(f"{PREFIX}{name}_sum{_label_text(labels)} {total:.6f}")
+    # Max / last durations are exported as separate gauge families
+    for suffix, index in (("max", 2), ("last", 3)):
+        for (name, labels), stats in timers:
+            describe(f"{name}_{suffix}", "gauge")
+            lines.append(
+                f"{PREFIX}{name}_{suffix}{_label_text(labels)} {stats[index]:.6f}"
+            )
+    return "\n".join(lines) + "\n"
@@ -28,28 +28,128 @@ Created on Sat Jun 15 08:01:44 2019.
 # objects up to date with current conditions.
 # This should be the only place that is creating and writing to airport objects.
 # - The airport DB and airport objects should be effectively readonly in all other threads
+#
+# Other threads read a published AirportDBSnapshot ; an immutable view of the DB with a
+# generation number. Updates are copy on write - the parser copies any Airport object it
+# is going to change, builds new dicts off to the side, and then publishes a new snapshot
+# with a single reference swap. A reader that takes one snapshot per frame / request
+# sees a consistent set of airports without taking any locks.
 
 
 # import os
+import atexit
+import copy
+import math
 import time
+import threading
+from collections import deque, namedtuple
 from datetime import datetime
-import shutil
+from types import MappingProxyType
 
 import csv
 import json
 import pytz
 
+import numpy as np
+
 from lxml import etree
 
 import debugging
+import metrics
 
 import utils
+import utils_geo
+import utils_wx
+import utils_wxsrc
 import airport
 
 
+# Immutable view of the airport DB published by AirportDB.publish_snapshot()
+# The dicts are read-only mappings of the writer's dicts, which are replaced and never
+# modified once published ; the Airport objects must be treated as read-only
+# changed_icaos is the set of airports that changed since the previous generation
+# age_buckets maps each active airport to its utils_wx.AGE_* observation age bucket
+AirportDBSnapshot = namedtuple(
+    "AirportDBSnapshot",
+    [
+        "generation",
+        "changed_icaos",
+        "airport_master_dict",
+        "airport_led_dict",
+        "airport_web_dict",
+        "metar_update_time",
+        "taf_xml_dict",
+        "taf_update_time",
+        "led_map",
+        "age_buckets",
+    ],
+)
+
+
+class AirportLEDMap:
+    """Compiled LED index <-> ICAO <-> slot lookup for the LED airports.
+
+    Built once per airports.json load / edit ; treat as read-only.
+    Slots are positions in airport_led_dict order.
+    """
+
+    def __init__(self, airport_led_dict):
+        icaos = []
+        led_indexes = []
+        active = []
+        for icao, airport_obj in airport_led_dict.items():
+            led_index = airport_obj.get_led_index()
+            if led_index is None:
+                continue
+            icaos.append(icao)
+            led_indexes.append(int(led_index))
+            active.append(bool(airport_obj.active()))
+        # slot -> icao / LED index / active
+        self.icaos = tuple(icaos)
+        self.led_indexes = np.array(led_indexes, dtype=np.int32)
+        self.active = np.array(active, dtype=bool)
+        # LED indexes of active airports in slot order ; for per frame loops
+        self.active_leds = tuple(int(led) for led in self.led_indexes[self.active])
+        # icao -> slot
+        self.icao_slots = MappingProxyType(
+            {icao: slot for slot, icao in enumerate(icaos)}
+        )
+        # LED index -> slot ; -1 for LEDs without an airport
+        self.led_count = int(self.led_indexes.max()) + 1 if led_indexes else 0
+        self.led_slots = np.full(self.led_count, -1, dtype=np.int32)
+        self.led_slots[self.led_indexes] = np.arange(len(icaos), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.icaos)
+
+    def led_for_icao(self, icao):
+        """Return the LED index for icao, or None."""
+        slot = self.icao_slots.get(icao)
+        if slot is None:
+            return None
+        return int(self.led_indexes[slot])
+
+    def icao_for_led(self, led_index):
+        """Return the ICAO code on LED led_index, or None."""
+        if not 0 <= led_index < self.led_count:
+            return None
+        slot = self.led_slots[led_index]
+        if slot < 0:
+            return None
+        return self.icaos[slot]
+
+    def is_active(self, icao):
+        """Return True if icao is an active LED airport."""
+        slot = self.icao_slots.get(icao)
+        return slot is not None and bool(self.active[slot])
+
+
 class AirportDB:
     """Airport Database - Keeping track of interesting sets of airport data."""
 
+    # Seconds from an edit to the airports.json write ; later edits share the write
+    SAVE_DELAY = 5
+
     def __init__(self, conf, dataset_thread):
         """Create a database of Airports to be tracked."""
         # TODO: A lot of the class local variables are extras,
@@ -78,6 +178,16 @@ class AirportDB:
 
         # Subset of airport_json_list that is active for LEDs
         self.airport_led_dict = {}
+        # Compiled LED index <-> ICAO lookups for airport_led_dict
+        self.airport_led_map = AirportLEDMap({})
+        # Compiled neighbour wxsrc mappings ; rebuilt with airport_led_map
+        self._wxsrc_graph = utils_wxsrc.WxSourceGraph({})
+        # icao -> station each neighbour airport took weather from last refresh
+        self._wxsrc_stations = {}
+        # icao -> station used by the nearest reporting station fallback
+        self._nearest_stations = {}
+        # icao -> (lat, lon) from airports.csv ; for airports not in the METAR feed
+        self._airport_positions = {}
 
         # Copy of raw json entries loaded from config
         self.airport_master_list = []
@@ -97,67 +207,223 @@ class AirportDB:
         # Airport Data
         self.airport_data = None
 
+        # Published snapshot ; replaced (never modified) by publish_snapshot()
+        # Writers hold _write_lock while building and publishing a new snapshot
+        self._write_lock = threading.Lock()
+        self._snapshot_condition = threading.Condition()
+        self._snapshot = None
+        # (generation, changed_icaos) for recent snapshots ; see changed_icaos_since()
+        self._snapshot_changes = deque(maxlen=32)
+
+        # METAR (observation_time, raw_text) per station from the last refresh
+        # Stations with the same observation are skipped on the next refresh
+        self._metar_observations = {}
+
+        # Pending airports.json write ; see request_save()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        # Held across each airports.json write ; the timer thread and a direct
+        # save share the same tmp file
+        self._json_write_lock = threading.Lock()
+        # The save timer is a daemon thread ; write pending edits on exit
+        atexit.register(self.flush_save)
+
+        # Observations older than this are shown as old data
+        self._metar_max_age = conf.get_float("metar", "metar_age") * 3600
+
+        # Last published weather ; lets the map light up before the first download
+        self._state_file = conf.get_string("filenames", "airports_state")
+
         self.load_airport_db()
+        self.load_state()
+        if self._snapshot is None:
+            self.publish_snapshot()
         debugging.info("AirportDB : init complete")
 
     def stats(self):
         """Return string containing pertinant stats."""
         return f"Statistics:\n\tairport master dict {len(self.airport_master_dict)} entries\n\tairport_web_dict: {len(self.airport_web_dict)}\n\tairport_led_dict: {len(self.airport_led_dict)}"
 
+    def publish_snapshot(self, changed_icaos=frozenset(), age_buckets=None):
+        """Publish the current DB state as a new immutable snapshot.
+
+        The dicts are published without copying ; writers build new dicts rather
+        than modifying ones that may have been published.
+        """
+        previous = self._snapshot
+        generation = 0 if previous is None else previous.generation + 1
+        changed_icaos = frozenset(changed_icaos)
+        if age_buckets is None:
+            age_buckets = self.changed_age_buckets(previous, changed_icaos)
+        snapshot = AirportDBSnapshot(
+            generation=generation,
+            changed_icaos=changed_icaos,
+            airport_master_dict=MappingProxyType(self.airport_master_dict),
+            airport_led_dict=MappingProxyType(self.airport_led_dict),
+            airport_web_dict=MappingProxyType(self.airport_web_dict),
+            metar_update_time=self.metar_update_time,
+            taf_xml_dict=MappingProxyType(self.taf_xml_dict),
+            taf_update_time=self.taf_update_time,
+            led_map=self.airport_led_map,
+            age_buckets=MappingProxyType(age_buckets),
+        )
+        with self._snapshot_condition:
+            self._snapshot = snapshot
+            self._snapshot_changes.append((generation, changed_icaos))
+            self._snapshot_condition.notify_all()
+        debugging.debug("AirportDB : published snapshot generation %s", generation)
+        return snapshot
+
+    def age_buckets(self, airport_master_dict):
+        """Return {icao: utils_wx.AGE_*} for the active airports, as of now."""
+        now = time.time()
+        return {
+            icao: utils_wx.observation_age_bucket(
+                airport_obj.observation_epoch(), now, self._metar_max_age
+            )
+            for icao, airport_obj in airport_master_dict.items()
+            if airport_obj.active()
+        }
+
+    def changed_age_buckets(self, previous, changed_icaos):
+        """Return age buckets for a new snapshot ; only changed_icaos are recomputed."""
+        if previous is None:
+            return self.age_buckets(self.airport_master_dict)
+        if not changed_icaos:
+            if previous.airport_master_dict == self.airport_master_dict:
+                # Same Airport objects ; eg: a TAF refresh
+                return previous.age_buckets
+            return self.age_buckets(self.airport_master_dict)
+        age_buckets = dict(previous.age_buckets)
+        now = time.time()
+        for icao in changed_icaos:
+            airport_obj = self.airport_master_dict.get(icao)
+            if airport_obj is None or not airport_obj.active():
+                age_buckets.pop(icao, None)
+                continue
+            age_buckets[icao] = utils_wx.observation_age_bucket(
+                airport_obj.observation_epoch(), now, self._metar_max_age
+            )
+        return age_buckets
+
+    def refresh_age_buckets(self):
+        """Publish a new snapshot if any airport has moved to another age bucket."""
+        # Observations age with no new data ; eg: the network is down
+        age_buckets = self.age_buckets(self.airport_master_dict)
+        published = self._snapshot.age_buckets
+        changed_icaos = {
+            icao
+            for icao, bucket in age_buckets.items()
+            if published.get(icao) != bucket
+        }
+        if changed_icaos:
+            debugging.debug(
+                "Observation age bucket changed for %s airports", len(changed_icaos)
+            )
+            self.publish_snapshot(changed_icaos, age_buckets)
+        old_buckets = [bucket == utils_wx.AGE_OLD for bucket in age_buckets.values()]
+        metrics.set_gauge("stations_old", sum(old_buckets))
+        return changed_icaos
+
+    def get_snapshot(self):
+        """Return the current published snapshot ; readers should use one per frame / request."""
+        return self._snapshot
+
+    def wait_for_snapshot(self, last_generation, timeout):
+        """Wait up to timeout seconds for a snapshot newer than last_generation ; return get_snapshot()."""
+        with self._snapshot_condition:
+            self._snapshot_condition.wait_for(
+                lambda: self._snapshot.generation != last_generation, timeout
+            )
+            return self._snapshot
+
+    def changed_icaos_since(self, generation):
+        """Return the set of airports changed after snapshot generation.
+
+        Returns None if generation is too old to know ; the caller should refresh everything.
+        """
+        with self._snapshot_condition:
+            if generation >= self._snapshot.generation:
+                return frozenset()
+            if self._snapshot_changes[0][0] > generation + 1:
+                return None
+            changed_icaos = set()
+            for change_generation, change_icaos in self._snapshot_changes:
+                if change_generation > generation:
+                    changed_icaos.update(change_icaos)
+            return frozenset(changed_icaos)
+
     def create_new_airport_record(self, station_id, metar_data):
         """Create new DB record for station_id seeded with metar_data."""
-        debugging.debug(f"New Airport DB Record :{station_id}:")
+        debugging.debug("New Airport DB Record :%s:", station_id)
         airport_obj = airport.Airport(station_id, metar_data)
         return airport_obj
 
     def get_airport(self, airport_icao):
         """Return a single Airport."""
-        return self.airport_master_dict[airport_icao]
+        return self._snapshot.airport_master_dict[airport_icao]
 
     def __get_airport_taf(self, airport_icao):
         """Return a single Airport TAF."""
-        result = None
-        if airport_icao in self.taf_xml_dict:
-            result = self.taf_xml_dict[airport_icao]
-        return result
+        return self._snapshot.taf_xml_dict.get(airport_icao)
 
     def get_airportdb(self):
         """Return a single Airport."""
-        return self.airport_master_dict
-
-    def get_airportxml(self, airport_icao):
-        """Return a single Airport."""
-        return self.metar_xml_dict[airport_icao]
-
-    def get_airportxmldb(self):
-        """Return a single Airport."""
-        return self.metar_xml_dict
+        return self._snapshot.airport_master_dict
 
     def get_airport_dict_led(self):
         """Return Airport LED dict."""
-        return self.airport_led_dict
+        return self._snapshot.airport_led_dict
+
+    def get_led_map(self):
+        """Return the compiled AirportLEDMap ; replaced only when airports.json changes."""
+        return self._snapshot.led_map
 
     def get_metar_update_time(self):
         """Return last update time of metar data."""
-        return self.metar_update_time
+        return self._snapshot.metar_update_time
+
+    def set_heatmap_index(self, heatmap_dict):
+        """Update heatmap index for airports in heatmap_dict {icao: hmcount} and publish."""
+        with self._write_lock:
+            airport_master_dict = dict(self.airport_master_dict)
+            for icao, hmcount in heatmap_dict.items():
+                if icao not in airport_master_dict:
+                    continue
+                airport_obj = copy.copy(airport_master_dict[icao])
+                airport_obj.set_heatmap_index(hmcount)
+                airport_master_dict[icao] = airport_obj
+            self.airport_master_dict = airport_master_dict
+            self.airport_dicts_refresh()
+            self.publish_snapshot(heatmap_dict.keys() & airport_master_dict.keys())
 
     def update_airport_wx(self):
         """Update airport WX data for each known Airport."""
-        for icao, airport_obj in self.airport_master_dict.items():
-            debugging.debug(f"Updating WX for :{airport_obj.icaocode()}:")
+        airport_master_dict = dict(self.airport_master_dict)
+        changed_icaos = set()
+        for icao, airport_obj in airport_master_dict.items():
+            debugging.debug("Updating WX for :%s:", icao)
             if not airport_obj.active():
                 continue
             try:
+                # Copy on write ; readers may be using the published object
+                airport_obj = copy.copy(airport_obj)
                 airport_obj.update_wx(self.metar_xml_dict)
+                airport_master_dict[icao] = airport_obj
+                changed_icaos.add(icao)
             except Exception as err:
                 debug_string = f"Error: update_airport_wx Exception handling for {airport_obj.icaocode()} ICAO:{icao}:"
                 debugging.error(debug_string)
                 debugging.crash(err)
+        self.airport_master_dict = airport_master_dict
+        self.airport_dicts_refresh()
+        self.publish_snapshot(changed_icaos)
 
     def save_data_from_db(self):
         """Create JSON data from Airport datasets."""
         airportdb_list = []
-        for __airport_db_id, airport_obj in self.airport_master_dict.items():
+        # Published snapshot ; safe to walk from the save timer thread
+        for __airport_db_id, airport_obj in self._snapshot.airport_master_dict.items():
             if not airport_obj.save_in_config():
                 continue
             airport_save_record = {}
@@ -179,7 +445,7 @@ class AirportDB:
             self.airport_master_list.append(json_airport)
             airport_icao = json_airport["icao"]
             airport_icao = airport_icao.lower()
-            debugging.info(f"Parsing Json Airport List : {airport_icao}")
+            debugging.debug("Parsing Json Airport List : %s", airport_icao)
 
             if airport_icao in ("null", "lgnd"):
                 # Need a Primary Key if icao code is null or lgnd
@@ -187,7 +453,7 @@ class AirportDB:
                 airport_icao = f"{airport_icao}:{ledindex}"
 
             if airport_icao not in self.airport_master_dict.keys():
-                debugging.info(f"Adding {airport_icao} to airport_master_dict")
+                debugging.debug("Adding %s to airport_master_dict", airport_icao)
                 new_airport_object = self.create_new_airport_record(airport_icao, None)
                 self.airport_master_dict.update({airport_icao: new_airport_object})
             else:
@@ -196,17 +462,17 @@ class AirportDB:
             new_airport_object.set_wxsrc(json_airport["wxsrc"])
             new_airport_object.set_purpose(json_airport["purpose"])
             new_airport_object.set_led_index(int(json_airport["led"]))
-            new_airport_object.set_heatmap_index(json_airport["heatmap"])
+            new_airport_object.set_heatmap_index(int(json_airport["heatmap"]))
 
             new_airport_object.loaded_from_config()
 
             if utils.str2bool(json_airport["active"]):
-                debugging.info(f"Loaded and activated airport :{airport_icao}:")
+                debugging.debug("Loaded and activated airport :%s:", airport_icao)
                 new_airport_object.set_active()
             else:
                 new_airport_object.set_inactive()
         debugging.info(
-            f"Completed loading dict from json : {len(self.airport_master_dict)} items"
+            "Completed loading dict from json : %s items", len(self.airport_master_dict)
         )
         return True
 
@@ -214,21 +480,37 @@ class AirportDB:
         """Update master database sub-lists from master list."""
         # LED List ( purpose: LED / NULL / LGND )
         # WEB List ( purpose: WEB / LGND )
-        debugging.info(
-            f"Copying master dict to other lists {len(self.airport_master_dict)} items"
+        # New dicts are built each time ; the previous dicts may be in a published snapshot
+        debugging.debug(
+            "Copying master dict to other lists %s items", len(self.airport_master_dict)
         )
+        airport_led_dict = {}
+        airport_web_dict = {}
         for airport_icao, airport_obj in self.airport_master_dict.items():
-            debugging.info(f"Airport dicts update for : {airport_icao} :")
             airport_purpose = airport_obj.purpose()
             if airport_purpose in ("led", "all", "off"):
-                self.airport_led_dict.update({airport_icao: airport_obj})
-                debugging.info(f"Adding Airport to airport_led_dict : {airport_icao}")
+                airport_led_dict[airport_icao] = airport_obj
             if airport_purpose in ("web", "all"):
-                self.airport_web_dict.update({airport_icao: airport_obj})
-                debugging.info(f"Adding airport to airport_web_dict : {airport_icao}")
+                airport_web_dict[airport_icao] = airport_obj
+        self.airport_led_dict = airport_led_dict
+        self.airport_web_dict = airport_web_dict
+        # LED <-> ICAO mapping only changes here ; airport_dicts_refresh() keeps it
+        self.airport_led_map = AirportLEDMap(airport_led_dict)
+        self._wxsrc_graph = utils_wxsrc.WxSourceGraph(self.airport_master_dict)
+        self._wxsrc_stations = {}
 
         return True
 
+    def airport_dicts_refresh(self):
+        """Point master database sub-lists at the current master dict objects."""
+        # Same airports as airport_dicts_update() ; objects replaced by copy on write
+        self.airport_led_dict = {
+            icao: self.airport_master_dict[icao] for icao in self.airport_led_dict
+        }
+        self.airport_web_dict = {
+            icao: self.airport_master_dict[icao] for icao in self.airport_web_dict
+        }
+
     def load_airport_db(self):
         """Load Airport Data file."""
         # FIXME: Add file error handling
@@ -236,7 +518,7 @@ class AirportDB:
         airport_json = self.__conf.get_string("filenames", "airports_json")
         # Opening JSON file
         if not utils.file_exists(airport_json):
-            debugging.debug(f"Airport json does not exist: {airport_json}")
+            debugging.debug("Airport json does not exist: %s", airport_json)
             return False
 
         json_file = open(airport_json, encoding="utf8")
@@ -252,25 +534,106 @@ class AirportDB:
         self.airport_dict_from_json(new_airport_json_dict)
         # Update the master dictionary ; overwrite existing keys with new keys
         self.airport_dicts_update()
+        self.publish_snapshot()
         debugging.debug("Airport Load and Merge complete")
 
     def save_airport_db(self):
         """Save Airport Data file."""
         debugging.debug("Saving Airport DB")
-        json_save_data = {}
-        json_save_data_airport = []
         airport_json_backup = self.__conf.get_string(
             "filenames", "airports_json_backup"
         )
         airport_json_new = self.__conf.get_string("filenames", "airports_json_new")
         airport_json = self.__conf.get_string("filenames", "airports_json")
 
-        shutil.move(airport_json, airport_json_backup)
-        json_save_data_airport = self.save_data_from_db()
-        json_save_data["airports"] = json_save_data_airport
-        with open(airport_json_new, "w", encoding="utf8") as json_file:
-            json.dump(json_save_data, json_file, sort_keys=True, indent=4)
-        shutil.move(airport_json_new, airport_json)
+        with self._json_write_lock:
+            json_save_data = {"airports": self.save_data_from_db()}
+            with metrics.timer("airportdb_save_seconds"):
+                saved = utils.atomic_write_json(
+                    airport_json,
+                    json_save_data,
+                    tmp_filename=airport_json_new,
+                    backup_filename=airport_json_backup,
+                )
+        if not saved:
+            debugging.error("Saving Airport DB to %s failed", airport_json)
+        return saved
+
+    def request_save(self):
+        """Schedule save_airport_db() ; edits within SAVE_DELAY share one write."""
+        metrics.inc("airportdb_save_requests_total")
+        with self._save_lock:
+            if self._save_timer is not None:
+                # Already pending ; the write picks up the latest snapshot
+                return
+            self._save_timer = threading.Timer(self.SAVE_DELAY, self.flush_save)
+            self._save_timer.name = "airportdb save"
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush_save(self):
+        """Write a pending airports.json save now ; True if nothing was pending."""
+        with self._save_lock:
+            pending = self._save_timer is not None
+            if pending:
+                self._save_timer.cancel()
+            self._save_timer = None
+        if not pending:
+            return True
+        return self.save_airport_db()
+
+    def save_state(self):
+        """Write the weather in the published snapshot to the warm start state file."""
+        snapshot = self._snapshot
+        airports = {}
+        for icao, airport_obj in snapshot.airport_master_dict.items():
+            if airport_obj.active() and airport_obj.get_raw_metar() is not None:
+                airports[icao] = airport_obj.wx_state()
+        metar_update_time = None
+        if snapshot.metar_update_time is not None:
+            metar_update_time = snapshot.metar_update_time.isoformat()
+        state = {"metar_update_time": metar_update_time, "airports": airports}
+        with metrics.timer("airportdb_state_save_seconds"):
+            return utils.atomic_write_json(self._state_file, state)
+
+    def load_state(self):
+        """Restore the weather saved by save_state() ; marked stale until refreshed."""
+        load_start = time.perf_counter()
+        try:
+            with open(self._state_file, encoding="utf8") as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            debugging.info("No warm start state : %s", self._state_file)
+            return False
+        except (OSError, ValueError) as err:
+            debugging.error("Ignoring warm start state %s : %s", self._state_file, err)
+            return False
+
+        airport_master_dict = dict(self.airport_master_dict)
+        changed_icaos = set()
+        for icao, wx_state in state.get("airports", {}).items():
+            if icao not in airport_master_dict:
+                continue
+            airport_obj = copy.copy(airport_master_dict[icao])
+            try:
+                airport_obj.set_wx_state(wx_state)
+            except (KeyError, TypeError, ValueError) as err:
+                debugging.info("Warm start state for %s ignored : %s", icao, err)
+                continue
+            airport_master_dict[icao] = airport_obj
+            changed_icaos.add(icao)
+        self.airport_master_dict = airport_master_dict
+        self.airport_dicts_refresh()
+        if state.get("metar_update_time"):
+            self.metar_update_time = datetime.fromisoformat(state["metar_update_time"])
+        self.publish_snapshot(changed_icaos)
+        debugging.info(
+            "Warm start : %s airports from %s loaded in %.1fms",
+            len(changed_icaos),
+            self.metar_update_time,
+            (time.perf_counter() - load_start) * 1000,
+        )
+        return True
 
     def update_airportdb_metar_xml(self):
         """Update Airport METAR DICT from XML."""
@@ -279,7 +642,7 @@ class AirportDB:
         debugging.debug("Updating Airports: Starting")
         metar_file = self.__conf.get_string("filenames", "metar_xml_data")
         if not utils.file_exists(metar_file):
-            debugging.info(f"File missing {metar_file} - skipping xml parsing")
+            debugging.info("File missing %s - skipping xml parsing", metar_file)
             return
 
         try:
@@ -302,6 +665,15 @@ class AirportDB:
         debugging.debug("Updating Airports: XML Parse Complete")
         metar_data = []
         display_counter = 0
+        changed_icaos = set()
+        metar_observations = {}
+        # Build the updated master dict off to the side ; published at the end
+        airport_master_dict = dict(self.airport_master_dict)
+        # Ceiling / visibility per station for the batch flight category classifier
+        station_airports = []
+        station_ceiling = []
+        station_visibility = []
+        high_wind_kt = self.__conf.get_int("metar", "max_wind_speed")
 
         for metar_data in root.iter("METAR"):
             if metar_data is None:
@@ -309,33 +681,176 @@ class AirportDB:
             station_id = metar_data.find("station_id").text
             station_id = station_id.lower()
             metar_raw = metar_data.find("raw_text").text
-            # Log an update every 200 stations parsed
+            metar_observation = (metar_data.findtext("observation_time"), metar_raw)
+            metar_observations[station_id] = metar_observation
             # Want to have some tracking of progress through the data set, but not
             # burden the log file with a huge volume of data
             display_counter += 1
             if display_counter % 200 == 0:
-                msg = f"xml parsing: entry:{str(display_counter)}  station_id:{station_id}"
-                debugging.debug(msg)
-            if station_id not in self.airport_master_dict:
-                new_airport_object = self.create_new_airport_record(
-                    station_id, metar_raw
+                debugging.debug(
+                    "xml parsing: entry:%s  station_id:%s", display_counter, station_id
                 )
-                self.airport_master_dict[station_id] = new_airport_object
-            self.airport_master_dict[station_id].set_metar(metar_raw)
-            self.airport_master_dict[station_id].update_airport_xml(
-                station_id, metar_data
+            airport_obj = airport_master_dict.get(station_id)
+            if (
+                airport_obj is not None
+                and self._metar_observations.get(station_id) == metar_observation
+            ):
+                # No new observation since the last refresh
+                continue
+            changed_icaos.add(station_id)
+            if airport_obj is None:
+                airport_obj = self.create_new_airport_record(station_id, metar_raw)
+            else:
+                # Copy on write ; readers may be using the published object
+                airport_obj = copy.copy(airport_obj)
+            airport_obj.set_metar(metar_raw)
+            airport_obj.update_airport_xml(station_id, metar_data)
+            # Decode present weather once here ; the LED loop just tests bits
+            airport_obj.set_wxconditions(
+                utils_wx.decode_wx_effects(
+                    airport_obj.wx_string(),
+                    airport_obj.get_wx_windspeed(),
+                    high_wind_kt,
+                )
+            )
+            airport_master_dict[station_id] = airport_obj
+            station_airports.append(airport_obj)
+            station_ceiling.append(utils_wx.sky_ceiling(metar_data))
+            station_visibility.append(
+                utils_wx.visibility_value(metar_data.findtext("visibility_statute_mi"))
             )
 
             if station_id in ("kbfi", "ksea"):
-                debugging.info(
-                    f"***\nAIRPORT OF INTEREST\n\t{station_id}\t{metar_raw}\n\n"
+                debugging.debug("AIRPORT OF INTEREST %s : %s", station_id, metar_raw)
+
+        # flight_category isn't in the XML when the METAR is incomplete ;
+        # fill those in from the ceiling and visibility that we do have
+        category_codes = utils_wx.classify_flight_categories(
+            station_ceiling, station_visibility
+        )
+        for airport_obj, category_code in zip(station_airports, category_codes):
+            if airport_obj.flightcategory() == "Missing":
+                airport_obj.set_flightcategory(
+                    utils_wx.FLIGHT_CATEGORIES[category_code]
                 )
 
-        self.metar_xml_dict = metar_data
+        self.update_neighbour_wx(airport_master_dict, metar_observations, changed_icaos)
+        if self.__conf.get_bool("metar", "nearest_fallback"):
+            self.update_nearest_wx(
+                airport_master_dict, metar_observations, changed_icaos
+            )
+
+        self._metar_observations = metar_observations
+        self.airport_master_dict = airport_master_dict
+        self.airport_dicts_refresh()
         self.metar_update_time = datetime.now(pytz.utc)
+        self.publish_snapshot(changed_icaos)
+        metrics.set_gauge("stations_parsed", display_counter, dataset="metar")
+        metrics.set_gauge("stations_changed", len(changed_icaos), dataset="metar")
+        debugging.debug(
+            "Updating Airports: %s of %s stations changed",
+            len(changed_icaos),
+            display_counter,
+        )
         debugging.debug("Updating Airports: METAR from XML Complete")
         return True
 
+    def update_neighbour_wx(self, airport_master_dict, reporting, changed_icaos):
+        """Copy station weather to neighbour wxsrc airports ; updates changed_icaos."""
+        wxsrc_stations = {}
+        for station_id, icaos in self._wxsrc_graph.resolve(reporting).items():
+            source_obj = airport_master_dict[station_id]
+            for icao in icaos:
+                wxsrc_stations[icao] = station_id
+                if (
+                    station_id not in changed_icaos
+                    and icao not in changed_icaos
+                    and self._wxsrc_stations.get(icao) == station_id
+                ):
+                    continue
+                # Copy on write ; readers may be using the published object
+                airport_obj = copy.copy(airport_master_dict[icao])
+                airport_obj.set_wx_from(source_obj)
+                airport_master_dict[icao] = airport_obj
+                changed_icaos.add(icao)
+        # Airports whose source stopped reporting mustn't keep showing its weather
+        for icao in self._wxsrc_graph.sources:
+            if icao in wxsrc_stations:
+                continue
+            airport_obj = airport_master_dict[icao]
+            if icao in self._wxsrc_stations or airport_obj.wx_stale():
+                airport_obj = copy.copy(airport_obj)
+                airport_obj.set_wx_unknown()
+                airport_master_dict[icao] = airport_obj
+                changed_icaos.add(icao)
+        unresolved = len(self._wxsrc_graph) - len(wxsrc_stations)
+        if unresolved:
+            debugging.debug("wxsrc: %s neighbour airports without a report", unresolved)
+        self._wxsrc_stations = wxsrc_stations
+
+    def airport_position(self, airport_obj):
+        """Return (lat, lon) for airport_obj ; from the METAR feed or airports.csv."""
+        if airport_obj.valid_coordinates():
+            position = utils_geo.coordinates(
+                airport_obj.latitude(), airport_obj.longitude()
+            )
+            if position is not None:
+                return position
+        return self._airport_positions.get(airport_obj.icaocode())
+
+    def update_nearest_wx(self, airport_master_dict, reporting, changed_icaos):
+        """Give unreported LED airports the weather of the nearest reporting station."""
+        # Once per refresh ; the LED loop just reads the copied observation
+        radius_nm = self.__conf.get_int("metar", "nearest_radius_nm")
+        unreported = [
+            icao
+            for icao, airport_obj in self.airport_led_dict.items()
+            if airport_obj.active()
+            and airport_obj.wxsrc() == "adds"
+            and icao not in reporting
+        ]
+        nearest_stations = {}
+        if unreported:
+            station_index = utils_geo.StationIndex(
+                (
+                    station_id,
+                    airport_master_dict[station_id].latitude(),
+                    airport_master_dict[station_id].longitude(),
+                )
+                for station_id in reporting
+            )
+            for icao in unreported:
+                position = self.airport_position(airport_master_dict[icao])
+                nearest = None
+                if position is not None:
+                    nearest = station_index.nearest(*position, radius_nm=radius_nm)
+                if not nearest:
+                    # No station in range now ; don't keep showing the old one's weather
+                    airport_obj = airport_master_dict[icao]
+                    if icao in self._nearest_stations or airport_obj.wx_stale():
+                        airport_obj = copy.copy(airport_obj)
+                        airport_obj.set_wx_unknown()
+                        airport_master_dict[icao] = airport_obj
+                        changed_icaos.add(icao)
+                    continue
+                station_id, distance = nearest[0]
+                nearest_stations[icao] = station_id
+                if (
+                    station_id not in changed_icaos
+                    and self._nearest_stations.get(icao) == station_id
+                ):
+                    continue
+                debugging.debug(
+                    "Nearest station for %s : %s (%.1fnm)", icao, station_id, distance
+                )
+                # Copy on write ; readers may be using the published object
+                airport_obj = copy.copy(airport_master_dict[icao])
+                airport_obj.set_wx_from(airport_master_dict[station_id])
+                airport_master_dict[icao] = airport_obj
+                changed_icaos.add(icao)
+        metrics.set_gauge("stations_nearest_fallback", len(nearest_stations))
+        self._nearest_stations = nearest_stations
+
     def update_airport_taf_xml(self):
         """Update Airport TAF DICT from XML."""
         # Create a DICT containing TAF records per site
@@ -358,7 +873,7 @@ class AirportDB:
         taf_file = self.__conf.get_string("filenames", "tafs_xml_data")
 
         if not utils.file_exists(taf_file):
-            debugging.info(f"File missing {taf_file} - skipping xml parsing")
+            debugging.info("File missing %s - skipping xml parsing", taf_file)
             return
         try:
             root = etree.parse(taf_file)
@@ -368,6 +883,11 @@ class AirportDB:
             debugging.debug("Not updating - returning")
             return False
 
+        # Flight category for every forecast is classified in one batch at the end
+        forecast_list = []
+        forecast_ceiling = []
+        forecast_visibility = []
+
         for taf in root.iter("TAF"):
             if taf is None:
                 return False
@@ -381,7 +901,7 @@ class AirportDB:
             taf_data["issue_time"] = issue_time
             taf_data["raw_text"] = raw_taf
 
-            debugging.debug(f"TAF: {station_id} - {issue_time}")
+            debugging.debug("TAF: %s - %s", station_id, issue_time)
             fcast_index = 0
             taf_forecast = []
 
@@ -410,113 +930,42 @@ class AirportDB:
                 if forecast.find("wind_gust_kt") is not None:
                     fcast["wind_gust_kt"] = forecast.find("wind_gust_kt").text
 
-                # There can be multiple layers of clouds in each taf, but they are always listed lowest AGL first.
-                # Check the lowest (first) layer and see if it's overcast, broken, or obscured. If it is, then compare to cloud base height to set $
-                # This algorithm basically sets the flight category based on the lowest OVC, BKN or OVX layer.
-                # for each sky_condition from the XML
-                flightcategory = "VFR"
-                for sky_condition in forecast.findall("sky_condition"):
-                    # get the sky cover (BKN, OVC, SCT, etc)
-                    sky_cvr = sky_condition.attrib["sky_cover"]
-                    debugging.debug(sky_cvr)  # debug
-
-                    # If the layer is OVC, BKN or OVX, set Flight category based on height AGL
-                    if sky_cvr in ("OVC", "BKN", "OVX"):
-                        try:
-                            # get cloud base AGL from XML
-                            cld_base_ft_agl = sky_condition.attrib["cloud_base_ft_agl"]
-                            # debugging.debug(cld_base_ft_agl)  # debug
-                        except Exception as err:
-                            # get cloud base AGL from XML
-                            # debugging.error(err)
-                            debugging.debug(err)
-                            cld_base_ft_agl = forecast.find("vert_vis_ft")
-                            if cld_base_ft_agl is not None:
-                                cld_base_ft_agl = cld_base_ft_agl.text
-                            else:
-                                # Default to low clouds
-                                cld_base_ft_agl = "60000"
-
-                        cld_base_ft_agl = int(cld_base_ft_agl)
-                        if cld_base_ft_agl < 500:
-                            flightcategory = "LIFR"
-                            break
-                        if 500 <= cld_base_ft_agl < 1000:
-                            flightcategory = "IFR"
-                            break
-                        if 1000 <= cld_base_ft_agl <= 3000:
-                            flightcategory = "MVFR"
-                            break
-                        if cld_base_ft_agl > 3000:
-                            flightcategory = "VFR"
-                            break
-
-                    # visibilty can also set flight category. If the clouds haven't set the fltcat to LIFR. See if visibility will
-                    # if it's LIFR due to cloud layer, no reason to check any other things that can set flight category.
-                    if flightcategory != "LIFR":
-                        # check XML if visibility value exists
-                        if forecast.find("visibility_statute_mi") is not None:
-                            visibility_statute_mi = forecast.find(
-                                "visibility_statute_mi"
-                            ).text  # get visibility number
-                            try:
-                                next_val = float(visibility_statute_mi)
-                            except (TypeError, ValueError):
-                                next_val_float = False
-                            else:
-                                next_val_float = True
-                            if next_val_float:
-                                visibility_statute_mi = next_val
-                            else:
-                                # FIXME: Hack for METAR parsing of complex valus
-                                if visibility_statute_mi == "6+":
-                                    visibility_statute_mi = 6
-                                else:
-                                    debugging.info(
-                                        f"GRR: visibility_statute_ml parse mismatch - setting to ten (10) actual:{visibility_statute_mi}"
-                                    )
-                                    visibility_statute_mi = 10
-                            debugging.debug(visibility_statute_mi)
-
-                            if visibility_statute_mi < 1.0:
-                                flightcategory = "LIFR"
-                            elif 1.0 <= visibility_statute_mi < 3.0:
-                                flightcategory = "IFR"
-                            # if Flight Category was already set to IFR $
-                            elif (
-                                3.0 <= visibility_statute_mi <= 5.0
-                                and flightcategory != "IFR"
-                            ):
-                                flightcategory = "MVFR"
-
-                    debugging.debug("Airport - " + station_id)
-                    debugging.debug("Flight Category - " + flightcategory)
-                    if "wind_speed_kt" in fcast:
-                        debugging.debug("Wind Speed - " + fcast["wind_speed_kt"])
-                    if "wx_string" in fcast:
-                        debugging.debug("WX String - " + fcast["wx_string"])
-                    if "change_indicator" in fcast:
-                        debugging.debug(
-                            "Change Indicator - " + fcast["change_indicator"]
+                # Flight category is set by the lowest OVC, BKN or OVX layer, and by visibility.
+                # A forecast without visibility is categorized on the ceiling alone.
+                if "visibility_statute_mi" in fcast:
+                    visibility_statute_mi = utils_wx.visibility_value(
+                        fcast["visibility_statute_mi"]
+                    )
+                    if math.isnan(visibility_statute_mi):
+                        debugging.info(
+                            "GRR: visibility_statute_ml parse mismatch - setting to ten (10) actual:%s",
+                            fcast["visibility_statute_mi"],
                         )
-                    if "wind_dir_degrees" in fcast:
-                        debugging.debug(
-                            "Wind Director Degrees - " + fcast["wind_dir_degrees"]
-                        )
-                    if "wind_gust_kt" in fcast:
-                        debugging.debug("Wind Gust - " + fcast["wind_gust_kt"])
+                        visibility_statute_mi = 10
+                else:
+                    visibility_statute_mi = math.inf
 
-                fcast["flightcategory"] = flightcategory
+                forecast_list.append(fcast)
+                forecast_ceiling.append(utils_wx.sky_ceiling(forecast))
+                forecast_visibility.append(visibility_statute_mi)
                 taf_forecast.append(fcast)
                 fcast_index = fcast_index + 1
 
             taf_data["forecast"] = taf_forecast
             taf_dict[station_id] = taf_data
 
-            debugging.debug(f"TAF: {station_id} - {issue_time} - {fcast_index - 1}")
+            debugging.debug("TAF: %s - %s - %s", station_id, issue_time, fcast_index - 1)
+
+        category_codes = utils_wx.classify_flight_categories(
+            forecast_ceiling, forecast_visibility
+        )
+        for fcast, category_code in zip(forecast_list, category_codes):
+            fcast["flightcategory"] = utils_wx.FLIGHT_CATEGORIES[category_code]
 
         self.taf_xml_dict = taf_dict
+        metrics.set_gauge("stations_parsed", len(taf_dict), dataset="taf")
         self.taf_update_time = datetime.now(pytz.utc)
+        self.publish_snapshot()
         debugging.debug("Updating Airport TAF from XML")
         return True
 
@@ -528,7 +977,7 @@ class AirportDB:
         airport_id = airport_id.upper()
         for runway_info in self.runway_data:
             if runway_info["airport_ident"] == airport_id:
-                debugging.debug(f"Airport Runway Data Found: {runway_info}")
+                debugging.debug("Airport Runway Data Found: %s", runway_info)
                 runway_set.append(runway_info)
         return runway_set
 
@@ -536,14 +985,14 @@ class AirportDB:
         """Load CSV Runways file."""
         runways_master_data = self.__conf.get_string("filenames", "runways_master_data")
         if not utils.file_exists(runways_master_data):
-            debugging.debug(f"Runways file does not exist: {runways_master_data}")
+            debugging.debug("Runways file does not exist: %s", runways_master_data)
             return False
         runway_data = None
         index_counter = 0
         with open(runways_master_data, "r", encoding="utf-8") as rway_file:
             runway_data = list(csv.DictReader(rway_file))
             index_counter += 1
-        debugging.debug(f"CSV Load found {index_counter} rows")
+        debugging.debug("CSV Load found %s rows", index_counter)
         self.runway_data = runway_data
         return True
 
@@ -553,7 +1002,9 @@ class AirportDB:
             "filenames", "airports_master_data"
         )
         if not utils.file_exists(airport_master_metadata_set):
-            debugging.debug(f"Airport dataset does not exist: {airport_master_metadata_set}")
+            debugging.debug(
+                "Airport dataset does not exist: %s", airport_master_metadata_set
+            )
             return False
 
         airport_data = None
@@ -561,23 +1012,40 @@ class AirportDB:
         with open(airport_master_metadata_set, "r", encoding="utf-8") as aprt_file:
             airport_data = list(csv.DictReader(aprt_file))
             index_counter += 1
-        debugging.debug(f"CSV Load found {index_counter} rows")
+        debugging.debug("CSV Load found %s rows", index_counter)
         self.airport_data = airport_data
+        airport_positions = {}
+        for airport_row in airport_data:
+            position = utils_geo.coordinates(
+                airport_row.get("latitude_deg"), airport_row.get("longitude_deg")
+            )
+            if position is not None and airport_row.get("ident"):
+                airport_positions[airport_row["ident"].lower()] = position
+        self._airport_positions = airport_positions
         return True
 
     def update_airport_runways(self):
         """Update airport RUNWAY data for each known Airport."""
-        for icao, airport_obj in self.airport_master_dict.items():
-            debugging.debug(f"Updating Runway for {airport_obj.icaocode()}")
+        airport_master_dict = dict(self.airport_master_dict)
+        changed_icaos = set()
+        for icao, airport_obj in airport_master_dict.items():
+            debugging.debug("Updating Runway for %s", icao)
             if not airport_obj.active():
                 continue
             try:
                 runway_dataset = self.airport_runway_data(icao)
+                # Copy on write ; readers may be using the published object
+                airport_obj = copy.copy(airport_obj)
                 airport_obj.set_runway_data(runway_dataset)
+                airport_master_dict[icao] = airport_obj
+                changed_icaos.add(icao)
             except Exception as err:
                 debug_string = f"Error: update_airport_runways Exception handling for {airport_obj.icaocode()}"
                 debugging.error(debug_string)
                 debugging.crash(err)
+        self.airport_master_dict = airport_master_dict
+        self.airport_dicts_refresh()
+        self.publish_snapshot(changed_icaos)
 
     def update_loop(self, conf):
         """Master loop for keeping the airport data set current.
@@ -599,25 +1067,31 @@ class AirportDB:
 
         while True:
             debugging.debug(
-                f"Updating Airport Data .. every aviation_weather_adds_timer ({aviation_weather_adds_timer})m)"
+                "Updating Airport Data .. every aviation_weather_adds_timer (%s)m)",
+                aviation_weather_adds_timer,
             )
+            cycle_start = time.perf_counter()
 
             if self._metar_serial < self.__dataset.metar_serial():
                 debugging.debug("Processing updated METAR data")
                 self._metar_serial = self.__dataset.metar_serial()
-                self.update_airportdb_metar_xml()
+                with self._write_lock, metrics.timer("metar_parse_seconds"):
+                    self.update_airportdb_metar_xml()
+                self.save_state()
 
             if self._taf_serial < self.__dataset.taf_serial():
                 debugging.debug("Processing updated TAF data")
                 self._taf_serial = self.__dataset.taf_serial()
-                self.update_airport_taf_xml()
+                with self._write_lock, metrics.timer("taf_parse_seconds"):
+                    self.update_airport_taf_xml()
 
             if self._runway_serial < self.__dataset.runway_serial():
                 debugging.debug("Processing updated Runway data")
                 self._runway_serial = self.__dataset.runway_serial()
                 self.import_runways()
                 # TODO: Figure out when this should be run - if not every time
-                self.update_airport_runways()
+                with self._write_lock:
+                    self.update_airport_runways()
 
             if self._airport_serial < self.__dataset.airport_serial():
                 debugging.debug("Processing updated Airport data")
@@ -628,12 +1102,16 @@ class AirportDB:
 
             # TODO: Add back in MOS processing in whatever new form it takes
 
+            with self._write_lock:
+                self.refresh_age_buckets()
+
             # FIXME: Key airport data - useful for debugging / health updates
             # Remove eventually
             kbfi_taf = self.__get_airport_taf("kbfi")
-            debugging.debug(f"TAF Lookup: kbfi {kbfi_taf}")
+            debugging.debug("TAF Lookup: kbfi %s", kbfi_taf)
             kbfi_runway = self.airport_runway_data("kbfi")
-            debugging.debug(f"Runway data - kbfi :{kbfi_runway}:")
+            debugging.debug("Runway data - kbfi :%s:", kbfi_runway)
+            metrics.observe("airportdb_cycle_seconds", time.perf_counter() - cycle_start)
             time.sleep(aviation_weather_adds_timer * 60)
 
         debugging.error("Hit the exit of the airport update loop")
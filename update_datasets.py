@@ -14,17 +14,83 @@ Created on Sat Jun 15 08:01:44 2019.
 # TODO: Get any/all the error handling for connectivity issues moved here
 
 
-# import os
+import json
+import os
+import random
 import time
+from datetime import datetime, timedelta, timezone
+
 import requests
+from requests.adapters import HTTPAdapter
 
 import debugging
+import metrics
 import utils
 
 
+class DataSource:
+    """One remote dataset and its refresh schedule."""
+
+    def __init__(
+        self,
+        name,
+        url,
+        filename,
+        dataset,
+        interval=None,
+        issue_hour=None,
+        decompress=False,
+    ):
+        """Refresh every interval seconds, or daily after issue_hour (UTC) bulletins."""
+        self.name = name
+        self.url = url
+        self.filename = filename
+        # DataSets serial / update time to bump on a new download
+        self.dataset = dataset
+        self.interval = interval
+        self.issue_hour = issue_hour
+        self.decompress = decompress
+        # ETag / Last-Modified / size / sha256 of the local copy
+        self.validator = None
+        # Set once the local copy has been handed to clients in this run
+        self.loaded = False
+        self.failures = 0
+        # Epoch seconds ; everything is due at startup
+        self.next_due = 0
+
+    def next_refresh(self, now):
+        """Return the epoch time of the next scheduled refresh after now."""
+        if self.issue_hour is None:
+            return now + self.interval
+        # Bulletins show up a few hours after the model run ; check once a day
+        now_utc = datetime.fromtimestamp(now, timezone.utc)
+        due = now_utc.replace(
+            hour=self.issue_hour, minute=0, second=0, microsecond=0
+        ) + timedelta(hours=DataSets.MOS_PUBLISH_DELAY_HOURS)
+        while due <= now_utc:
+            due += timedelta(days=1)
+        return due.timestamp()
+
+    def retry_delay(self):
+        """Return the jittered exponential backoff delay after a failure."""
+        ceiling = DataSets.BACKOFF_MAX
+        if self.interval is not None:
+            # No point backing off past the normal refresh cadence
+            ceiling = min(ceiling, self.interval)
+        delay = min(ceiling, DataSets.BACKOFF_BASE * 2 ** (self.failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+
 class DataSets:
     """Dataset Sync - Keeping track of datasets."""
 
+    # Retry a failed download after BACKOFF_BASE seconds, doubling up to BACKOFF_MAX
+    BACKOFF_BASE = 15
+    BACKOFF_MAX = 30 * 60
+
+    # GFS MOS bulletins are posted some hours after the 00/06/12/18z model runs
+    MOS_PUBLISH_DELAY_HOURS = 5
+
     def __init__(self, conf):
         """Tracking freshness of data sets ; internally using the time stamp of when the updated was pulled
         Clients of this class use a serial number - so that the ability to determine if something was updated is straightforward.
@@ -41,6 +107,7 @@ class DataSets:
         self._runway_serial_num = 0
         self._airport_update_time = None
         self._airport_serial_num = 0
+        self._validators_file = conf.get_string("filenames", "download_validators")
 
     def metar_update_time(self):
         """Get last time metar data was updated."""
@@ -86,141 +153,192 @@ class DataSets:
         """Return string containing pertinant stats."""
         return f"Statistics:\n\tMetar Refresh {self.metar_serial()}/{self._metar_update_time}\n\tMOS refresh: {self.mos_serial()}/{self._mos_update_time}\n\tTAF Refresh: {self.taf_serial()}/{self._taf_update_time}"
 
-    def mos_refresh(self, https_session, etag_mos, mos_file, mos_xml_url):
-        """Refresh MOS Data."""
-        ret, new_etag_mos = utils.download_newer_file(
-            https_session, mos_xml_url, mos_file, etag=etag_mos
-        )
+    def download(
+        self, https_session, source, url, filename, decompress=False, validator=None
+    ):
+        """Call utils.download_if_changed ; recording time and bytes to metrics."""
+        with metrics.timer("download_seconds", source=source):
+            ret, new_validator = utils.download_if_changed(
+                https_session, url, filename, decompress=decompress, validator=validator
+            )
         if ret is True:
-            debugging.debug(f"Downloaded :{mos_file}: file")
+            metrics.inc("download_total", source=source, result="downloaded")
+            if os.path.isfile(filename):
+                metrics.inc(
+                    "download_bytes_total", os.path.getsize(filename), source=source
+                )
         elif ret is False:
-            debugging.debug(f"Server side :{mos_file}: older")
+            metrics.inc("download_total", source=source, result="unchanged")
+        else:
+            metrics.inc("download_total", source=source, result="error")
+        return ret, new_validator
+
+    def load_validators(self, sources):
+        """Seed each source's validator from the cache saved by a previous run.
 
+        A cached validator is only used if the local file still matches its
+        size and hash ; otherwise the dataset is fetched unconditionally.
+        """
         try:
-            debugging.info("Do MOS refresh stuff... ")
-            # TODO: do stuff here
-        except Exception as err:
-            debugging.error("MOS Refresh: self. figure something out () exception")
-            debugging.error(err)
+            with open(self._validators_file, encoding="utf8") as validators_file:
+                validators = json.load(validators_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            debugging.info("Ignoring download validator cache : %s", err)
+            return
+        for source in sources:
+            validator = validators.get(source.url)
+            if utils.validator_matches_file(source.filename, validator):
+                source.validator = validator
+            elif validator is not None:
+                debugging.info(
+                    "%s changed since last run ; refetching", source.filename
+                )
+        cached = sum(1 for source in sources if source.validator is not None)
+        debugging.info(
+            "Download validators cached for %s/%s files", cached, len(sources)
+        )
 
-        return new_etag_mos
+    def save_validators(self, sources):
+        """Persist the current validators ; keyed by url."""
+        validators = {
+            source.url: source.validator for source in sources if source.validator
+        }
+        utils.atomic_write_json(self._validators_file, validators)
+
+    def data_sources(self, conf):
+        """Return the list of DataSource to keep current."""
+        minutes = 60
+        sources = [
+            DataSource(
+                "metar",
+                conf.get_string("urls", "metar_xml_gz"),
+                conf.get_string("filenames", "metar_xml_data"),
+                "metar",
+                interval=conf.get_int("metar", "wx_update_interval") * minutes,
+                decompress=True,
+            ),
+            DataSource(
+                "taf",
+                conf.get_string("urls", "tafs_xml_gz"),
+                conf.get_string("filenames", "tafs_xml_data"),
+                "taf",
+                interval=conf.get_int("metar", "taf_update_interval") * minutes,
+                decompress=True,
+            ),
+            DataSource(
+                "runways",
+                conf.get_string("urls", "runways_csv_url"),
+                conf.get_string("filenames", "runways_master_data"),
+                "runway",
+                interval=conf.get_int("metar", "airports_update_interval") * minutes,
+            ),
+            DataSource(
+                "airports",
+                conf.get_string("urls", "airports_csv_url"),
+                conf.get_string("filenames", "airports_master_data"),
+                "airport",
+                interval=conf.get_int("metar", "airports_update_interval") * minutes,
+            ),
+        ]
+        if conf.get_bool("modules", "use_mos"):
+            for issue_hour in (0, 6, 12, 18):
+                sources.append(
+                    DataSource(
+                        f"mos{issue_hour:02}",
+                        conf.get_string("urls", f"mos{issue_hour:02}_data_gz"),
+                        conf.get_string("filenames", f"mos{issue_hour:02}_xml_data"),
+                        "mos",
+                        issue_hour=issue_hour,
+                    )
+                )
+        return sources
+
+    def mark_updated(self, conf, dataset):
+        """Record a new download of dataset ; bumps its serial number for clients."""
+        setattr(self, f"_{dataset}_update_time", utils.current_time_utc(conf))
+        serial_attr = f"_{dataset}_serial_num"
+        setattr(self, serial_attr, getattr(self, serial_attr) + 1)
+
+    def refresh_source(self, conf, https_session, source):
+        """Download source if it changed ; schedule its next refresh or retry."""
+        ret, source.validator = self.download(
+            https_session,
+            source.name,
+            source.url,
+            source.filename,
+            decompress=source.decompress,
+            validator=source.validator,
+        )
+        now = time.time()
+        if ret is None:
+            source.failures += 1
+            delay = source.retry_delay()
+            source.next_due = now + delay
+            debugging.info(
+                "Download %s failed (%s) - retry in %.0fs",
+                source.name,
+                source.failures,
+                delay,
+            )
+            metrics.set_gauge("download_failures", source.failures, source=source.name)
+            return ret
+        source.failures = 0
+        source.next_due = source.next_refresh(now)
+        metrics.set_gauge("download_failures", 0, source=source.name)
+        if ret is True:
+            debugging.debug("Downloaded %s :%s:", source.name, source.filename)
+            self.mark_updated(conf, source.dataset)
+        else:
+            debugging.debug("Server side %s not newer", source.name)
+            if not source.loaded:
+                # Current copy from a previous run ; clients still need to parse it
+                self.mark_updated(conf, source.dataset)
+        source.loaded = True
+        return ret
 
     def update_loop(self, conf):
         """Master loop for keeping the data set current.
 
-        Infinite Loop
-         1/ Update METAR data sets
-         2/ Update TAF data sets
-         3/ Update MOS data sets
-         4/ Update Airport Runway DB
-         ...
-         9/ Wait for update interval timer to expire
-
-        Triggered Update
+        Each DataSource has its own cadence ; METAR every wx_update_interval,
+        TAF every taf_update_interval, runways / airports every
+        airports_update_interval and MOS once after each bulletin is issued.
+        Failed downloads back off exponentially (with jitter) then retry.
         """
-        aviation_weather_adds_timer = conf.get_int("metar", "wx_update_interval")
-
-        # TODO: Do we really need these, or can we just do the conf lookup when needed
-        # Might be better to pull them from the conf file on demand,
-        # to allow the config to be dynamically updated without needing a restart
-        metar_xml_url = conf.get_string("urls", "metar_xml_gz")
-        metar_file = conf.get_string("filenames", "metar_xml_data")
-        runways_csv_url = conf.get_string("urls", "runways_csv_url")
-        airports_csv_url = conf.get_string("urls", "airports_csv_url")
-        runways_master_data = conf.get_string("filenames", "runways_master_data")
-        airport_master_metadata_set = conf.get_string(
-            "filenames", "airports_master_data"
-        )
-        tafs_xml_url = conf.get_string("urls", "tafs_xml_gz")
-        tafs_file = conf.get_string("filenames", "tafs_xml_data")
-        mos00_xml_url = conf.get_string("urls", "mos00_data_gz")
-        mos00_file = conf.get_string("filenames", "mos00_xml_data")
-        mos06_xml_url = conf.get_string("urls", "mos06_data_gz")
-        mos06_file = conf.get_string("filenames", "mos06_xml_data")
-        mos12_xml_url = conf.get_string("urls", "mos12_data_gz")
-        mos12_file = conf.get_string("filenames", "mos12_xml_data")
-        mos18_xml_url = conf.get_string("urls", "mos18_data_gz")
-        mos18_file = conf.get_string("filenames", "mos18_xml_data")
-
-        etag_metar = None
-        etag_tafs = None
-        etag_mos00 = None
-        etag_mos06 = None
-        etag_mos12 = None
-        etag_mos18 = None
-        etag_runways = None
-        etag_airports = None
+        sources = self.data_sources(conf)
+        self.load_validators(sources)
+
+        # Waiting here rather than in livemap.py ; the rest of the app starts
+        # from the warm start state while the network comes up
+        if utils.wait_for_internet():
+            debugging.info("Internet Available")
+        else:
+            debugging.warn("Internet NOT Available")
+
+        # One session for the life of the thread ; keeps connections to each host alive
+        https_session = requests.Session()
+        https_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+        https_session.mount("https://", https_adapter)
+        https_session.mount("http://", https_adapter)
 
         while True:
+            cycle_start = time.perf_counter()
+            validators_changed = False
+            for source in sources:
+                if source.next_due <= time.time():
+                    validator = source.validator
+                    self.refresh_source(conf, https_session, source)
+                    validators_changed |= source.validator != validator
+            if validators_changed:
+                self.save_validators(sources)
+            metrics.observe("datasets_cycle_seconds", time.perf_counter() - cycle_start)
+
+            next_source = min(sources, key=lambda source: source.next_due)
+            sleep_time = max(1.0, next_source.next_due - time.time())
             debugging.debug(
-                f"Updating Airport Data .. every aviation_weather_adds_timer ({aviation_weather_adds_timer})m)"
-            )
-
-            https_session = requests.Session()
-
-            ret, etag_metar = utils.download_newer_file(
-                https_session,
-                metar_xml_url,
-                metar_file,
-                decompress=True,
-                etag=etag_metar,
-            )
-            if ret is True:
-                debugging.debug("Downloaded METAR file")
-                self._metar_update_time = utils.current_time_utc(conf)
-                self._metar_serial_num += 1
-            elif ret is False:
-                debugging.debug("Server side METAR older")
-
-            ret, etag_tafs = utils.download_newer_file(
-                https_session, tafs_xml_url, tafs_file, decompress=True, etag=etag_tafs
-            )
-            if ret is True:
-                debugging.debug("Downloaded TAFS file")
-                self._taf_update_time = utils.current_time_utc(conf)
-                self._taf_serial_num += 1
-            elif ret is False:
-                debugging.debug("Server side TAFS older")
-
-            ret, etag_runways = utils.download_newer_file(
-                https_session, runways_csv_url, runways_master_data, etag=etag_runways
+                "Datasets: next refresh %s in %.0fs", next_source.name, sleep_time
             )
-            if ret is True:
-                debugging.debug("Downloaded runways.csv")
-                self._runway_update_time = utils.current_time_utc(conf)
-                self._runway_serial_num += 1
-            elif ret is False:
-                debugging.debug("Server side runways.csv older")
-
-            ret, etag_airports = utils.download_newer_file(
-                https_session,
-                airports_csv_url,
-                airport_master_metadata_set,
-                etag=etag_airports,
-            )
-            if ret is True:
-                debugging.debug("Downloaded airports.csv")
-                self._airport_update_time = utils.current_time_utc(conf)
-                self._airport_serial_num += 1
-            elif ret is False:
-                debugging.debug("Server side airports.csv older")
-
-            etag_mos00 = self.mos_refresh(
-                https_session, etag_mos00, mos00_file, mos00_xml_url
-            )
-            etag_mos06 = self.mos_refresh(
-                https_session, etag_mos06, mos06_file, mos06_xml_url
-            )
-            etag_mos12 = self.mos_refresh(
-                https_session, etag_mos12, mos12_file, mos12_xml_url
-            )
-            etag_mos18 = self.mos_refresh(
-                https_session, etag_mos18, mos18_file, mos18_xml_url
-            )
-
-            # Clean UP HTTPS_Session
-            https_session.close()
-
-            time.sleep(aviation_weather_adds_timer * 60)
+            time.sleep(sleep_time)
 
         debugging.error("Hit the exit of the dataset update loop")
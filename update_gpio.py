@@ -31,45 +31,39 @@
 ###########################
 
 # Import needed libraries
-import time
-from datetime import datetime
-from datetime import timedelta
-from datetime import time as time_
-
 try:
     import RPi.GPIO as GPIO
 except ImportError:
     import fakeRPI.GPIO as GPIO
 
 import debugging
+from update_leds import LedMode
 
 
 class UpdateGPIO:
     """Class to manage GPIO pins"""
 
-    def __init__(self, conf, airport_database):
+    # Rotary switch ; grounding ROTARY_SWITCH_PINS[n] selects switch position n
+    ROTARY_SWITCH_PINS = (0, 5, 6, 13, 19, 26, 21, 20, 16, 12, 1, 7)
+    REFRESH_BUTTON_PIN = 22
+
+    # Ignore further edges on a pin for this long after a transition (ms)
+    DEBOUNCE_MS = 50
+
+    # data_swN -> LED mode ; 0 = TAF and 2 = MOS have no LED display, so show METAR
+    DATA_SW_MODES = {1: LedMode.METAR, 3: LedMode.HEATMAP}
+
+    def __init__(self, conf, airport_database, led_mgmt=None):
         # ****************************************************************************
         # * User defined items to be set below - Make changes to config.py, not here *
         # ****************************************************************************
 
         self.conf = conf
         self.airport_database = airport_database
+        self.led_mgmt = led_mgmt
 
-        # Specific Variables to default data to display if Rotary Switch is not installed.
-        # hour_to_display # Offset in HOURS to choose which TAF/MOS to display
-        self.hour_to_display = self.conf.get_int("rotaryswitch", "time_sw0")
-        # metar_taf_mos
-        # 0 = Display TAF,
-        # 1 = Display METAR,
-        # 2 = Display MOS,
-        # 3 = Heat Map (Heat map not controlled by rotary switch)
-        self.metar_taf_mos = self.conf.get_int("rotaryswitch", "data_sw0")
         # Set toggle_sw to an initial value that forces rotary switch to dictate data displayed
         self.toggle_sw = -1
-        self.onhour = self.conf.get_int("schedule", "onhour")
-        self.offhour = self.conf.get_int("schedule", "offhour")
-        self.onminutes = self.conf.get_int("schedule", "onminutes")
-        self.offminutes = self.conf.get_int("schedule", "offminutes")
 
         # delay in fading the home airport if used
         self.fade_delay = conf.get_float("rotaryswitch", "fade_delay")
@@ -84,192 +78,116 @@ class UpdateGPIO:
         GPIO.setmode(GPIO.BCM)
         # set pin 4 as input for light sensor, if one is used. If no sensor used board remains at high brightness always.
         GPIO.setup(4, GPIO.IN)
+
+        # A pin driving an LED strip can't also be a switch input ; leave it to the LEDs
+        led_pins = frozenset()
+        if self.led_mgmt is not None:
+            led_pins = self.led_mgmt.gpio_pins()
+        self.switch_pins = tuple(
+            pin for pin in self.ROTARY_SWITCH_PINS if pin not in led_pins
+        )
+        for pin in led_pins.intersection(self.ROTARY_SWITCH_PINS):
+            debugging.error(
+                "GPIO: pin %s drives an LED strip ; rotary switch position %s disabled",
+                pin,
+                self.ROTARY_SWITCH_PINS.index(pin),
+            )
+        self.use_refresh_button = self.REFRESH_BUTTON_PIN not in led_pins
+        if not self.use_refresh_button:
+            debugging.error(
+                "GPIO: pin %s drives an LED strip ; refresh button disabled",
+                self.REFRESH_BUTTON_PIN,
+            )
+
         # set pin 22 to momentary push button to force FAA Weather Data update if button is used.
-        GPIO.setup(22, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        if self.use_refresh_button:
+            GPIO.setup(self.REFRESH_BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
 
         # Setup GPIO pins for rotary switch to choose between Metars, or Tafs and which hour of TAF
         # Not all the pins are required to be used. If only METARS are desired, then no Rotary Switch is needed.
-        # set pin 0 to ground for METARS
-        GPIO.setup(0, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 5 to ground for TAF + 1 hour
-        GPIO.setup(5, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 6 to ground for TAF + 2 hours
-        GPIO.setup(6, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 13 to ground for TAF + 3 hours
-        GPIO.setup(13, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 19 to ground for TAF + 4 hours
-        GPIO.setup(19, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 26 to ground for TAF + 5 hours
-        GPIO.setup(26, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 21 to ground for TAF + 6 hours
-        GPIO.setup(21, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 20 to ground for TAF + 7 hours
-        GPIO.setup(20, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 16 to ground for TAF + 8 hours
-        GPIO.setup(16, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 12 to ground for TAF + 9 hours
-        GPIO.setup(12, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 1 to ground for TAF + 10 hours
-        GPIO.setup(1, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        # set pin 7 to ground for TAF + 11 hours
-        GPIO.setup(7, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        # Grounding ROTARY_SWITCH_PINS[n] selects switch position n ; data_swN
+        # pin -> (position, LED mode) ; looked up once here rather than on every transition
+        self.switch_positions = {}
+        for position, pin in enumerate(self.ROTARY_SWITCH_PINS):
+            if pin not in self.switch_pins:
+                continue
+            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            self.switch_positions[pin] = (position, self.switch_mode(position))
+
+        # Edge triggered callbacks run on the RPi.GPIO event thread ; no polling
+        try:
+            for pin in self.switch_pins:
+                GPIO.add_event_detect(
+                    pin,
+                    GPIO.FALLING,
+                    callback=self.rotary_switch_callback,
+                    bouncetime=self.DEBOUNCE_MS,
+                )
+            if self.use_refresh_button:
+                GPIO.add_event_detect(
+                    self.REFRESH_BUTTON_PIN,
+                    GPIO.FALLING,
+                    callback=self.refresh_button_callback,
+                    bouncetime=self.DEBOUNCE_MS,
+                )
+        except RuntimeError as err:
+            debugging.error("GPIO: unable to add edge detection: %s", err)
 
         # True to invert the signal (when using NPN transistor level shift)
         self.LED_BRIGHTNESS = self.conf.get_int("lights", "bright_value")
-        # Timer calculations
-        self.lights_out = time_(
-            self.conf.get_int("schedule", "offhour"),
-            self.conf.get_int("schedule", "offminutes"),
-            0,
-        )
-        self.timeoff = self.lights_out
-        self.lights_on = time_(self.onhour, self.onminutes, 0)
-        self.end_time = self.lights_on
-        # Set flag for next round if sleep timer is interrupted by button push.
-        self.temp_lights_on = 0
-
         # Misc Settings
         # Toggle used for logging when ambient sensor changes from bright to dim.
         self.ambient_toggle = 0
 
-    def update_gpio_flags(self, toggle_value, time_sw, data_sw):
+    def switch_mode(self, position):
+        """Return the LED mode for rotary switch position ; from data_swN."""
+        data_sw = self.conf.get_int("rotaryswitch", f"data_sw{position}")
+        mode = self.DATA_SW_MODES.get(data_sw)
+        if mode is None:
+            debugging.warn(
+                "Rotary switch position %s : data_sw%s = %s (TAF / MOS) has no LED"
+                " display ; showing METAR",
+                position,
+                position,
+                data_sw,
+            )
+            mode = LedMode.METAR
+        return mode
+
+    def update_gpio_flags(self, toggle_value, led_mode):
         self.toggle_sw = toggle_value
-        # Offset in HOURS to choose which TAF to display
-        self.hour_to_display = time_sw
-        self.metar_taf_mos = data_sw  # 0 = Display TAF.
-        # debugging.info( 'Switch in position ' )
+        if self.led_mgmt is not None:
+            # Picked up by the LED thread on its next frame
+            self.led_mgmt.set_rotary_switch(led_mode)
+
+    def rotary_switch_callback(self, channel):
+        """Rotary switch edge ; apply the new switch position."""
+        if GPIO.input(channel) != GPIO.LOW:
+            # Bounce on the way out of the previous position
+            return
+        position, led_mode = self.switch_positions[channel]
+        if position != self.toggle_sw:
+            debugging.info("Rotary switch in position %s", position)
+            self.update_gpio_flags(position, led_mode)
+
+    def refresh_button_callback(self, channel):
+        """Refresh pushbutton ; turn the lights on temporarily during sleep mode."""
+        if GPIO.input(channel) != GPIO.LOW:
+            return
+        debugging.info("Refresh Pushbutton Pressed")
+        if self.led_mgmt is not None:
+            self.led_mgmt.temp_wake(self.conf.get_int("schedule", "tempsleepon"))
+
+    def read_rotary_switch(self):
+        """Apply the current rotary switch position ; edges only report changes."""
+        for pin in self.switch_pins:
+            if GPIO.input(pin) == GPIO.LOW:
+                self.update_gpio_flags(*self.switch_positions[pin])
+                return
+        # If there is no rotary switch installed, then display the defaulted data from switch position 0
+        self.update_gpio_flags(12, self.switch_mode(0))
 
     def update_loop(self):
-        # #########################
-        # Start of executed code  #
-        # #########################
-        outerloop = True  # Set to TRUE for infinite outerloop
-        tempsleepon = self.conf.get_int("schedule", "tempsleepon")
-
-        while outerloop:
-            # Pushbutton for Refresh. check to see if we should turn on temporarily during sleep mode
-            if GPIO.input(22) is False:
-                # Set to turn lights on two seconds ago to make sure we hit the loop next time through
-                self.end_time = (datetime.now() - timedelta(seconds=2)).time()
-                self.timeoff = (datetime.now() + timedelta(minutes=tempsleepon)).time()
-                self.temp_lights_on = 1  # Set this to 1 if button is pressed
-
-            # Check if rotary switch is used, and what position it is in. This will determine what to display, METAR, TAF and MOS data.
-            # If TAF or MOS data, what time offset should be displayed, i.e. 0 hour, 1 hour, 2 hour etc.
-            # If there is no rotary switch installed, then all these tests will fail and will display the defaulted data from switch position 0
-            if GPIO.input(0) is False and self.toggle_sw != 0:
-                self.update_gpio_flags(
-                    0,
-                    self.conf.get_int("rotaryswitch", "time_sw0"),
-                    self.conf.get_int("rotaryswitch", "data_sw0"),
-                )
-
-            elif GPIO.input(5) is False and self.toggle_sw != 1:
-                self.update_gpio_flags(
-                    1,
-                    self.conf.get_int("rotaryswitch", "time_sw1"),
-                    self.conf.get_int("rotaryswitch", "data_sw1"),
-                )
-
-            elif GPIO.input(6) is False and self.toggle_sw != 2:
-                self.update_gpio_flags(
-                    2,
-                    self.conf.get_int("rotaryswitch", "time_sw2"),
-                    self.conf.get_int("rotaryswitch", "data_sw2"),
-                )
-
-            elif GPIO.input(13) is False and self.toggle_sw != 3:
-                self.update_gpio_flags(
-                    3,
-                    self.conf.get_int("rotaryswitch", "time_sw3"),
-                    self.conf.get_int("rotaryswitch", "data_sw3"),
-                )
-
-            elif GPIO.input(19) is False and self.toggle_sw != 4:
-                self.update_gpio_flags(
-                    4,
-                    self.conf.get_int("rotaryswitch", "time_sw4"),
-                    self.conf.get_int("rotaryswitch", "data_sw4"),
-                )
-
-            elif GPIO.input(26) is False and self.toggle_sw != 5:
-                self.update_gpio_flags(
-                    5,
-                    self.conf.get_int("rotaryswitch", "time_sw5"),
-                    self.conf.get_int("rotaryswitch", "data_sw5"),
-                )
-
-            elif GPIO.input(21) is False and self.toggle_sw != 6:
-                self.update_gpio_flags(
-                    6,
-                    self.conf.get_int("rotaryswitch", "time_sw6"),
-                    self.conf.get_int("rotaryswitch", "data_sw6"),
-                )
-
-            elif GPIO.input(20) is False and self.toggle_sw != 7:
-                self.update_gpio_flags(
-                    7,
-                    self.conf.get_int("rotaryswitch", "time_sw7"),
-                    self.conf.get_int("rotaryswitch", "data_sw7"),
-                )
-
-            elif GPIO.input(16) is False and self.toggle_sw != 8:
-                self.update_gpio_flags(
-                    8,
-                    self.conf.get_int("rotaryswitch", "time_sw8"),
-                    self.conf.get_int("rotaryswitch", "data_sw8"),
-                )
-
-            elif GPIO.input(12) is False and self.toggle_sw != 9:
-                self.update_gpio_flags(
-                    9,
-                    self.conf.get_int("rotaryswitch", "time_sw9"),
-                    self.conf.get_int("rotaryswitch", "data_sw9"),
-                )
-
-            elif GPIO.input(1) is False and self.toggle_sw != 10:
-                self.update_gpio_flags(
-                    10,
-                    self.conf.get_int("rotaryswitch", "time_sw10"),
-                    self.conf.get_int("rotaryswitch", "data_sw10"),
-                )
-
-            elif GPIO.input(7) is False and self.toggle_sw != 11:
-                self.update_gpio_flags(
-                    11,
-                    self.conf.get_int("rotaryswitch", "time_sw11"),
-                    self.conf.get_int("rotaryswitch", "data_sw11"),
-                )
-
-            elif self.toggle_sw == -1:  # used if no Rotary Switch is installed
-                self.update_gpio_flags(
-                    12,
-                    self.conf.get_int("rotaryswitch", "time_sw0"),
-                    self.conf.get_int("rotaryswitch", "data_sw0"),
-                )
-
-                # Check to see if pushbutton is pressed to force an update of FAA Weather
-                # If no button is connected, then this is bypassed and will only update when 'update_interval' is met
-            if GPIO.input(22) is False:
-                debugging.info(
-                    "Refresh Pushbutton Pressed. Breaking out of loop to refresh FAA Data"
-                )
-
-            # Light sensor has ability to send interrupts..
-            # TODO: Come back to here and figure out if we're handling that code here
-            # or if we should handle it elsewhere
-            #
-            # Bright light will provide a low state (0) on GPIO. Dark light will provide a high state (1).
-            # Full brightness will be used if no light sensor is installed.
-            #
-            # if GPIO.input(4) == 1:
-            #     self.LED_BRIGHTNESS = self.conf.get_int("lights", "dimmed_value")
-            #    if self.ambient_toggle == 1:
-            #        debugging.info("Ambient Sensor set brightness to dimmed_value")
-            #        self.ambient_toggle = 0
-            # else:
-            #    self.LED_BRIGHTNESS = self.conf.get_int("lights", "bright_value")
-            #    if self.ambient_toggle == 0:
-            #        debugging.info("Ambient Sensor set brightness to bright_value")
-            #        self.ambient_toggle = 1
-            time.sleep(5)
+        """Pick up the starting switch position ; edge callbacks handle the rest."""
+        # Edge callbacks run on the RPi.GPIO event thread ; nothing to poll here
+        self.read_rotary_switch()
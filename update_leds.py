@@ -49,6 +49,7 @@
 import math
 import datetime
 import time
+import threading
 from enum import Enum, auto
 
 # from datetime import datetime
@@ -57,17 +58,17 @@ from enum import Enum, auto
 # import collections
 import colorsys
 import ast
+import re
 
-from rpi_ws281x import (
-    Color,
-    PixelStrip,
-    ws,
-)  # works with python 3.7. sudo pip3 install rpi_ws281x
+import numpy as np
 
 import debugging
+import led_backend
+import metrics
 import utils
 import utils_colors
 import utils_gfx
+import utils_wx
 
 
 class LedMode(Enum):
@@ -106,85 +107,9 @@ class UpdateLEDs:
     __toggle_sw = -1
     __led_mode = LedMode.METAR
 
-    __active_led_dict = {}
-
-    # List of METAR weather categories to designate weather in area. Many Metars will report multiple conditions, i.e. '-RA BR'.
-    # The code pulls the first/main weather reported to compare against the lists below. In this example it uses the '-RA' and ignores the 'BR'.
-    # See https://www.aviationweather.gov/metar/symbol for descriptions. Add or subtract codes as desired.
-    # Thunderstorm and lightning
-    wx_lghtn_ck = [
-        "TS",
-        "TSRA",
-        "TSGR",
-        "+TSRA",
-        "TSRG",
-        "FC",
-        "SQ",
-        "VCTS",
-        "VCTSRA",
-        "VCTSDZ",
-        "LTG",
-    ]
-
-    # Snow in various forms
-    wx_snow_ck = [
-        "BLSN",
-        "DRSN",
-        "-RASN",
-        "RASN",
-        "+RASN",
-        "-SN",
-        "SN",
-        "+SN",
-        "SG",
-        "IC",
-        "PE",
-        "PL",
-        "-SHRASN",
-        "SHRASN",
-        "+SHRASN",
-        "-SHSN",
-        "SHSN",
-        "+SHSN",
-    ]
-
-    # Rain in various forms
-    wx_rain_ck = [
-        "-DZ",
-        "DZ",
-        "+DZ",
-        "-DZRA",
-        "DZRA",
-        "-RA",
-        "RA",
-        "+RA",
-        "-SHRA",
-        "SHRA",
-        "+SHRA",
-        "VIRGA",
-        "VCSH",
-    ]
-
-    # Freezing Rain
-    wx_frrain_ck = ["-FZDZ", "FZDZ", "+FZDZ", "-FZRA", "FZRA", "+FZRA"]
-
-    # Dust Sand and/or Ash
-    wx_dustsandash_ck = [
-        "DU",
-        "SA",
-        "HZ",
-        "FU",
-        "VA",
-        "BLDU",
-        "BLSA",
-        "PO",
-        "VCSS",
-        "SS",
-        "+SS",
-    ]
-
-    # Fog
-    wx_fog_ck = ["BR", "MIFG", "VCFG", "BCFG", "PRFG", "FG", "FZFG"]
+    # LED indexes of active airports ; from the airport DB's compiled LED map
+    __led_map = None
+    __active_leds = ()
 
     # Flight Categories
     categories = [
@@ -281,7 +206,7 @@ class UpdateLEDs:
     # True to invert the signal (when using NPN transistor level shift)
     __led_invert = False
     __led_channel = 0  # set to '1' for GPIOs 13, 19, 41, 45 or 53
-    __led_strip = ws.WS2811_STRIP_GRB  # Strip type and color ordering
+    __led_strip = led_backend.WS2811_STRIP_GRB  # Strip type and color ordering
 
     def __init__(self, conf, airport_database):
         """Initialize LED Strip."""
@@ -291,11 +216,16 @@ class UpdateLEDs:
         # Populate the config cache data
         self.update_confcache()
 
-        # Specific Variables to default data to display if Rotary Switch is not installed.
-        # hour_to_display # Offset in HOURS to choose which TAF/MOS to display
-        self.hour_to_display = self.__conf.get_int("rotaryswitch", "time_sw0")
-        # metar_taf_mos    # 0 = Display TAF, 1 = Display METAR, 2 = Display MOS, 3 = Heat Map (Heat map not controlled by rotary switch)
-        self.__metar_taf_mos = self.__conf.get_int("rotaryswitch", "data_sw0")
+        # LED mode selected by the rotary switch ; None until UpdateGPIO reads it
+        self.__switch_mode = None
+        # Set to cut the current frame wait short ; mode / switch changes
+        self.__wake_event = threading.Event()
+        # Mode to restore when sleep mode ends ; None while awake.
+        # The lock keeps rotary switch changes from racing the sleep transitions
+        self.__sleep_resume_mode = None
+        self.__sleep_lock = threading.Lock()
+        # Refresh button during sleep mode ; monotonic time to go back to sleep
+        self.__temp_wake_until = None
 
         self.nightsleep = self.__conf.get_bool("schedule", "usetimer")
 
@@ -334,12 +264,17 @@ class UpdateLEDs:
 
         # starting brightness. It will be changed below.
         self.__led_brightness = self.__conf.get_int("lights", "bright_value")
+        # Light sensor sets the target ; each frame ramps toward it
+        self.__brightness_target = self.__led_brightness
+        self.__brightness_ramp_rate = self.__conf.get_int("lights", "bright_ramp_rate")
+        self.__brightness_step_time = time.monotonic()
 
         # MOS Data Settings
         self.__mos_filepath = self.__conf.get_string("filenames", "mos_filepath")
 
-        # Create an instance of NeoPixel
-        self.strip = PixelStrip(
+        # Create the LED strip output ; hardware or null backend depending on config
+        self.strip = led_backend.create_backend(
+            self.__conf,
             self.__led_count,
             self.__led_pin,
             self.__led_freq_hz,
@@ -350,6 +285,15 @@ class UpdateLEDs:
             self.__led_strip,
         )
         self.strip.begin()
+
+        # Commit stage colour transform ; see build_color_transform()
+        self.build_color_transform()
+
+        # Last committed frame ; hex color (rrggbb) per LED, published for web viewers
+        self.__frame = ["000000"] * self.__led_count
+        self.__frame_brightness = self.__led_brightness
+        self.__frame_serial = 0
+        self.__frame_condition = threading.Condition()
         # self.init_rainbow()
         debugging.info("LED Strip INIT complete")
 
@@ -366,7 +310,7 @@ class UpdateLEDs:
             (col_r, col_g, col_b) = rgb_col
             rgb_list[i] = (col_r * 255, col_g * 255, col_b * 255)
         self.__rgb_rainbow = rgb_list
-        debugging.info(f"Rainbow List - {self.__rgb_rainbow}")
+        debugging.info("Rainbow List - %s", self.__rgb_rainbow)
 
     def update_confcache(self):
         """Update class local variables to cache conf data."""
@@ -377,12 +321,17 @@ class UpdateLEDs:
         self.__confcache["ifr_color"] = utils_colors.cat_ifr(self.__conf)
         self.__confcache["lifr_color"] = utils_colors.cat_lifr(self.__conf)
         self.__confcache["unkn_color"] = utils_colors.wx_noweather(self.__conf)
+        # Stations with an old observation show their last category dimmed
+        old_data_dim = self.__conf.get_int("lights", "old_data_dim") / 100
+        self.__confcache["old_colors"] = {
+            category: utils_colors.dim(
+                self.__confcache[f"{category.lower()}_color"], old_data_dim
+            )
+            for category in ("VFR", "MVFR", "IFR", "LIFR", "UNKN")
+        }
         self.__confcache["lights_highwindblink"] = self.__conf.get_bool(
             "lights", "hiwindblink"
         )
-        self.__confcache["metar_maxwindspeed"] = self.__conf.get_int(
-            "metar", "max_wind_speed"
-        )
         self.__confcache["lights_lghtnflash"] = self.__conf.get_bool(
             "lights", "lghtnflash"
         )
@@ -402,9 +351,6 @@ class UpdateLEDs:
         self.__confcache["lights_homeport_display"] = self.__conf.get_int(
             "lights", "homeport_display"
         )
-        self.__confcache["rev_rgb_grb"] = self.__conf.get_string(
-            "lights", "rev_rgb_grb"
-        )
 
     def ledmode(self):
         """Return current LED Mode."""
@@ -413,37 +359,117 @@ class UpdateLEDs:
     def set_ledmode(self, new_mode):
         """Update active LED Mode."""
         self.__led_mode = new_mode
+        self.wake()
+
+    def set_rotary_switch(self, new_mode):
+        """Apply the LED mode of a rotary switch position ; shown on the next frame."""
+        if new_mode == self.__switch_mode:
+            return
+        self.__switch_mode = new_mode
+        with self.__sleep_lock:
+            if self.__sleep_resume_mode is not None:
+                # Lights stay off until the sleep timer ends ; then show this mode
+                self.__sleep_resume_mode = new_mode
+                if self.__temp_wake_until is None:
+                    return
+        self.set_ledmode(new_mode)
+
+    def temp_wake(self, minutes):
+        """Light the map for minutes while in sleep mode ; the refresh button."""
+        with self.__sleep_lock:
+            if self.__sleep_resume_mode is None:
+                return
+            debugging.info("Sleep mode interrupted for %s minutes", minutes)
+            self.__temp_wake_until = time.monotonic() + minutes * 60
+            self.__led_mode = self.__sleep_resume_mode
+        self.wake()
+
+    def wake(self):
+        """Start the next LED frame now rather than at the end of the frame wait."""
+        self.__wake_event.set()
+
+    def frame_sleep(self, seconds):
+        """Sleep between frames ; returns early if wake() is called."""
+        if self.__wake_event.wait(seconds):
+            self.__wake_event.clear()
+
+    def build_color_transform(self):
+        """Precompute the per LED colour order and the gamma table applied at commit."""
+        # rgb_grb: 1 = RGB strip, 0 = GRB strip. LEDs listed in rev_rgb_grb use
+        # the opposite order ; so both types of LED string can be used on one map
+        led_grb = np.full(self.__led_count, not self.__rgb_grb, dtype=bool)
+        rev_rgb_grb = self.__conf.get_string("lights", "rev_rgb_grb")
+        for led_index in {int(pin) for pin in re.findall(r"\d+", rev_rgb_grb)}:
+            if led_index < self.__led_count:
+                led_grb[led_index] = not led_grb[led_index]
+        self.__led_grb = led_grb
+        led_gamma = self.__conf.get_float("lights", "led_gamma")
+        self.__gamma_lut = np.round(
+            255 * (np.arange(256) / 255) ** led_gamma
+        ).astype(np.uint32)
+        # hex color -> packed 24bit RGB ; frames are drawn from a small palette
+        self.__packed_colors = {}
+        # Logical RGB color per LED, and the pixel data last sent to the strip
+        self.__frame_rgb = np.zeros(self.__led_count, dtype=np.uint32)
+        self.__strip_pixels = np.zeros(self.__led_count, dtype=np.uint32)
+
+    def packed_rgb(self, hexcolor):
+        """Return a HEX color as 24bit packed RGB."""
+        packed = self.__packed_colors.get(hexcolor)
+        if packed is None:
+            red, grn, blu = utils_colors.rgb_color(hexcolor)
+            packed = led_backend.pixel_color(red, grn, blu)
+            self.__packed_colors[hexcolor] = packed
+        return packed
+
+    def strip_pixels(self, frame_rgb, led_grb):
+        """Return strip pixel data for packed RGB ; applies gamma and colour order."""
+        red = self.__gamma_lut[(frame_rgb >> 16) & 0xFF]
+        grn = self.__gamma_lut[(frame_rgb >> 8) & 0xFF]
+        blu = self.__gamma_lut[frame_rgb & 0xFF]
+        first = np.where(led_grb, grn, red)
+        second = np.where(led_grb, red, grn)
+        return (first << 16) | (second << 8) | blu
+
+    def commit_colors(self, led_color_dict):
+        """Transform a frame of HEX colors in one pass ; push changed pixels to the strip."""
+        led_indexes = [
+            led_index
+            for led_index in led_color_dict
+            if isinstance(led_index, int) and 0 <= led_index < self.__led_count
+        ]
+        self.__frame_rgb[led_indexes] = [
+            self.packed_rgb(led_color_dict[led_index]) for led_index in led_indexes
+        ]
+        pixels = self.strip_pixels(self.__frame_rgb, self.__led_grb)
+        changed = np.flatnonzero(pixels != self.__strip_pixels)
+        if changed.size:
+            self.strip.set_pixels(changed.tolist(), pixels[changed].tolist())
+            self.__strip_pixels = pixels
 
     def set_led_color(self, led_id, hexcolor):
-        """Convert color from HEX to RGB or GRB and apply to LED String."""
+        """Convert color from HEX to strip pixel data and apply to one LED."""
         # TODO: Add capability here to manage 'nullpins' and remove any mention of nullpins from
         # the rest of the code
-        #
-        # This function should do all the color conversions
-        rgb_color = utils_colors.rgb_color(hexcolor)
-        color_ord = self.rgb_to_pixel(led_id, rgb_color, self.__rgb_grb)
-        pixel_data = Color(color_ord[0], color_ord[1], color_ord[2])
         if isinstance(led_id, str):
-            debugging.info(f"led_id : {led_id} str")
+            debugging.info("led_id : %s str", led_id)
             return
-        self.strip.setPixelColor(led_id, pixel_data)
+        self.__frame_rgb[led_id] = self.packed_rgb(hexcolor)
+        pixel_data = self.strip_pixels(
+            self.__frame_rgb[led_id], self.__led_grb[led_id]
+        )
+        self.__strip_pixels[led_id] = pixel_data
+        self.strip.setPixelColor(led_id, int(pixel_data))
 
     def update_active_led_list(self):
         """Update Active LED list."""
-        active_led_dict = {}
-        led_index = 0
-        posn = 0
-        airports = self.__airport_database.get_airport_dict_led()
-        if airports is None:
+        # The LED map is only replaced when airports.json is loaded or edited
+        led_map = self.__airport_database.get_led_map()
+        if led_map is None or led_map is self.__led_map:
             return
-        for icao, airport_obj in airports.items():
-            if not airport_obj.active():
-                debugging.debug(f"Airport Not Active {icao} : Not updating LED list")
-                continue
-            led_index = airport_obj.get_led_index()
-            active_led_dict[posn] = led_index
-            posn = posn + 1
-        self.__active_led_dict = active_led_dict
+        debugging.debug("LED map changed : %s active LEDs", len(led_map.active_leds))
+        self.__led_map = led_map
+        self.__active_leds = led_map.active_leds
 
     def show(self):
         """Update LED strip to display current colors."""
@@ -454,22 +480,75 @@ class UpdateLEDs:
         for i in range(self.num_pixels()):
             self.set_led_color(i, utils_colors.black())
         self.show()
+        self.publish_frame(
+            {led_index: utils_colors.black() for led_index in range(self.num_pixels())}
+        )
+
+    def publish_frame(self, led_color_dict):
+        """Record led_color_dict as the committed frame and wake any frame watchers.
+
+        Returns False if the frame is unchanged from the previous frame.
+        """
+        # LEDs not in led_color_dict keep their previous color ; same as the strip
+        # Only this thread replaces self.__frame, so reading it unlocked here is safe
+        new_frame = list(self.__frame)
+        for ledindex, led_color in led_color_dict.items():
+            if isinstance(ledindex, int) and 0 <= ledindex < self.__led_count:
+                new_frame[ledindex] = led_color.lstrip("#").lower()
+        with self.__frame_condition:
+            if (
+                new_frame == self.__frame
+                and self.__frame_brightness == self.__led_brightness
+            ):
+                return False
+            self.__frame = new_frame
+            self.__frame_brightness = self.__led_brightness
+            self.__frame_serial += 1
+            self.__frame_condition.notify_all()
+        return True
+
+    def committed_frame(self):
+        """Return (serial, brightness, frame) for the last committed frame."""
+        with self.__frame_condition:
+            return self.__frame_serial, self.__frame_brightness, self.__frame
+
+    def wait_for_frame(self, last_serial, timeout):
+        """Wait up to timeout seconds for a frame newer than last_serial ; return committed_frame()."""
+        with self.__frame_condition:
+            self.__frame_condition.wait_for(
+                lambda: self.__frame_serial != last_serial, timeout
+            )
+            return self.__frame_serial, self.__frame_brightness, self.__frame
 
     def fill(self, color):
         """Return led_updated_dict containing single color only"""
-        debugging.info("Fill: In the fill loop")
-        led_updated_dict = {}
-        for led_posn, active_led in enumerate(self.__active_led_dict):
-            led_updated_dict[self.__active_led_dict[led_posn]] = color
-        return led_updated_dict
+        debugging.debug("Fill: In the fill loop")
+        return dict.fromkeys(self.__active_leds, color)
+
+    def gpio_pins(self):
+        """Return the GPIO pins driving the LED strips."""
+        return self.strip.gpio_pins()
 
     def num_pixels(self):
         """Return number of Pixels defined."""
         return self.__led_count
 
-    def set_brightness(self, lux):
-        """Update saved brightness value."""
-        self.__led_brightness = round(lux)
+    def set_brightness(self, level):
+        """Set target brightness ; the LED loop ramps toward it a frame at a time."""
+        self.__brightness_target = max(0, min(255, round(level)))
+
+    def step_brightness(self):
+        """Move brightness toward the target by at most bright_ramp_rate per second."""
+        step_time = time.monotonic()
+        elapsed = step_time - self.__brightness_step_time
+        self.__brightness_step_time = step_time
+        delta = self.__brightness_target - self.__led_brightness
+        if delta == 0:
+            return
+        max_step = max(1, round(self.__brightness_ramp_rate * elapsed))
+        delta = max(-max_step, min(max_step, delta))
+        self.__led_brightness += delta
+        metrics.set_gauge("led_brightness", self.__led_brightness)
 
     def dim(self, color_data, value):
         """DIM LED.
@@ -503,33 +582,15 @@ class UpdateLEDs:
                     yield round(i, 2)
                     i -= step
 
-    def rgb_to_pixel(self, pin, data, order=True):
-        """Change colorcode to match self.strip RGB / GRB style."""
-        # Change color code to work with various led self.strips. For instance, WS2812 model
-        # self.strip uses RGB where WS2811 model uses GRB
-        # Set the "rgb_grb" user setting above. 1 for RGB LED self.strip, and 0 for GRB self.strip.
-        # If necessary, populate the list rev_rgb_grb with pin numbers of LED's that use the opposite color scheme.
-        # list of pins that need to use the reverse of the normal order setting.
-        # This accommodates the use of both models of LED strings on one map.
-        if str(pin) in self.__confcache["rev_rgb_grb"]:
-            order = not order
-            debugging.info(f"Reversing rgb2grb Routine Output for PIN {pin}")
-        red = data[0]
-        grn = data[1]
-        blu = data[2]
-        if order:
-            data = [red, grn, blu]
-        else:
-            data = [grn, red, blu]
-        return data
 
     # For Heat Map. Based on visits, assign color. Using a 0 to 100 scale where 0 is never visted and 100 is home airport.
     # Can choose to display binary colors with homeap.
     def heatmap_color(self, visits):
         """Color codes assigned with heatmap."""
-        if visits == "0":
+        visits = int(visits)
+        if visits == 0:
             color = utils_colors.colordict["GOLD"]
-        elif visits == "100":
+        elif visits == 100:
             if self.__conf.get_bool(
                 "rotaryswitch", "fade_yesno"
             ) and self.__conf.get_bool("rotaryswitch", "bin_grad"):
@@ -538,21 +599,21 @@ class UpdateLEDs:
                 color = utils_colors.colordict["RED"]
             else:
                 color = self.__conf.get_string("colors", "color_vfr")
-        elif "1" <= visits <= "50":  # Working
+        elif 1 <= visits <= 50:  # Working
             if self.__conf.get_bool("rotaryswitch", "bin_grad"):
                 red = 255
                 grn = 0
                 blu = 0
-                red = int(int(visits) * 5.1)
+                red = int(visits * 5.1)
                 color = utils_colors.rgb2hex((red, grn, blu))
             else:
                 color = utils_colors.colordict["RED"]
-        elif "51" <= visits <= "99":  # Working
+        elif 51 <= visits <= 99:  # Working
             if self.__conf.get_bool("rotaryswitch", "bin_grad"):
                 red = 255
                 grn = 0
                 blu = 0
-                blu = 255 - int((int(visits) - 50) * 5.1)
+                blu = 255 - int((visits - 50) * 5.1)
                 color = utils_colors.rgb2hex((red, grn, blu))
             else:
                 color = utils_colors.rgb2hex((255, 0, 0))
@@ -563,8 +624,6 @@ class UpdateLEDs:
     def update_loop(self):
         """LED Display Loop - supporting multiple functions."""
         clocktick = 0
-        sleeping = False
-        original_state = LedMode.METAR
         self.update_active_led_list()
         rainbowtick = 0
         while True:
@@ -574,99 +633,120 @@ class UpdateLEDs:
             # If each pass through this loop touches one LED ; then we need enough
             # clock cycles to cover every LED.
             clocktick = (clocktick + 1) % self.BIGNUM
+            frame_start = time.perf_counter()
 
-            if (clocktick % 1000) == 1:
-                # Make sure the active LED list is updated
-                self.update_active_led_list()
+            # Cheap identity check ; only rebuilds after airports.json changes
+            self.update_active_led_list()
 
             # Check for nighttime every 1000 times through the loop
             # Keep the CPU load down
             if ((clocktick % 200) == 1) and self.nightsleep:
-                debugging.info(f"Checking if it's time for sleep mode: {clocktick}")
+                debugging.debug("Checking if it's time for sleep mode: %s", clocktick)
                 datetime_now = utils.current_time(self.__conf)
                 time_now = datetime_now.time()
-                if utils.time_in_range(self.__offtime, self.__ontime, time_now):
-                    if not sleeping:
+                sleep_now = utils.time_in_range(self.__offtime, self.__ontime, time_now)
+                with self.__sleep_lock:
+                    if sleep_now and self.__sleep_resume_mode is None:
                         debugging.info("Enabling sleeping mode...")
-                        original_state = self.__led_mode
+                        self.__sleep_resume_mode = self.__led_mode
                         self.__led_mode = LedMode.SLEEP
-                        sleeping = True
-                    else:
+                    elif sleep_now and self.__temp_wake_until is not None:
+                        if time.monotonic() >= self.__temp_wake_until:
+                            debugging.info("Temporary wake over ; back to sleep")
+                            self.__temp_wake_until = None
+                            self.__led_mode = LedMode.SLEEP
+                    elif sleep_now:
                         # It's night time; we're already sleeping. Take a break.
-                        debugging.info(f"Sleeping .. {clocktick}")
-                elif sleeping:
-                    debugging.info(f"Disabling sleeping mode... {clocktick} ")
-                    self.__led_mode = original_state
-                    sleeping = False
+                        debugging.debug("Sleeping .. %s", clocktick)
+                    elif self.__sleep_resume_mode is not None:
+                        debugging.info("Disabling sleeping mode... %s", clocktick)
+                        self.__led_mode = self.__sleep_resume_mode
+                        self.__sleep_resume_mode = None
+                        self.__temp_wake_until = None
 
             if self.__led_mode in (LedMode.OFF, LedMode.SLEEP):
                 self.turnoff()
-                time.sleep(self.PAUSESHORT)
+                self.frame_sleep(self.PAUSESHORT)
                 continue
             if self.__led_mode == LedMode.METAR:
                 led_color_dict = self.ledmode_metar(clocktick)
-                self.update_ledstring(led_color_dict)
+                # Add cycle delay to this loop
+                # Kept out of ledmode_metar() so frame generation can be timed on its own
+                frame_wait = self.__cycle_wait[clocktick % len(self.__cycle_wait)]
+                self.update_ledstring(led_color_dict, frame_start, frame_wait)
+                self.frame_sleep(frame_wait)
                 continue
             if self.__led_mode == LedMode.TEST:
                 self.ledmode_test(clocktick)
                 led_color_dict = self.colorwipe(clocktick)
-                time.sleep(self.DELAYMEDIUM)
+                self.frame_sleep(self.DELAYMEDIUM)
                 continue
             if self.__led_mode == LedMode.RAINBOW:
                 led_color_dict = self.ledmode_rainbow(rainbowtick)
-                self.update_ledstring(led_color_dict)
+                self.update_ledstring(led_color_dict, frame_start, self.DELAYMEDIUM)
                 rainbowtick += 5
-                time.sleep(self.DELAYMEDIUM)
+                self.frame_sleep(self.DELAYMEDIUM)
                 continue
             if self.__led_mode == LedMode.FADE:
                 led_color_dict = self.ledmode_fade(clocktick)
-                self.update_ledstring(led_color_dict)
-                time.sleep(self.DELAYSHORT)
+                self.update_ledstring(led_color_dict, frame_start, self.DELAYSHORT)
+                self.frame_sleep(self.DELAYSHORT)
                 continue
             if self.__led_mode == LedMode.RABBIT:
                 led_color_dict = self.ledmode_rabbit(clocktick)
-                self.update_ledstring(led_color_dict)
-                time.sleep(self.DELAYSHORT)
+                self.update_ledstring(led_color_dict, frame_start, self.DELAYSHORT)
+                self.frame_sleep(self.DELAYSHORT)
                 continue
             if self.__led_mode == LedMode.SHUFFLE:
                 led_color_dict = self.ledmode_shuffle(clocktick)
-                self.update_ledstring(led_color_dict)
-                time.sleep(self.DELAYMEDIUM)
+                self.update_ledstring(led_color_dict, frame_start, self.DELAYMEDIUM)
+                self.frame_sleep(self.DELAYMEDIUM)
                 continue
             #
             # Rewrite complete as far as here
             #
             if self.__led_mode == LedMode.RADARWIPE:
                 led_color_dict = self.ledmode_rabbit(clocktick)
-                self.update_ledstring(led_color_dict)
-                time.sleep(self.DELAYMEDIUM)
+                self.update_ledstring(led_color_dict, frame_start, self.DELAYMEDIUM)
+                self.frame_sleep(self.DELAYMEDIUM)
                 continue
             if self.__led_mode == LedMode.SQUAREWIPE:
                 led_color_dict = self.ledmode_rabbit(clocktick)
-                self.update_ledstring(led_color_dict)
-                time.sleep(self.DELAYMEDIUM)
+                self.update_ledstring(led_color_dict, frame_start, self.DELAYMEDIUM)
+                self.frame_sleep(self.DELAYMEDIUM)
                 continue
             if self.__led_mode == LedMode.WHEELWIPE:
                 led_color_dict = self.ledmode_rabbit(clocktick)
-                self.update_ledstring(led_color_dict)
-                time.sleep(self.DELAYMEDIUM)
+                self.update_ledstring(led_color_dict, frame_start, self.DELAYMEDIUM)
+                self.frame_sleep(self.DELAYMEDIUM)
                 continue
             if self.__led_mode == LedMode.CIRCLEWIPE:
                 led_color_dict = self.ledmode_rabbit(clocktick)
-                self.update_ledstring(led_color_dict)
-                time.sleep(self.DELAYMEDIUM)
+                self.update_ledstring(led_color_dict, frame_start, self.DELAYMEDIUM)
+                self.frame_sleep(self.DELAYMEDIUM)
                 continue
             if self.__led_mode == LedMode.HEATMAP:
                 led_color_dict = self.ledmode_heatmap(clocktick)
-                self.update_ledstring(led_color_dict)
+                self.update_ledstring(led_color_dict, frame_start)
                 continue
 
-    def update_ledstring(self, led_color_dict):
-        """Iterate across all the LEDs and set the color appropriately."""
-        for ledindex, led_color in led_color_dict.items():
-            self.set_led_color(ledindex, led_color)
+    def update_ledstring(self, led_color_dict, frame_start=None, frame_interval=None):
+        """Set the LEDs in led_color_dict and commit the frame to the strip."""
+        self.commit_colors(led_color_dict)
+        self.step_brightness()
         self.strip.setBrightness(self.__led_brightness)
         self.show()
+        if not self.publish_frame(led_color_dict):
+            metrics.inc("led_frames_unchanged_total")
+        metrics.inc("led_frames_total")
+        if frame_start is not None:
+            # Frame generation + commit time
+            frame_time = time.perf_counter() - frame_start
+            metrics.observe(
+                "led_frame_seconds", frame_time, mode=self.__led_mode.name.lower()
+            )
+            if frame_interval is not None and frame_time > frame_interval:
+                metrics.inc("led_frames_late_total")
 
     def ledmode_test(self, clocktick):
         """Run self test sequences."""
@@ -734,7 +814,10 @@ class UpdateLEDs:
 
     def ledmode_metar(self, clocktick):
         """Generate LED Color set for Airports."""
-        airport_list = self.__airport_database.get_airport_dict_led()
+        # One snapshot per frame ; age buckets are computed when it's published
+        snapshot = self.__airport_database.get_snapshot()
+        airport_list = snapshot.airport_led_dict
+        age_buckets = snapshot.age_buckets
         led_updated_dict = {}
         for led_index in range(self.num_pixels()):
             led_updated_dict[led_index] = utils_colors.off()
@@ -758,14 +841,8 @@ class UpdateLEDs:
             flightcategory = airport_obj.flightcategory()
             if not flightcategory:
                 flightcategory = "UNKN"
-            # Pull the winds from the dictionary.
-            airportwinds = airport_obj.get_wx_windspeed()
-            if not airportwinds:
-                airportwinds = -1
             airport_conditions = airport_obj.wxconditions()
-            debugging.debug(
-                f"{airportcode}:{flightcategory}:{airportwinds}:cycle=={cycle_num}"
-            )
+            debugging.debug("%s:%s:cycle==%s", airportcode, flightcategory, cycle_num)
 
             # Start of weather display code for each airport in the "airports" file
             # Check flight category and set the appropriate color to display
@@ -780,55 +857,72 @@ class UpdateLEDs:
             elif flightcategory == "UNKN":
                 ledcolor = self.__confcache["unkn_color"]
 
+            if age_buckets.get(airport_key) == utils_wx.AGE_OLD:
+                # Observation older than [metar] metar_age ; show the last category
+                # dimmed, without weather effects that are just as old
+                ledcolor = self.__confcache["old_colors"].get(
+                    flightcategory, self.__confcache["old_colors"]["UNKN"]
+                )
+                airport_conditions = 0
+
+            # Weather effects are decoded from the METAR wx_string at ingest
+            # See utils_wx.decode_wx_effects()
+
             # Check winds and set the 2nd half of cycles to black to create blink effect
             if self.__confcache["lights_highwindblink"]:
                 # bypass if "hiwindblink" is set to 0
-                if int(airportwinds) >= self.__confcache["metar_maxwindspeed"] and (
+                if airport_conditions & utils_wx.WX_HIGH_WIND and (
                     cycle_num in (3, 4, 5)
                 ):
                     ledcolor = utils_colors.off()
-                    debugging.debug(f"HIGH WINDS {airportcode} : {airportwinds} kts")
+                    debugging.debug(
+                        "HIGH WINDS %s : %s kts",
+                        airportcode,
+                        airport_obj.get_wx_windspeed(),
+                    )
 
             if self.__confcache["lights_lghtnflash"]:
                 # Check for Thunderstorms
-                if airport_conditions in self.wx_lghtn_ck and (cycle_num in (2, 4)):
+                if airport_conditions & utils_wx.WX_LIGHTNING and (cycle_num in (2, 4)):
                     ledcolor = utils_colors.wx_lightning(self.__conf)
 
             if self.__confcache["lights_snowshow"]:
                 # Check for Snow
-                if airport_conditions in self.wx_snow_ck and (cycle_num in (3, 5)):
+                if airport_conditions & utils_wx.WX_SNOW and (cycle_num in (3, 5)):
                     ledcolor = utils_colors.wx_snow(self.__conf, 1)
-                if airport_conditions in self.wx_snow_ck and cycle_num == 4:
+                if airport_conditions & utils_wx.WX_SNOW and cycle_num == 4:
                     ledcolor = utils_colors.wx_snow(self.__conf, 2)
 
             if self.__confcache["lights_rainshow"]:
                 # Check for Rain
-                if airport_conditions in self.wx_rain_ck and (cycle_num in (3, 4)):
+                if airport_conditions & utils_wx.WX_RAIN and (cycle_num in (3, 4)):
                     ledcolor = utils_colors.wx_rain(self.__conf, 1)
-                if airport_conditions in self.wx_rain_ck and cycle_num == 5:
+                if airport_conditions & utils_wx.WX_RAIN and cycle_num == 5:
                     ledcolor = utils_colors.wx_rain(self.__conf, 2)
 
             if self.__confcache["lights_frrainshow"]:
                 # Check for Freezing Rain
-                if airport_conditions in self.wx_frrain_ck and (cycle_num in (3, 5)):
+                if airport_conditions & utils_wx.WX_FREEZING_RAIN and (
+                    cycle_num in (3, 5)
+                ):
                     ledcolor = utils_colors.wx_frzrain(self.__conf, 1)
-                if airport_conditions in self.wx_frrain_ck and cycle_num == 4:
+                if airport_conditions & utils_wx.WX_FREEZING_RAIN and cycle_num == 4:
                     ledcolor = utils_colors.wx_frzrain(self.__conf, 2)
 
             if self.__confcache["lights_dustsandashshow"]:
                 # Check for Dust, Sand or Ash
-                if airport_conditions in self.wx_dustsandash_ck and (
+                if airport_conditions & utils_wx.WX_DUST_SAND_ASH and (
                     cycle_num in (3, 5)
                 ):
                     ledcolor = utils_colors.wx_dust_sand_ash(self.__conf, 1)
-                if airport_conditions in self.wx_dustsandash_ck and cycle_num == 4:
+                if airport_conditions & utils_wx.WX_DUST_SAND_ASH and cycle_num == 4:
                     ledcolor = utils_colors.wx_dust_sand_ash(self.__conf, 2)
 
             if self.__confcache["lights_fogshow"]:
                 # Check for Fog
-                if airport_conditions in self.wx_fog_ck and (cycle_num in (3, 5)):
+                if airport_conditions & utils_wx.WX_FOG and (cycle_num in (3, 5)):
                     ledcolor = utils_colors.wx_fog(self.__conf, 1)
-                if airport_conditions in self.wx_fog_ck and cycle_num == 4:
+                if airport_conditions & utils_wx.WX_FOG and cycle_num == 4:
                     ledcolor = utils_colors.wx_fog(self.__conf, 2)
 
             # If homeport is set to 1 then turn on the appropriate LED using a specific color, This will toggle
@@ -868,8 +962,6 @@ class UpdateLEDs:
             #    # ledcolor = utils_colors.hexcode(norm_color[0], norm_color[1], norm_color[2])
 
             led_updated_dict[airportled] = ledcolor
-        # Add cycle delay to this loop
-        time.sleep(self.__cycle_wait[cycle_num])
         return led_updated_dict
 
     def colorwipe(self, clocktick):
@@ -892,7 +984,7 @@ class UpdateLEDs:
         led_updated_dict = {}
         for led_index in range(self.num_pixels()):
             led_updated_dict[led_index] = utils_colors.off()
-        for led_index in self.__active_led_dict.values():
+        for led_index in self.__active_leds:
             rainbow_index = (clocktick + led_index) % len(self.__rgb_rainbow)
             rainbow_color = utils_colors.hex_tuple(self.__rgb_rainbow[rainbow_index])
             # print(f"Rainbow loop {led_index} / {rainbow_index} / {rainbow_color} ")
@@ -1280,22 +1372,22 @@ class UpdateLEDs:
     def ledmode_rabbit(self, clocktick):
         """Rabbit running through the map."""
         led_updated_dict = {}
-        rabbit_posn = clocktick % (len(self.__active_led_dict) + 1)
+        rabbit_posn = clocktick % (len(self.__active_leds) + 1)
         rabbit_color_1 = utils_colors.colordict["RED"]
         rabbit_color_2 = utils_colors.colordict["BLUE"]
         rabbit_color_3 = utils_colors.colordict["ORANGE"]
 
-        debugging.info("Rabbit: In the rabbit loop")
+        debugging.debug("Rabbit: In the rabbit loop")
 
-        for led_posn, active_led in enumerate(self.__active_led_dict):
+        for led_posn, led_index in enumerate(self.__active_leds):
             # debugging.info(f"posn:{rabbit_posn}/index:{led_index}")
-            led_updated_dict[self.__active_led_dict[led_posn]] = utils_colors.off()
+            led_updated_dict[led_index] = utils_colors.off()
             if led_posn == rabbit_posn - 2:
-                led_updated_dict[self.__active_led_dict[led_posn]] = rabbit_color_1
+                led_updated_dict[led_index] = rabbit_color_1
             if led_posn == rabbit_posn - 1:
-                led_updated_dict[self.__active_led_dict[led_posn]] = rabbit_color_2
+                led_updated_dict[led_index] = rabbit_color_2
             if led_posn == rabbit_posn:
-                led_updated_dict[self.__active_led_dict[led_posn]] = rabbit_color_3
+                led_updated_dict[led_index] = rabbit_color_3
         return led_updated_dict
 
     def ledmode_shuffle(self, clocktick):
@@ -1303,7 +1395,7 @@ class UpdateLEDs:
         led_updated_dict = {}
         for led_index in range(self.num_pixels()):
             led_updated_dict[led_index] = utils_colors.off()
-        for led_index in self.__active_led_dict.values():
+        for led_index in self.__active_leds:
             led_updated_dict[led_index] = utils_colors.randomcolor()
         return led_updated_dict
 
@@ -34,6 +34,7 @@ from python_tsl2591 import tsl2591
 
 import random
 import debugging
+import metrics
 
 
 class LightSensor:
@@ -60,8 +61,49 @@ class LightSensor:
         self.found_device = False
         self.i2cbus = i2cbus
         self.led_mgmt = led_mgmt
+        self._sample_interval = conf.get_int("lights", "lux_sample_interval")
+        self._smoothing = conf.get_float("lights", "lux_smoothing")
+        self._hysteresis = conf.get_int("lights", "lux_hysteresis")
+        self._brightness_lut = self.brightness_curve(conf)
+        self._smoothed_lux = None
+        self._target_brightness = None
         self.enable_i2c_device()
 
+    @staticmethod
+    def brightness_curve(conf):
+        """Return the lux -> LED brightness lookup table ; indexed by whole lux."""
+        full_scale = max(1, conf.get_int("lights", "lux_full_scale"))
+        gamma = conf.get_float("lights", "lux_gamma")
+        min_brightness = conf.get_int("lights", "lux_min_brightness")
+        max_brightness = conf.get_int("lights", "bright_value")
+        return [
+            round(
+                min_brightness
+                + (max_brightness - min_brightness) * (lux / full_scale) ** gamma
+            )
+            for lux in range(full_scale + 1)
+        ]
+
+    def update_brightness(self, lux):
+        """Smooth a lux reading ; return the new target brightness or None."""
+        if self._smoothed_lux is None:
+            self._smoothed_lux = lux
+        else:
+            # EWMA ; a passing shadow or headlight shouldn't swing the whole map
+            self._smoothed_lux += self._smoothing * (lux - self._smoothed_lux)
+        lut_index = max(0, min(int(self._smoothed_lux), len(self._brightness_lut) - 1))
+        target = self._brightness_lut[lut_index]
+        if target == self._target_brightness:
+            return None
+        if (
+            self._target_brightness is not None
+            and abs(target - self._target_brightness) < self._hysteresis
+            and target not in (self._brightness_lut[0], self._brightness_lut[-1])
+        ):
+            return None
+        self._target_brightness = target
+        return target
+
     def enable_i2c_device(self):
         """TSL2591 Device Enable"""
         # FIXME: Very fragile - assumes existance of hardware
@@ -71,10 +113,12 @@ class LightSensor:
             # Look for device ID hex(29)
             # Datasheet suggests this device also occupies addr 0x28
             self.found_device = True
-            if self.i2cbus.bus_lock("enable_i2c_device"):
-                self.tsl = tsl2591(i2c_bus=1)  # initialize
-                self.tsl.set_timing(1)
-                self.i2cbus.bus_unlock()
+            with self.i2cbus.transaction(
+                "enable_i2c_device", priority=self.i2cbus.PRIORITY_SENSOR
+            ) as acquired:
+                if acquired:
+                    self.tsl = tsl2591(i2c_bus=1)  # initialize
+                    self.tsl.set_timing(1)
             # FIXME: This time interval should align to the thread cycle time
             # The current default interval is 60s
         else:
@@ -86,22 +130,29 @@ class LightSensor:
         while outerloop:
             current_light = None
             if self.found_device:
-                if self.i2cbus.bus_lock("light sensor update loop"):
+                with self.i2cbus.transaction(
+                    "light sensor update loop", priority=self.i2cbus.PRIORITY_SENSOR
+                ) as acquired:
+                    if not acquired:
+                        time.sleep(self._sample_interval)
+                        continue
                     try:
                         current_light = self.tsl.get_current()
                     except OSError as err:
-                        debugging.info(f"light sensor read failure: {err}")
-                        # Try to rediscover the device on the i2c bus
-                        self.i2cbus.bus_unlock()
-                        self.enable_i2c_device()
-                    self.i2cbus.bus_unlock()
-                lux = current_light["lux"] * 2
-                lux = max(lux, 20)
-                lux = min(lux, 255)
-                debugging.debug(f"Setting light levels: {lux}")
-                self.led_mgmt.set_brightness(lux)
-                sleep_interval = 30 + random.randint(0, 5)
-                time.sleep(sleep_interval)
+                        debugging.info("light sensor read failure: %s", err)
+                if current_light is None:
+                    # Try to rediscover the device on the i2c bus
+                    self.i2cbus.invalidate_device_map()
+                    self.enable_i2c_device()
+                    time.sleep(self._sample_interval)
+                    continue
+                metrics.set_gauge("light_sensor_lux", current_light["lux"])
+                target = self.update_brightness(current_light["lux"])
+                if target is not None:
+                    # Only touch the LED brightness when the level actually moves
+                    debugging.debug("Setting light levels: %s", target)
+                    self.led_mgmt.set_brightness(target)
+                time.sleep(self._sample_interval + random.random())
             else:
                 # No device found - longer sleeping
                 debugging.info(
@@ -30,10 +30,10 @@ from enum import Enum, auto
 # import datetime
 
 from luma.core.interface.serial import i2c
-from luma.core.render import canvas
 from luma.oled.device import ssd1306, ssd1309, ssd1325, ssd1331, sh1106, ws0010
 
 import debugging
+import metrics
 
 import utils
 
@@ -134,6 +134,16 @@ class UpdateOLEDs:
     OLED_96x16 = {"w": 96, "h": 16}
     OLED_240x320 = {"w": 240, "h": 320}
 
+    # Wind panels ; oled_id -> (airport, default runway)
+    # TODO: This is hardcoded
+    WIND_PANELS = {
+        1: ("kbfi", 140),
+        2: ("ksea", 160),
+        3: ("kpae", 160),
+        4: ("kpwt", 200),
+        5: ("kfhr", 340),
+    }
+
     reentry_check = False
     _conf = None
     _airport_database = None
@@ -157,15 +167,23 @@ class UpdateOLEDs:
         self._airport_database = airport_database
         self._i2cbus = i2cbus
         self._device_count = self._conf.get_int("oled", "oled_count")
+        self._refresh_interval = self._conf.get_int("oled", "oled_refresh_interval")
+
+        # Fonts are loaded once, not per draw
+        self._font = ImageFont.load_default()
+        # Last frame (bitmap bytes) sent to each OLED ; unchanged frames aren't sent
+        self._frame_cache = {}
+        # Content of the last web image written for each OLED
+        self._web_image_cache = {}
 
         debugging.debug("OLED: Config setup for {self._device_count} devices")
 
         for device_idnum in range(0, self._device_count):
-            debugging.debug(f"OLED: Polling for device: {device_idnum}")
+            debugging.debug("OLED: Polling for device: %s", device_idnum)
             self.oled_list.insert(device_idnum, self.oled_device_init(device_idnum))
             self.oled_text(device_idnum, f"Init {device_idnum}")
 
-        debugging.debug(f"OLED: Init complete : oled_list len {len(self.oled_list)}")
+        debugging.debug("OLED: Init complete : oled_list len %s", len(self.oled_list))
 
     def oled_device_init(self, device_idnum):
         """Initialize individual OLED devices."""
@@ -199,33 +217,53 @@ class UpdateOLEDs:
         # Simple for now - with a 1:1 mapping
         self._i2cbus.select(oled_id)
 
+    def new_frame(self, oled_dev):
+        """Return a blank frame image for oled_dev."""
+        # Make sure to create image with mode '1' for 1-bit color.
+        return Image.new(
+            oled_dev["mode"], (oled_dev["size"]["w"], oled_dev["size"]["h"])
+        )
+
+    def push_frame(self, oled_id, image, owner):
+        """Send image to oled_id if it differs from the last frame sent ; return True if sent."""
+        frame_bytes = image.tobytes()
+        if self._frame_cache.get(oled_id) == frame_bytes:
+            metrics.inc("oled_frames_total", panel=oled_id, result="unchanged")
+            return False
+        oled_dev = self.oled_list[oled_id]
+        # Frame is already rendered ; only the select + transfer happen on the bus
+        with self._i2cbus.transaction(
+            owner, oled_dev["devid"], self._i2cbus.PRIORITY_DISPLAY
+        ) as acquired:
+            if not acquired:
+                debugging.info("Failed to grab lock for oled:%s", oled_id)
+                return False
+            oled_dev["device"].display(image)
+        self._frame_cache[oled_id] = frame_bytes
+        metrics.inc("oled_frames_total", panel=oled_id, result="sent")
+        return True
+
     def oled_text(self, oled_id, txt):
         """Update oled_id with the message from txt."""
-        if oled_id > len(self.oled_list):
-            debugging.warn("OLED: Attempt to access index beyond list length {oled_id}")
-            return
+        if oled_id >= len(self.oled_list):
+            debugging.warn(
+                "OLED: Attempt to access index beyond list length %s", oled_id
+            )
+            return False
         oled_dev = self.oled_list[oled_id]
         if oled_dev["active"] is False:
-            debugging.warn(f"OLED: Attempting to update disabled OLED : {oled_id}")
-            return
+            debugging.warn("OLED: Attempting to update disabled OLED : %s", oled_id)
+            return False
 
-        fnt = ImageFont.load_default()
-        # Make sure to create image with mode '1' for 1-bit color.
-        # image = Image.new(oled_dev["mode"], (width, height))
-        # draw = ImageDraw.Draw(image)
-        # txt_w, txt_h = draw.textsize(txt, fnt)
-        device = oled_dev["device"]
-        device_i2cbus_id = oled_dev["devid"]
-
-        debugging.debug(f"OLED: Writing to device: {oled_id} : Msg : {txt}")
-        if self._i2cbus.bus_lock("oled_text"):
-            self.oled_select(device_i2cbus_id)
-            with canvas(device) as draw:
-                draw.rectangle(device.bounding_box, outline="white", fill="black")
-                draw.text((5, 5), txt, font=fnt, fill="white")
-            self._i2cbus.bus_unlock()
-        else:
-            debugging.info(f"Failed to grab lock for oled:{oled_id}")
+        image = self.new_frame(oled_dev)
+        draw = ImageDraw.Draw(image)
+        draw.rectangle(
+            (0, 0, image.width - 1, image.height - 1), outline="white", fill="black"
+        )
+        draw.text((5, 5), txt, font=self._font, fill="white")
+
+        debugging.debug("OLED: Writing to device: %s : Msg : %s", oled_id, txt)
+        return self.push_frame(oled_id, image, "oled_text")
 
     def generate_info_image(self, oled_id):
         """Create the status/info image."""
@@ -284,18 +322,18 @@ class UpdateOLEDs:
     def draw_wind(self, oled_id, airport, rway_angle, winddir, windspeed):
         """Draw Wind Arrow and Runway."""
         # TODO: This code assumes a single runway direction only. Need to handle airports with multiple runways
-        if oled_id > len(self.oled_list):
-            debugging.warn("OLED: Attempt to access index beyond list length {oled_id}")
-            return
+        if oled_id >= len(self.oled_list):
+            debugging.warn(
+                "OLED: Attempt to access index beyond list length %s", oled_id
+            )
+            return False
         oled_dev = self.oled_list[oled_id]
         if oled_dev["active"] is False:
-            debugging.warn(f"OLED: Attempting to update disabled OLED : {oled_id}")
-            return
+            debugging.warn("OLED: Attempting to update disabled OLED : %s", oled_id)
+            return False
 
-        device = oled_dev["device"]
         width = oled_dev["size"]["w"]
         height = oled_dev["size"]["h"]
-        device_i2cbus_id = oled_dev["devid"]
 
         # Runway Dimensions
         rway_width = 6
@@ -307,18 +345,12 @@ class UpdateOLEDs:
             rway_x, rway_y, rway_width, rway_angle, width, height
         )
 
-        if self._i2cbus.bus_lock("draw_wind"):
-            self.oled_select(device_i2cbus_id)
-            with canvas(device) as draw:
-                draw.text(
-                    (1, 1), airport_details, font=ImageFont.load_default(), fill="white"
-                )
-                draw.polygon(wind_poly, fill="white", outline="white")
-                draw.polygon(runway_poly, fill=None, outline="white")
-            self._i2cbus.bus_unlock()
-        else:
-            debugging.info(f"Failed to grab lock for oled:{oled_id}")
-        return
+        image = self.new_frame(oled_dev)
+        draw = ImageDraw.Draw(image)
+        draw.text((1, 1), airport_details, font=self._font, fill="white")
+        draw.polygon(wind_poly, fill="white", outline="white")
+        draw.polygon(runway_poly, fill=None, outline="white")
+        return self.push_frame(oled_id, image, "draw_wind")
 
     def update_oled_wind(self, oled_id, airportcode, default_rwy):
         """Draw WIND Info on designated OLED."""
@@ -326,13 +358,15 @@ class UpdateOLEDs:
         airport_list = self._airport_database.get_airport_dict_led()
         if airportcode not in airport_list:
             debugging.debug(
-                f"Skipping OLED update {airportcode} not found in airport_list"
+                "Skipping OLED update %s not found in airport_list", airportcode
             )
             # Stop here if we don't have airport data yet
             return
         airport_obj = airport_list[airportcode]
         if airport_obj is None:
-            debugging.debug(f"Skipping OLED update {airportcode} lookup returns :None:")
+            debugging.debug(
+                "Skipping OLED update %s lookup returns :None:", airportcode
+            )
             # FIXME: We should not return here - we should update the OLED / Image with some signal that the information is out of date.
             return
         windspeed = airport_obj.get_wx_windspeed()
@@ -344,13 +378,25 @@ class UpdateOLEDs:
             best_runway = default_rwy
         if (winddir is not None) and (best_runway is not None):
             debugging.info(
-                f"Updating OLED Wind: {airportcode} : rwy: {best_runway} : wind {winddir}"
+                "Updating OLED Wind: %s : rwy: %s : wind %s",
+                airportcode,
+                best_runway,
+                winddir,
             )
             self.draw_wind(oled_id, airportcode, best_runway, winddir, windspeed)
-            self.generate_image(oled_id, airportcode, best_runway, winddir, windspeed)
+            # Web image only needs to be written when the content changes
+            web_image = (airportcode, best_runway, winddir, windspeed)
+            if self._web_image_cache.get(oled_id) != web_image:
+                self.generate_image(
+                    oled_id, airportcode, best_runway, winddir, windspeed
+                )
+                self._web_image_cache[oled_id] = web_image
         else:
             debugging.info(
-                f"NOT Updating OLED: {airportcode} : rwy: {best_runway} : wind {winddir}"
+                "NOT Updating OLED: %s : rwy: %s : wind %s",
+                airportcode,
+                best_runway,
+                winddir,
             )
         return
 
@@ -365,30 +411,39 @@ class UpdateOLEDs:
         oled_status_text = f"{info_timestamp}\n{info_ipaddr}\n{info_uptime}"
         # Update OLED
         self.oled_text(oled_id, oled_status_text)
-        # Update saved image
-        self.generate_info_image(oled_id)
+        # Update saved image ; when the address or METAR data changes
+        web_image = (info_ipaddr, metarage)
+        if self._web_image_cache.get(oled_id) != web_image:
+            self.generate_info_image(oled_id)
+            self._web_image_cache[oled_id] = web_image
 
     def update_loop(self):
-        """Continuous Loop for Thread."""
+        """Continuous Loop for Thread.
+
+        Woken by new airport data ; wind panels are only redrawn when their airport changes.
+        All panels are refreshed every oled_refresh_interval seconds.
+        """
         debugging.debug("OLED: Entering Update Loop")
-        outerloop = True  # Set to TRUE for infinite outerloop
-        count = 0
-        while outerloop:
-            count += 1
-            debugging.info(f"OLED: Updating {self._device_count} OLEDs")
+        generation = -1
+        while True:
+            snapshot = self._airport_database.wait_for_snapshot(
+                generation, self._refresh_interval
+            )
+            if generation >= 0 and snapshot.generation != generation:
+                changed_icaos = self._airport_database.changed_icaos_since(generation)
+            else:
+                # First pass, or periodic refresh ; unchanged frames still aren't sent
+                changed_icaos = None
+            generation = snapshot.generation
+
+            debugging.debug("OLED: Updating %s OLEDs", self._device_count)
+            cycle_start = time.perf_counter()
             for oled_id in range(0, self._device_count):
-                # TODO: This is hardcoded
-                if oled_id == 0:
-                    self.update_oled_status(oled_id)
-                if oled_id == 1:
-                    self.update_oled_wind(oled_id, "kbfi", 140)
-                if oled_id == 2:
-                    self.update_oled_wind(oled_id, "ksea", 160)
-                if oled_id == 3:
-                    self.update_oled_wind(oled_id, "kpae", 160)
-                if oled_id == 4:
-                    self.update_oled_wind(oled_id, "kpwt", 200)
-                if oled_id == 5:
-                    self.update_oled_wind(oled_id, "kfhr", 340)
-            # time.sleep(20)
-            time.sleep(180)
+                with metrics.timer("oled_render_seconds", panel=oled_id):
+                    if oled_id == 0:
+                        self.update_oled_status(oled_id)
+                    elif oled_id in self.WIND_PANELS:
+                        airportcode, default_rwy = self.WIND_PANELS[oled_id]
+                        if changed_icaos is None or airportcode in changed_icaos:
+                            self.update_oled_wind(oled_id, airportcode, default_rwy)
+            metrics.observe("oled_cycle_seconds", time.perf_counter() - cycle_start)
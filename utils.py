@@ -7,8 +7,8 @@ import time
 import shutil
 import socket
 import json
-import urllib
 import gzip
+import hashlib
 import tempfile
 
 from datetime import datetime
@@ -112,7 +112,9 @@ def delete_file(target_path, filename):
             debugging.debug("Deleted " + filename)
             return True
         except OSError as err:
-            debugging.error(f"Error {err} while deleting file {target_path} {filename}")
+            debugging.error(
+                "Error %s while deleting file %s %s", err, target_path, filename
+            )
             return False
     else:
         return False
@@ -135,115 +137,120 @@ def hex2rgb(value):
     )
 
 
-def download_newer_file(session, url, filename, decompress=False, etag=None):
+def file_sha256(filename):
+    """Return the hex SHA-256 of a file, or None if it can't be read."""
+    digest = hashlib.sha256()
+    try:
+        with open(filename, "rb") as hash_file:
+            for chunk in iter(lambda: hash_file.read(65536), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def validator_matches_file(filename, validator):
+    """Check a download validator still describes the local copy of filename."""
+    if not validator or not os.path.isfile(filename):
+        return False
+    if os.path.getsize(filename) != validator.get("size"):
+        return False
+    return file_sha256(filename) == validator.get("sha256")
+
+
+def download_if_changed(session, url, filename, decompress=False, validator=None):
     """
-    Attempt to download a file only if it appears newer / different from the server side copy.
-    Download a file from URL if the
-    last-modified header is newer than our timestamp
+    Download url to filename with a conditional GET.
 
-    Return Values: result, etag
-    Result:
-        True - Download completed
-        False - Download not attempted
-    Etag:
-        Etag Header
+    validator is the dict returned by the previous call for this url ; its
+    ETag / Last-Modified are sent as If-None-Match / If-Modified-Since so an
+    unchanged dataset costs one 304 response rather than a full download.
+    The caller must only pass a validator that matches the local file.
 
+    Return Values: result, validator
+    Result:
+        True - Download completed ; filename replaced
+        False - Download not needed ; local copy is current
+        None - Error talking to the server ; caller should retry later
+    Validator:
+        {"etag", "last_modified", "size", "sha256"} for the local copy
     ."""
-    debugging.debug("Starting download_newer_file" + filename)
-    url_time = url_date = url_etag = None
-    download = False
-
-    # Do a HTTP GET to pull headers so we can check timestamps
+    headers = {}
+    if validator:
+        if validator.get("etag"):
+            headers["If-None-Match"] = validator["etag"]
+        if validator.get("last_modified"):
+            headers["If-Modified-Since"] = validator["last_modified"]
+
+    # Download next to filename so the final rename is atomic
+    download_dir = os.path.dirname(os.path.abspath(filename))
+    download_object = None
     try:
-        req = session.head(url, allow_redirects=True, timeout=5)
-    except ConnectionError as err:
-        debugging.debug(f"Connection Error :{url}:")
-        debugging.error(err)
-        return False, url_etag
-    except TimeoutError as err:
-        debugging.debug(f"Timeout Error :{url}:")
-        debugging.error(err)
-        return False, url_etag
+        # Missing / unwritable download_dir is reported like any other failure
+        download_object = tempfile.NamedTemporaryFile(dir=download_dir, delete=False)
+        download_object.close()
+        with session.get(
+            url, headers=headers, stream=True, timeout=(5, 60)
+        ) as response:
+            if response.status_code == 304:
+                debugging.debug("Not modified :%s:", url)
+                os.remove(download_object.name)
+                return False, validator
+            response.raise_for_status()
+            url_etag = response.headers.get("etag")
+            url_time = response.headers.get("last-modified")
+            with open(download_object.name, "wb") as download_file:
+                for chunk in response.iter_content(chunk_size=65536):
+                    download_file.write(chunk)
     except Exception as err:
-        debugging.debug(f"Generic error checking HEAD :{url}:")
+        debugging.info("Error in download :%s:", url)
         debugging.error(err)
-        return False, url_etag
-
-    if "last-modified" in req.headers:
-        url_time = req.headers["last-modified"]
-        url_date = parsedate(url_time)
-    if "etag" in req.headers:
-        url_etag = req.headers["etag"]
-
-    if not os.path.isfile(filename):
-        # File doesn't exist, so we need to download it
-        debugging.info(
-            f"Download request for {filename}; file not found ; download scheduled"
-        )
-        download = True
-    else:
-        # File exists - we might have a last-modified header
-        # or we might be using etag comparisons to decide if something is newer/different
-        if url_time is not None:
-            file_time = datetime.fromtimestamp(os.path.getmtime(filename))
-            if url_date.timestamp() > file_time.timestamp():
-                # Time stamp of local file is older than timestamp on server
-                download = True
-            else:
-                # Server side file is same or older, our file is up to date
-                msg = (
-                    f"Timestamp check - Server side: {datetime.fromtimestamp(url_date.timestamp())}"
-                    f"Local : {datetime.fromtimestamp(file_time.timestamp())}"
-                )
-                debugging.debug(msg)
-        if (url_etag is not None) and (etag != url_etag):
-            # Check to see if downloaded etag and value passed in are the same. If not - download is true
-            download = True
-
-    if download:
-        debugging.debug(f"Starting download_newer_file {filename}")
-        try:
-            # Download file to temporary object
-            download_object = tempfile.NamedTemporaryFile(delete=False)
-            try:
-                urllib.request.urlretrieve(url, download_object.name)
-            except ConnectionError as err:
-                debugging.info(f"Connection error in download :{url}:")
-                debugging.error(err)
-                return False, url_etag
-            except TimeoutError as err:
-                debugging.info(f"Timeout Error :{url}:")
-                debugging.error(err)
-                return False, url_etag
-            except Exception as err:
-                debugging.info(f"Generic error in urlretrieve :{url}:")
-                debugging.error(err)
-                return False, url_etag
-
-            if decompress:
-                uncompress_object = tempfile.NamedTemporaryFile(delete=False)
-                try:
-                    decompress_file_gz(download_object.name, uncompress_object.name)
-                except Exception as err:
-                    debugging.info(f"File decompression failed for : {filename}")
-                    debugging.error(err)
+        if download_object is not None:
+            os.remove(download_object.name)
+        return None, validator
+
+    try:
+        if decompress:
+            compressed_name = download_object.name
+            uncompress_object = tempfile.NamedTemporaryFile(
+                dir=download_dir, delete=False
+            )
+            uncompress_object.close()
+            decompressed = decompress_file_gz(compressed_name, uncompress_object.name)
+            os.remove(compressed_name)
+            download_object = uncompress_object
+            if not decompressed:
+                # Truncated / corrupt download ; keep the existing file
+                debugging.info("File decompression failed for : %s", filename)
                 os.remove(download_object.name)
-                download_object = uncompress_object
+                return None, validator
+
+        new_validator = {
+            "etag": url_etag,
+            "last_modified": url_time,
+            "size": os.path.getsize(download_object.name),
+            "sha256": file_sha256(download_object.name),
+        }
+        if validator and new_validator["sha256"] == validator.get("sha256"):
+            # Server ignored the conditional headers but the content is the same
+            os.remove(download_object.name)
+            return False, new_validator
 
-            shutil.copyfile(download_object.name, filename)
+        os.replace(download_object.name, filename)
+        # Set the timestamp of the downloaded file to match the server's
+        file_timestamp = time.time()
+        if url_time is not None:
+            try:
+                file_timestamp = parsedate(url_time).timestamp()
+            except (ValueError, OverflowError):
+                pass
+        os.utime(filename, (file_timestamp, file_timestamp))
+        return True, new_validator
+    except OSError as err:
+        debugging.error(err)
+        if os.path.isfile(download_object.name):
             os.remove(download_object.name)
-            # Set the timestamp of the downloaded file to match
-            # match the HEAD date stamp / or 'now' for etag headers
-            if url_date is None:
-                file_timestamp = datetime.now().timestamp()
-            else:
-                file_timestamp = datetime.timestamp(url_date)
-            os.utime(filename, (file_timestamp, file_timestamp))
-            return download, url_etag
-        except Exception as err:
-            debugging.error(err)
-            return False, url_etag
-    return download, url_etag
+        return None, validator
 
 
 def decompress_file_gz(srcfile, dstfile):
@@ -256,11 +263,38 @@ def decompress_file_gz(srcfile, dstfile):
         return True
     except Exception as err:
         # Something went wrong
-        debugging.info(f"File gzip decompress error f:{srcfile}:")
+        debugging.info("File gzip decompress error f:%s:", srcfile)
         debugging.error(err)
         return False
 
 
+def atomic_write_json(filename, data, tmp_filename=None, backup_filename=None):
+    """Write data to filename as compact JSON ; temp file + fsync + atomic rename."""
+    # filename is either the old or the new complete file at every point ;
+    # a crash can only lose the temp file
+    if tmp_filename is None:
+        tmp_filename = f"{filename}.tmp"
+    try:
+        with open(tmp_filename, "w", encoding="utf8") as json_file:
+            json.dump(data, json_file, sort_keys=True, separators=(",", ":"))
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        if backup_filename is not None and os.path.isfile(filename):
+            # Copy rather than move ; filename has to exist right up to the rename
+            shutil.copyfile(filename, backup_filename)
+        os.replace(tmp_filename, filename)
+        # fsync the directory so the rename itself survives a power cut
+        dir_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return True
+    except OSError as err:
+        debugging.error("atomic_write_json: error writing %s : %s", filename, err)
+        return False
+
+
 def time_in_range(start_time, end_time, check_time):
     """See if a time falls within range."""
     if start_time < end_time:
@@ -77,6 +77,13 @@ def rgb2hex(rgb):
     return hexval
 
 
+def dim(value, factor):
+    """Return HEX color value scaled by factor (0.0 - 1.0)."""
+    factor = min(max(factor, 0.0), 1.0)
+    red, grn, blu = (round(channel * factor) for channel in hex2rgb(value))
+    return f"#{red:02x}{grn:02x}{blu:02x}"
+
+
 def rgb_color(value):
     """Return RGB values from HEX string."""
     return hex2rgb(value)
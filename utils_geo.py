@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*- #
+"""
+Geographic helpers
+
+StationIndex is a lat/lon grid over a set of stations, used to find the
+nearest reporting stations to an airport that isn't in the METAR feed.
+"""
+
+import math
+
+import numpy as np
+
+
+EARTH_RADIUS_NM = 3440.065
+
+# Grid cell size in degrees ; ~60nm north/south
+GRID_CELL_DEGREES = 1.0
+
+
+def distance_nm(lat1, lon1, lat2, lon2):
+    """Great circle (haversine) distance in nautical miles ; works on NumPy arrays."""
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlon = np.radians(lon2) - np.radians(lon1)
+    hav = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_NM * np.arcsin(np.sqrt(np.minimum(hav, 1.0)))
+
+
+def coordinates(lat, lon):
+    """Return (lat, lon) as floats, or None if either is missing / invalid."""
+    try:
+        lat = float(lat)
+        lon = float(lon)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(lat) or math.isnan(lon) or abs(lat) > 90 or abs(lon) > 180:
+        return None
+    return lat, lon
+
+
+class StationIndex:
+    """Grid index of station positions for k nearest lookups."""
+
+    def __init__(self, stations, cell_degrees=GRID_CELL_DEGREES):
+        """Index stations ; an iterable of (station_id, lat, lon)."""
+        station_ids = []
+        positions = []
+        for station_id, lat, lon in stations:
+            position = coordinates(lat, lon)
+            if position is None:
+                continue
+            station_ids.append(station_id)
+            positions.append(position)
+        self.cell_degrees = cell_degrees
+        self.station_ids = tuple(station_ids)
+        positions = np.array(positions, dtype=np.float64).reshape(-1, 2)
+        self.lat = positions[:, 0]
+        self.lon = positions[:, 1]
+        self._lon_cell_count = int(round(360 / cell_degrees))
+        # (lat cell, lon cell) -> station index array
+        cells = {}
+        lat_cells = np.floor(self.lat / cell_degrees).astype(np.int32).tolist()
+        lon_cells = np.floor(self.lon / cell_degrees).astype(np.int32).tolist()
+        for index, (lat_cell, lon_cell) in enumerate(zip(lat_cells, lon_cells)):
+            cells.setdefault((lat_cell, self._wrap(lon_cell)), []).append(index)
+        self._cells = {
+            cell: np.array(indexes, dtype=np.int32) for cell, indexes in cells.items()
+        }
+
+    def _wrap(self, lon_cell):
+        """Wrap a longitude cell number across the antimeridian."""
+        half = self._lon_cell_count // 2
+        return (lon_cell + half) % self._lon_cell_count - half
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def _candidates(self, lat, lon, radius_nm):
+        """Return indexes of stations in grid cells within radius_nm of lat/lon."""
+        lat_span = radius_nm / 60.0
+        lat_min = math.floor((lat - lat_span) / self.cell_degrees)
+        lat_max = math.floor((lat + lat_span) / self.cell_degrees)
+        # A degree of longitude shrinks with cos(lat) ; use the widest latitude in range
+        widest_lat = min(89.0, abs(lat) + lat_span)
+        lon_span = radius_nm / (60.0 * math.cos(math.radians(widest_lat)))
+        if lon_span >= 180:
+            lon_cells = set(range(self._lon_cell_count))
+        else:
+            lon_cells = {
+                self._wrap(lon_cell)
+                for lon_cell in range(
+                    math.floor((lon - lon_span) / self.cell_degrees),
+                    math.floor((lon + lon_span) / self.cell_degrees) + 1,
+                )
+            }
+        found = []
+        for lat_cell in range(lat_min, lat_max + 1):
+            for lon_cell in lon_cells:
+                indexes = self._cells.get((lat_cell, self._wrap(lon_cell)))
+                if indexes is not None:
+                    found.append(indexes)
+        if not found:
+            return np.empty(0, dtype=np.int32)
+        return np.concatenate(found)
+
+    def nearest(self, lat, lon, k=1, radius_nm=50, exclude=()):
+        """Return up to k (station_id, distance_nm) within radius_nm, nearest first."""
+        candidates = self._candidates(lat, lon, radius_nm)
+        if candidates.size == 0:
+            return []
+        distances = distance_nm(lat, lon, self.lat[candidates], self.lon[candidates])
+        order = np.argsort(distances)
+        result = []
+        for position in order:
+            distance = float(distances[position])
+            if distance > radius_nm:
+                break
+            station_id = self.station_ids[candidates[position]]
+            if station_id in exclude:
+                continue
+            result.append((station_id, distance))
+            if len(result) >= k:
+                break
+        return result
@@ -80,7 +80,12 @@ def create_wind_arrow(windangle, width, height):
         seq_offset2, int((width / 2) - off_x), int((height / 2) - off_y)
     )
     debugging.debug(
-        f"arrow:{windangle}\n  in:{arrow}\n out:{seq_draw}\n   w:{width} / h:{height}"
+        "arrow:%s\n  in:%s\n out:%s\n   w:%s / h:%s",
+        windangle,
+        arrow,
+        seq_draw,
+        width,
+        height,
     )
     return seq_draw
 
@@ -102,8 +107,8 @@ def create_runway(r_x, r_y, rwidth, rwangle, width, height):
     seq_draw = poly_offset(
         seq_offset2, int((width / 2) - off_x), int((height / 2) - off_y)
     )
-    debugging.debug(f"runway:{rwangle}\n  in:{runway}\n out:{seq_draw}")
-    debugging.debug(f"runway:x-{r_x}:y-{r_y}:rw-{rwidth}:w-{width}:h-{height}")
+    debugging.debug("runway:%s\n  in:%s\n out:%s", rwangle, runway, seq_draw)
+    debugging.debug("runway:x-%s:y-%s:rw-%s:w-%s:h-%s", r_x, r_y, rwidth, width, height)
     return seq_draw
 
 
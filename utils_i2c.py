@@ -13,9 +13,12 @@ i2c utils
 # /boot/config.txt
 # dtparam=i2c_arm=on,i2c_arm_baudrate=400000
 
+import heapq
+import itertools
+import threading
 import time
 
-from threading import Lock
+from contextlib import contextmanager
 
 import board
 from board import SCL, SDA
@@ -23,6 +26,7 @@ import busio
 
 import smbus2
 import debugging
+import metrics
 
 
 # the channel for the mux board
@@ -63,7 +67,18 @@ class I2CBus:
     bus = None
     i2c = None
 
-    lock = None
+    # Transaction priorities ; lower values get the bus first.
+    # Sensor reads are a few bytes, OLED frames ~1k ; short transactions go first.
+    PRIORITY_SENSOR = 0
+    PRIORITY_DEFAULT = 5
+    PRIORITY_DISPLAY = 10
+
+    # How long a queued transaction waits for the bus before giving up
+    BUS_LOCK_TIMEOUT = 5.0
+
+    # Rescan the bus after this many seconds, or after an IO error
+    DEVICE_MAP_MAX_AGE = 600
+
     lock_count = 0
 
     bus_lock_owner = None
@@ -73,6 +88,9 @@ class I2CBus:
     always_enabled = 0x0
     current_enabled = 0x0
 
+    # Last flags written to the MUX ; None forces the next write
+    _mux_written = None
+
     # Stats
     _average_lock_count = 0
     _average_lock_duration = 0
@@ -84,7 +102,13 @@ class I2CBus:
     def __init__(self, conf):
         """Do setup for i2c bus - look for default hardware."""
         self.conf = conf
-        self.lock = Lock()
+        self._queue_condition = threading.Condition()
+        self._queue = []
+        self._queue_seq = itertools.count()
+        self._bus_held = False
+        # mux select flags -> (scan time, frozenset of device ids)
+        self._device_map = {}
+        self.__lock_events = 0
         try:
             self.bus = smbus2.SMBus(self.rpi_bus_number)
         except IOError:
@@ -98,7 +122,6 @@ class I2CBus:
             self.i2c_mux_default()
         if not self.i2c_update():
             debugging.error("OLED: init - error calling i2c_update")
-        self.__lock_events = 0
         self.lock_count = 0
 
     def select(self, channel_id):
@@ -107,71 +130,124 @@ class I2CBus:
         if self.bus is None:
             return
         if self.mux_active:
-            if self.i2c_exists(self.MUX_DEVICE_ID):
-                self.i2c_mux_select(channel_id)
-                result = True
-            else:
-                debugging.error("i2c: mux missing")
+            # The MUX was found at init ; a failed write invalidates the device map
+            result = self.i2c_mux_select(channel_id)
         return result
 
-    def i2c_exists(self, device_id):
-        """Iterate across the list of i2c devices."""
+    def scan_devices(self, refresh=False):
+        """Return the device ids visible on the current MUX channels ; cached."""
+        if self.bus is None:
+            return frozenset()
+        mux_select_flags = self.always_enabled | self.current_enabled
+        cached = self._device_map.get(mux_select_flags)
+        now = time.monotonic()
+        if refresh or cached is None or now - cached[0] > self.DEVICE_MAP_MAX_AGE:
+            active_devices = frozenset(self.i2c.scan())
+            metrics.inc("i2c_scan_total")
+            self._device_map[mux_select_flags] = (now, active_devices)
+            debugging.debug(
+                "i2c: scan mux:%s found %s",
+                hex(mux_select_flags),
+                [hex(dev_id) for dev_id in sorted(active_devices)],
+            )
+            return active_devices
+        return cached[1]
+
+    def invalidate_device_map(self):
+        """Drop cached scan results ; the next i2c_exists() rescans."""
+        self._device_map = {}
+
+    def i2c_exists(self, device_id, refresh=False):
+        """Check the device map for device_id."""
         if self.bus is None:
             return
-        found_device = False
-        # with self.lock:
-        active_devices = self.i2c.scan()
-        # length = len(active_devices)
-        # debugging.debug("i2c: scan device count = " + str(length))
-        for dev_id in active_devices:
-            # debugging.debug("i2c: device id " + hex(dev_id))
-            if dev_id == device_id:
-                # debugging.debug("i2c: device id match " + hex(dev_id))
-                found_device = True
-        return found_device
-
-    def bus_lock(self, owner):
-        """Grab bus lock."""
+        return device_id in self.scan_devices(refresh)
+
+    def bus_lock(self, owner, priority=PRIORITY_DEFAULT, timeout=BUS_LOCK_TIMEOUT):
+        """Grab bus lock ; waits in priority order behind other requests."""
         if self.bus is None:
             return
-        if self.lock.locked():
-            debugging.warn(
-                f"bus_lock: request by {owner} when lock is held: count:{self.lock_count}: events:{self.__lock_events}: owner:{self.bus_lock_owner}"
+        ticket = (priority, next(self._queue_seq))
+        wait_start = time.perf_counter()
+        with self._queue_condition:
+            if self._bus_held:
+                debugging.debug(
+                    "bus_lock: %s queued behind %s (%d waiting)",
+                    owner,
+                    self.bus_lock_owner,
+                    len(self._queue),
+                )
+                metrics.inc("i2c_lock_busy_total", owner=owner)
+            heapq.heappush(self._queue, ticket)
+            acquired = self._queue_condition.wait_for(
+                lambda: not self._bus_held and self._queue[0] == ticket, timeout
             )
-            return False
-        else:
-            if self.lock.acquire(blocking=True, timeout=0.5):
+            if acquired:
+                heapq.heappop(self._queue)
+                self._bus_held = True
                 self.__lock_events += 1
                 self.lock_count += 1
                 self.bus_lock_owner = owner
                 self._average_lock_count += 1
                 self._average_lock_start = time.time()
-                return True
-            return False
-        return False
+            else:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                # The head of the queue may have changed
+                self._queue_condition.notify_all()
+        metrics.observe(
+            "i2c_lock_wait_seconds", time.perf_counter() - wait_start, owner=owner
+        )
+        if not acquired:
+            debugging.warn(
+                "bus_lock: request by %s timed out after %ss : owner:%s",
+                owner,
+                timeout,
+                self.bus_lock_owner,
+            )
+            metrics.inc("i2c_lock_timeout_total", owner=owner)
+        return acquired
 
     def bus_unlock(self):
         """Release bus lock."""
         if self.bus is None:
             return
-        if self.lock.locked():
-            self.lock_count -= 1
-            try:
-                self.lock.release()
-                lock_duration = time.time() - self._average_lock_start
-                self._average_lock_total = self._average_lock_total + lock_duration
-                self._average_lock_duration = (
-                    self._average_lock_total / self._average_lock_count
+        with self._queue_condition:
+            if not self._bus_held:
+                debugging.warn(
+                    "bus_unlock: Request to release lock that wasn't acquired - lock_count :%s:%s:%s",
+                    self.lock_count,
+                    self.__lock_events,
+                    self.bus_lock_owner,
                 )
-                if lock_duration > self._max_lock_duration:
-                    self._max_lock_duration = lock_duration
-                    self._max_lock_owner = self.bus_lock_owner
-            except Exception as unlock_err:
-                debugging.error(f"bus_unlock release failed :{unlock_err}:")
-        else:
-            debugging.warn(
-                f"bus_unlock: Request to release lock that wasn't acquired - lock_count :{self.lock_count}:{self.__lock_events}:{self.bus_lock_owner}"
+                return
+            self.lock_count -= 1
+            self._bus_held = False
+            lock_duration = time.time() - self._average_lock_start
+            self._average_lock_total = self._average_lock_total + lock_duration
+            self._average_lock_duration = (
+                self._average_lock_total / self._average_lock_count
             )
+            metrics.observe(
+                "i2c_lock_hold_seconds", lock_duration, owner=self.bus_lock_owner
+            )
+            if lock_duration > self._max_lock_duration:
+                self._max_lock_duration = lock_duration
+                self._max_lock_owner = self.bus_lock_owner
+            self._queue_condition.notify_all()
+
+    @contextmanager
+    def transaction(self, owner, channel_id=None, priority=PRIORITY_DEFAULT):
+        """Hold the bus on channel_id for the block ; yields True if acquired."""
+        if not self.bus_lock(owner, priority):
+            yield False
+            return
+        try:
+            if channel_id is not None:
+                self.select(channel_id)
+            yield True
+        finally:
+            self.bus_unlock()
 
     def set_always_on(self, channel_id):
         """Set channel to be always on."""
@@ -202,10 +278,12 @@ class I2CBus:
         # This switches to channel 1
         if self.bus is None:
             return
-        debugging.debug(f"i2c_mux_select({channel_id})")
+        debugging.debug("i2c_mux_select(%s)", channel_id)
         self.current_enabled = I2C_ch[channel_id]
         if not self.i2c_update():
             debugging.error("OLED: i2c_mux_select - error calling i2c_update")
+            return False
+        return True
 
     def i2c_mux_default(self):
         """Update MUX settings."""
@@ -213,8 +291,8 @@ class I2CBus:
         if self.bus is None:
             return
         if self.mux_active:
-            # with self.lock:
             self.bus.write_byte(self.MUX_DEVICE_ID, self.always_enabled)
+            self._mux_written = None
             if not self.i2c_update():
                 debugging.error("OLED: i2c_mux_default - error calling i2c_update")
 
@@ -223,14 +301,22 @@ class I2CBus:
         if self.bus is None:
             return
         if self.mux_active:
+            mux_select_flags = self.always_enabled | self.current_enabled
+            if mux_select_flags == self._mux_written:
+                # Same channels as the last write ; skip the bus round trip
+                metrics.inc("i2c_mux_writes_total", result="coalesced")
+                return True
             try:
-                mux_select_flags = self.always_enabled | self.current_enabled
-                # with self.lock:
                 self.bus.write_byte_data(self.MUX_DEVICE_ID, 0, mux_select_flags)
+                self._mux_written = mux_select_flags
+                metrics.inc("i2c_mux_writes_total", result="written")
                 return True
             except Exception as err:
-                # self.lock.release()
                 debugging.error(err)
+                # Don't trust the MUX state or the cached scan after a bus error
+                self._mux_written = None
+                self.invalidate_device_map()
+                metrics.inc("i2c_mux_writes_total", result="error")
         return False
 
     def stats(self):
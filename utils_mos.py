@@ -220,7 +220,7 @@ def mos_decode_routine(
                             flightcategory = "MVFR"
 
                     debugging.debug(flightcategory + " |")
-                    debugging.debug(f"Windspeed = {wsp} | Wind dir = {wdr} |")
+                    debugging.debug("Windspeed = %s | Wind dir = %s |", wsp, wdr)
 
                     # decode reported weather using probabilities provided.
                     if (
@@ -260,7 +260,7 @@ def mos_decode_routine(
                         else:
                             wx_info = "NONE"
 
-                    debugging.debug(f"Reported Weather = {wx_info}")
+                    debugging.debug("Reported Weather = %s", wx_info)
 
             # Connect the information from MOS to the board
             stationId = airport
@@ -281,25 +281,25 @@ def mos_decode_routine(
             else:
                 wxstring = wx_info
 
-            debugging.debug(f"{stationId}, {windspeedkt},  {wxstring}")  # debug
+            debugging.debug("%s, %s,  %s", stationId, windspeedkt, wxstring)
 
             # Check for duplicate airport identifier and skip if found, otherwise store in dictionary. covers for dups in "airports" file
             if stationId in stationiddict:
                 debugging.info(
-                    f"{stationId} Duplicate, only saved first metar category"
+                    "%s Duplicate, only saved first metar category", stationId
                 )
             else:
                 # build category dictionary
                 stationiddict[stationId] = flightcategory
 
             if stationId in windsdict:
-                debugging.info(f"{stationId} Duplicate, only saved the first winds")
+                debugging.info("%s Duplicate, only saved the first winds", stationId)
             else:
                 # build windspeed dictionary
                 windsdict[stationId] = windspeedkt
 
             if stationId in wxstringdict:
-                debugging.info(f"{stationId} Duplicate, only saved the first weather")
+                debugging.info("%s Duplicate, only saved the first weather", stationId)
             else:
                 # build weather dictionary
                 wxstringdict[stationId] = wxstring
@@ -10,8 +10,12 @@ Created on Mon Sept 5 08:01:44 2022.
 
 # It includes supporting utility functions
 
+import math
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
 
 # from distutils import util
 from enum import Enum
@@ -19,13 +23,160 @@ from urllib.request import urlopen
 import urllib.error
 import socket
 
+import numpy as np
+
 from metar import Metar
 import debugging
+import metrics
 
 
 # import utils
 
 
+# Flight category codes returned by classify_flight_categories()
+# FLIGHT_CATEGORIES[code] is the category string
+FC_VFR = 0
+FC_MVFR = 1
+FC_IFR = 2
+FC_LIFR = 3
+FC_UNKN = 4
+FLIGHT_CATEGORIES = ("VFR", "MVFR", "IFR", "LIFR", "UNKN")
+
+# Observation age buckets returned by observation_age_bucket()
+AGE_CURRENT = 0
+AGE_OLD = 1
+AGE_UNKNOWN = 2
+
+# Sky cover that counts as a ceiling
+CEILING_SKY_COVER = ("OVC", "BKN", "OVX")
+
+# Parsed METAR cache ; raw METAR text -> Metar.Metar object (or ParserError message)
+# Sized to hold every station in the full ADDS METAR file, so unchanged
+# observations aren't re-parsed on each refresh.
+METAR_CACHE_SIZE = 8192
+_metar_cache = OrderedDict()
+_metar_cache_lock = threading.Lock()
+_metar_cache_hits = 0
+_metar_cache_misses = 0
+
+
+# Weather effect bits decoded from the METAR wx_string by decode_wx_effects()
+WX_LIGHTNING = 0x01
+WX_SNOW = 0x02
+WX_RAIN = 0x04
+WX_FREEZING_RAIN = 0x08
+WX_DUST_SAND_ASH = 0x10
+WX_FOG = 0x20
+WX_HIGH_WIND = 0x40
+
+# METAR present weather tokens for each effect.
+# See https://www.aviationweather.gov/metar/symbol for descriptions. Add or subtract codes as desired.
+# Thunderstorm and lightning
+WX_LIGHTNING_TOKENS = (
+    "TS",
+    "TSRA",
+    "TSGR",
+    "+TSRA",
+    "TSRG",
+    "FC",
+    "SQ",
+    "VCTS",
+    "VCTSRA",
+    "VCTSDZ",
+    "LTG",
+)
+
+# Snow in various forms
+WX_SNOW_TOKENS = (
+    "BLSN",
+    "DRSN",
+    "-RASN",
+    "RASN",
+    "+RASN",
+    "-SN",
+    "SN",
+    "+SN",
+    "SG",
+    "IC",
+    "PE",
+    "PL",
+    "-SHRASN",
+    "SHRASN",
+    "+SHRASN",
+    "-SHSN",
+    "SHSN",
+    "+SHSN",
+)
+
+# Rain in various forms
+WX_RAIN_TOKENS = (
+    "-DZ",
+    "DZ",
+    "+DZ",
+    "-DZRA",
+    "DZRA",
+    "-RA",
+    "RA",
+    "+RA",
+    "-SHRA",
+    "SHRA",
+    "+SHRA",
+    "VIRGA",
+    "VCSH",
+)
+
+# Freezing Rain
+WX_FREEZING_RAIN_TOKENS = (
+    "-FZDZ",
+    "FZDZ",
+    "+FZDZ",
+    "-FZRA",
+    "FZRA",
+    "+FZRA",
+)
+
+# Dust Sand and/or Ash
+WX_DUST_SAND_ASH_TOKENS = (
+    "DU",
+    "SA",
+    "HZ",
+    "FU",
+    "VA",
+    "BLDU",
+    "BLSA",
+    "PO",
+    "VCSS",
+    "SS",
+    "+SS",
+)
+
+# Fog
+WX_FOG_TOKENS = (
+    "BR",
+    "MIFG",
+    "VCFG",
+    "BCFG",
+    "PRFG",
+    "FG",
+    "FZFG",
+)
+
+WX_EFFECT_TOKENS = (
+    (WX_LIGHTNING, WX_LIGHTNING_TOKENS),
+    (WX_SNOW, WX_SNOW_TOKENS),
+    (WX_RAIN, WX_RAIN_TOKENS),
+    (WX_FREEZING_RAIN, WX_FREEZING_RAIN_TOKENS),
+    (WX_DUST_SAND_ASH, WX_DUST_SAND_ASH_TOKENS),
+    (WX_FOG, WX_FOG_TOKENS),
+)
+
+# Token -> effect bits ; one dict lookup per token
+WX_TOKEN_EFFECTS = {}
+for _effect, _tokens in WX_EFFECT_TOKENS:
+    for _token in _tokens:
+        WX_TOKEN_EFFECTS[_token] = WX_TOKEN_EFFECTS.get(_token, 0) | _effect
+
+
 class WxConditions(Enum):
     """ENUM Identifying Weather Conditions."""
 
@@ -51,7 +202,7 @@ def get_usa_metar(airport_data):
     if airport_data.metar_date > expiredtime:
         # Metar Data still fresh
         debugging.debug(
-            f"METAR is fresh  : {airport_data.icao} - {airport_data.wx_category_str}"
+            "METAR is fresh  : %s - %s", airport_data.icao, airport_data.wx_category_str
         )
         return True
     # TODO: Move this to config
@@ -72,13 +223,13 @@ def get_usa_metar(airport_data):
                 airport_data.metar = report
                 debugging.debug(report)
         if not report:
-            debugging.debug(f"No data for {airport_data.icao}")
+            debugging.debug("No data for %s", airport_data.icao)
     except urllib.error.HTTPError:
-        debugging.debug(f"HTTPError retrieving {airport_data.icao} data")
+        debugging.debug("HTTPError retrieving %s data", airport_data.icao)
     except urllib.error.URLError:
         # import traceback
         # debugging.debug(traceback.format_exc())
-        debugging.debug(f"URLError retrieving {airport_data.icao} data")
+        debugging.debug("URLError retrieving %s data", airport_data.icao)
         if urlh:
             if urlh.getcode() == 404:
                 airport_data.metar_date = timenow
@@ -106,10 +257,44 @@ def get_usa_metar(airport_data):
     return False
 
 
+def parse_metar(wx_metar):
+    """Return Metar.Metar(wx_metar) ; parsed objects are shared, and must not be modified."""
+    global _metar_cache_hits, _metar_cache_misses
+    with _metar_cache_lock:
+        wx_data = _metar_cache.get(wx_metar)
+        if wx_data is not None:
+            _metar_cache.move_to_end(wx_metar)
+            _metar_cache_hits += 1
+        else:
+            _metar_cache_misses += 1
+    if wx_data is not None:
+        metrics.inc("metar_parse_cache_total", result="hit")
+    else:
+        metrics.inc("metar_parse_cache_total", result="miss")
+        try:
+            wx_data = Metar.Metar(wx_metar)
+        except Metar.ParserError as err:
+            # Cache the failure too ; it will fail the same way next time
+            wx_data = str(err)
+        with _metar_cache_lock:
+            _metar_cache[wx_metar] = wx_data
+            if len(_metar_cache) > METAR_CACHE_SIZE:
+                _metar_cache.popitem(last=False)
+    if isinstance(wx_data, str):
+        raise Metar.ParserError(wx_data)
+    return wx_data
+
+
+def metar_cache_stats():
+    """Return (hits, misses, entries) for the parsed METAR cache."""
+    with _metar_cache_lock:
+        return _metar_cache_hits, _metar_cache_misses, len(_metar_cache)
+
+
 def cloud_height(wx_metar):
     """Calculate Height to Broken Layer. wx_metar - METAR String."""
     # debugging.debug(wx_data.observation.sky)
-    wx_data = Metar.Metar(wx_metar)
+    wx_data = parse_metar(wx_metar)
     lowest_ceiling = 100000
     for cloudlayer in wx_data.sky:
         key = cloudlayer[0]
@@ -149,7 +334,7 @@ def update_wx(airport_data, metar_xml_dict):
     freshness = False
     if airport_data.wxsrc == "adds":
         try:
-            debugging.debug("Update USA Metar: ADDS " + airport_data.icao)
+            debugging.debug("Update USA Metar: ADDS %s", airport_data.icaocode())
             freshness = airport_data.get_adds_metar(metar_xml_dict)
             if freshness:
                 return
@@ -157,7 +342,9 @@ def update_wx(airport_data, metar_xml_dict):
             debugging.error(err)
     elif airport_data.wxsrc == "usa-metar":
         debugging.debug(
-            f"Update USA Metar: {airport_data.icao} - {airport_data.wx_category_str}"
+            "Update USA Metar: %s - %s",
+            airport_data.icaocode(),
+            airport_data.wx_category_str(),
         )
         freshness = get_usa_metar(airport_data)
         if freshness:
@@ -165,85 +352,183 @@ def update_wx(airport_data, metar_xml_dict):
             return
         calculate_wx_from_metar(airport_data)
     elif airport_data.wxsrc == "ca-metar":
-        debugging.debug("Update CA Metar: " + airport_data.icao + " and skip")
+        debugging.debug("Update CA Metar: %s and skip", airport_data.icaocode())
         freshness = airport_data.get_ca_metar()
         if freshness:
             # get_*_metar() returned true, so weather is still fresh
             return
-        airport_data.wx_category_str = "UNKN"
-        airport_data.set_wx_category(airport_data.wx_category_str)
+        airport_data.set_wx_category("UNKN")
     return
 
 
 def calculate_wx_from_metar(airport_data):
     """Use METAR data to work out wx conditions."""
-    # Should have Good METAR data in airport_data.metar
+    # Should have Good METAR data in airport_data.get_raw_metar()
     # Need to Figure out Airport State
+    wx_metar = airport_data.get_raw_metar()
     try:
-        airport_data_observation = Metar.Metar(airport_data.metar)
+        airport_data_observation = parse_metar(wx_metar)
     except Metar.ParserError as err:
-        debugging.debug("Parse Error for METAR code: " + airport_data.metar)
+        debugging.debug("Parse Error for METAR code: %s", wx_metar)
         debugging.error(err)
-        airport_data.wx_category_str = "UNKN"
-        airport_data.set_wx_category(airport_data.wx_category_str)
+        airport_data.set_wx_category("UNKN")
         return False
 
     if not airport_data_observation:
-        debugging.warn("Have no observations for " + airport_data.icao)
+        debugging.warn("Have no observations for %s", airport_data.icaocode())
         return False
 
     if airport_data_observation.wind_gust:
         airport_data.wx_windgust = airport_data_observation.wind_gust.value()
     else:
         airport_data.wx_windgust = 0
-    if airport_data.observation.wind_speed:
+    if airport_data_observation.wind_speed:
         airport_data.wx_windspeed = airport_data_observation.wind_speed.value()
     else:
         airport_data.wx_windspeed = 0
-    if airport_data.observation.vis:
+    if airport_data_observation.vis:
         airport_data.wx_visibility = airport_data_observation.vis.value()
     else:
         # Set visiblity to -1 to flag as unknown
         airport_data.wx_visibility = -1
     try:
-        airport_data.wx_ceiling = cloud_height(airport_data.metar)
+        airport_data.wx_ceiling = cloud_height(wx_metar)
     except Exception as err:
-        msg = "airport_data.cloud_height() failed for " + airport_data.icao
-        debugging.error(msg)
+        debugging.error("cloud_height() failed for %s", airport_data.icaocode())
         debugging.error(err)
 
-    # Calculate Flight Category
-    if airport_data.wx_ceiling == -1 or airport_data.wx_visibility == -1:
-        airport_data.wx_category_str = "UNKN"
-    elif airport_data.wx_visibility < 1 or airport_data.wx_ceiling < 500:
-        airport_data.wx_category_str = "LIFR"
-    elif 1 <= airport_data.wx_visibility < 3 or 500 <= airport_data.wx_ceiling < 1000:
-        airport_data.wx_category_str = "IFR"
-    elif (
-        3 <= airport_data.wx_visibility <= 5 or 1000 <= airport_data.wx_ceiling <= 3000
-    ):
-        airport_data.wx_category_str = "MVFR"
-    elif airport_data.wx_visibility > 5 and airport_data.wx_ceiling > 3000:
-        airport_data.wx_category_str = "VFR"
-    else:
-        airport_data.wx_category_str = "UNKN"
-
-    airport_data.set_wx_category(airport_data.wx_category_str)
+    # Calculate Flight Category ; -1 flags unknown values
+    ceiling = airport_data.wx_ceiling
+    if ceiling == -1:
+        ceiling = math.nan
+    visibility = airport_data.wx_visibility
+    if visibility == -1:
+        visibility = math.nan
+    airport_data.set_wx_category(flight_category(ceiling, visibility))
 
     debugging.debug(
-        f"Airport: Ceiling {airport_data.wx_ceiling} + Visibility : {airport_data.wx_visibility}"
+        "Airport %s - %s : Ceiling %s + Visibility : %s",
+        airport_data.icaocode(),
+        airport_data.wx_category_str(),
+        airport_data.wx_ceiling,
+        airport_data.wx_visibility,
     )
-    debugging.debug(f"Airport {airport_data.icao} - {airport_data.wx_category_str}")
     return True
 
 
 def calc_wx_conditions(wx_metar):
     """Compute Wind Conditions."""
     wx_conditions = ()
-    wx_data = Metar.Metar(wx_metar)
+    wx_data = parse_metar(wx_metar)
 
     if wx_data.wind_speed > 20:
         wx_conditions = wx_conditions + (WxConditions.HIGHWINDS,)
     if wx_data.wind_gust > 0:
         wx_conditions = wx_conditions + (WxConditions.GUSTS,)
     return wx_conditions
+
+
+def decode_wx_effects(wx_string, wind_speed_kt=0, high_wind_kt=None):
+    """Decode a METAR wx_string (eg: -RA BR) into WX_* effect bits.
+
+    WX_HIGH_WIND is set if high_wind_kt is given and wind_speed_kt >= high_wind_kt.
+    """
+    wx_effects = 0
+    if wx_string:
+        for token in wx_string.split():
+            effect = WX_TOKEN_EFFECTS.get(token)
+            if effect is None:
+                # Intensity variants not in the token lists ; eg: -TSRA
+                effect = WX_TOKEN_EFFECTS.get(token.lstrip("+-"), 0)
+            wx_effects |= effect
+    if high_wind_kt is not None and wind_speed_kt >= high_wind_kt:
+        wx_effects |= WX_HIGH_WIND
+    return wx_effects
+
+
+def flight_category(ceiling, visibility):
+    """Flight category for one station ; ceiling in ft (inf = no ceiling), visibility in sm (nan = unknown)."""
+    if math.isnan(ceiling) or math.isnan(visibility):
+        return "UNKN"
+    if visibility < 1 or ceiling < 500:
+        return "LIFR"
+    if visibility < 3 or ceiling < 1000:
+        return "IFR"
+    if visibility <= 5 or ceiling <= 3000:
+        return "MVFR"
+    return "VFR"
+
+
+def classify_flight_categories(ceiling, visibility):
+    """Flight category codes (FC_*) for arrays of ceiling (ft) and visibility (sm).
+
+    Same rules as flight_category() ; inf = no ceiling / unlimited, nan = unknown.
+    """
+    ceiling = np.asarray(ceiling, dtype=np.float64)
+    visibility = np.asarray(visibility, dtype=np.float64)
+    # Worst category wins ; later assignments override earlier ones
+    codes = np.full(np.broadcast(ceiling, visibility).shape, FC_VFR, dtype=np.int8)
+    codes[(ceiling <= 3000) | (visibility <= 5)] = FC_MVFR
+    codes[(ceiling < 1000) | (visibility < 3)] = FC_IFR
+    codes[(ceiling < 500) | (visibility < 1)] = FC_LIFR
+    codes[np.isnan(ceiling) | np.isnan(visibility)] = FC_UNKN
+    return codes
+
+
+def observation_epoch(observation_time):
+    """Epoch seconds from an observation_time (eg: 2024-06-15T12:53:00Z) or None."""
+    if not observation_time:
+        return None
+    try:
+        observed = datetime.fromisoformat(observation_time.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if observed.tzinfo is None:
+        # ADDS times are UTC
+        observed = observed.replace(tzinfo=timezone.utc)
+    return observed.timestamp()
+
+
+def observation_age_bucket(observation_epoch_time, now, max_age):
+    """Age bucket (AGE_*) for an observation ; max_age and now in seconds."""
+    if observation_epoch_time is None:
+        return AGE_UNKNOWN
+    if now - observation_epoch_time > max_age:
+        return AGE_OLD
+    return AGE_CURRENT
+
+
+def visibility_value(vis_text):
+    """Convert visibility text (eg: 10+ , 6+ , 1 1/2) to statute miles ; nan if not parseable."""
+    if vis_text is None:
+        return math.nan
+    total = 0.0
+    try:
+        for part in vis_text.rstrip("+").split():
+            if "/" in part:
+                numerator, denominator = part.split("/")
+                total += int(numerator) / int(denominator)
+            else:
+                total += float(part)
+    except (ValueError, ZeroDivisionError):
+        return math.nan
+    return total
+
+
+def sky_ceiling(xml_record):
+    """Ceiling in ft AGL from the sky_condition layers of a METAR / TAF forecast XML record."""
+    # Layers are listed lowest first ; the first OVC, BKN or OVX layer is the ceiling
+    for sky_condition in xml_record.iterfind("sky_condition"):
+        if sky_condition.get("sky_cover") not in CEILING_SKY_COVER:
+            continue
+        cloud_base = sky_condition.get("cloud_base_ft_agl")
+        if cloud_base is None:
+            cloud_base = xml_record.findtext("vert_vis_ft")
+        if cloud_base is None:
+            # No cloud base or vertical visibility reported
+            cloud_base = 60000
+        try:
+            return float(cloud_base)
+        except ValueError:
+            return math.nan
+    return math.inf
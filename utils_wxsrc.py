@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*- #
+"""
+Weather source (wxsrc) resolution
+
+Airports with wxsrc "neigh:<icao>[,<icao>...]" display the weather reported
+by another station. The mappings are compiled once when airports.json is
+loaded into a graph ; each METAR refresh then resolves every dependent
+airport to the first of its candidate stations that is reporting.
+"""
+
+import debugging
+
+
+# Prefix for "display another station's weather" ; comma separated fallbacks
+WXSRC_NEIGHBOUR_PREFIX = "neigh:"
+
+
+def neighbour_candidates(wxsrc):
+    """Return the candidate stations from a neigh:... wxsrc, or None."""
+    if wxsrc is None or not wxsrc.startswith(WXSRC_NEIGHBOUR_PREFIX):
+        return None
+    candidates = wxsrc[len(WXSRC_NEIGHBOUR_PREFIX) :].split(",")
+    return tuple(station.strip().lower() for station in candidates if station.strip())
+
+
+class WxSourceGraph:
+    """Compiled wxsrc dependency graph for a set of airports.
+
+    sources maps each dependent airport to the stations it can take weather
+    from, in preference order. Neighbour chains (A -> B where B is itself
+    neigh:C) are flattened, and cycles are dropped with one error logged.
+    """
+
+    def __init__(self, airport_dict):
+        self._neighbours = {}
+        for icao, airport_obj in airport_dict.items():
+            candidates = neighbour_candidates(airport_obj.wxsrc())
+            if candidates is not None:
+                self._neighbours[icao] = candidates
+        self.cycles = []
+        self.sources = {}
+        for icao in self._neighbours:
+            self.sources[icao] = self._resolve(icao, ())
+        # station -> airports that list it ; for logging / the web views
+        dependents = {}
+        for icao, stations in self.sources.items():
+            for station in stations:
+                dependents.setdefault(station, []).append(icao)
+        self.dependents = {
+            station: tuple(icaos) for station, icaos in dependents.items()
+        }
+        debugging.info(
+            "wxsrc: %s neighbour airports using %s stations",
+            len(self.sources),
+            len(self.dependents),
+        )
+
+    def _resolve(self, icao, path):
+        """Return the flattened candidate stations for icao."""
+        if icao in self.sources:
+            return self.sources[icao]
+        if icao in path:
+            cycle = path[path.index(icao) :] + (icao,)
+            debugging.error("wxsrc: neighbour cycle %s", " -> ".join(cycle))
+            self.cycles.append(cycle)
+            # Memoize the failure ; the other airports on the cycle aren't
+            # walked (and logged) again
+            for cycle_icao in cycle[:-1]:
+                self.sources[cycle_icao] = ()
+            return ()
+        stations = []
+        for candidate in self._neighbours[icao]:
+            if candidate in self._neighbours:
+                # Neighbour is itself borrowing weather ; follow the chain
+                chained = self._resolve(candidate, path + (icao,))
+            else:
+                chained = (candidate,)
+            for station in chained:
+                if station not in stations:
+                    stations.append(station)
+        return tuple(stations)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def resolve(self, reporting_stations):
+        """Return {station: [icao, ...]} ; each airport under its first reporting station."""
+        fan_out = {}
+        for icao, stations in self.sources.items():
+            for station in stations:
+                if station in reporting_stations:
+                    fan_out.setdefault(station, []).append(icao)
+                    break
+        return fan_out
@@ -12,10 +12,6 @@ import json
 import secrets
 import pytz
 
-from rpi_ws281x import (
-    Color,
-)
-
 import folium
 import folium.plugins
 
@@ -39,10 +35,12 @@ from flask import (
 import qrcode
 
 import utils
+import utils_colors
 
 # import conf
 from update_leds import LedMode
 import debugging
+import metrics
 
 
 # import sysinfo
@@ -96,6 +94,11 @@ class WebViews:
         self.app.add_url_rule(
             "/heat_map", view_func=self.heat_map, methods=["GET", "POST"]
         )
+        self.app.add_url_rule("/led_view", view_func=self.led_view, methods=["GET"])
+        self.app.add_url_rule(
+            "/led_stream", view_func=self.led_stream, methods=["GET"]
+        )
+        self.app.add_url_rule("/metrics", view_func=self.getmetrics, methods=["GET"])
         # self.app.add_url_rule("/touchscr", view_func=self.touchscr, methods=["GET", "POST"])
         self.app.add_url_rule(
             "/open_console", view_func=self.open_console, methods=["GET", "POST"]
@@ -155,10 +158,12 @@ class WebViews:
         # For performance reasons we should do the minimum of data generation now
         # This gets executed for every page load
         airport_dict_data = {}
+        # Use a single snapshot of the airport DB for the whole page
+        airportdb_snapshot = self._airport_database.get_snapshot()
         for (
             airport_icao,
             airport_obj,
-        ) in self._airport_database.get_airport_dict_led().items():
+        ) in airportdb_snapshot.airport_led_dict.items():
             airport_record = {}
             airport_record["active"] = airport_obj.active()
             airport_record["icaocode"] = airport_icao
@@ -179,9 +184,7 @@ class WebViews:
             "strip": self._led_strip,
             "timestr": utils.time_format(utils.current_time(self.conf)),
             "timestrutc": utils.time_format(utils.current_time_utc(self.conf)),
-            "timemetarage": utils.time_format(
-                self._airport_database.get_metar_update_time()
-            ),
+            "timemetarage": utils.time_format(airportdb_snapshot.metar_update_time),
             "current_timezone": self.conf.get_string("default", "timezone"),
             "current_ledmode": current_ledmode,
             "num": self.num,
@@ -252,7 +255,7 @@ class WebViews:
                 self._led_strip.set_ledmode(LedMode.RAINBOW)
 
             flash(f"LED Mode set to {newledmode}")
-            debugging.info(f"LEDMode set to {newledmode}")
+            debugging.info("LEDMode set to %s", newledmode)
             return redirect("ledmodeset")
 
         ledmodelist = ["METAR", "Off", "Test", "Rabbit", "Shuffle", "Rainbow"]
@@ -338,6 +341,72 @@ class WebViews:
 
         return self.app.response_class(generate(), mimetype="text/plain")
 
+    def led_view(self):
+        """Flask Route: /led_view - Live mirror of the LED map."""
+        led_layout = []
+        for icao, airport_obj in self._airport_database.get_airport_dict_led().items():
+            try:
+                led_lat = float(airport_obj.latitude())
+                led_lon = float(airport_obj.longitude())
+            except (TypeError, ValueError):
+                continue
+            led_layout.append([airport_obj.get_led_index(), led_lat, led_lon, icao])
+        template_data = self.standardtemplate_data()
+        template_data["title"] = "LED View"
+        template_data["led_layout"] = led_layout
+        return render_template("led_view.html", **template_data)
+
+    def led_stream(self):
+        """Flask Route: /led_stream - Server Sent Events stream of committed LED frames.
+
+        First event is the full frame, then only changed pixels ; {"s": serial, "b": brightness, "p": {led: "rrggbb"}}
+        """
+        min_interval = 1 / max(self.conf.get_float("lights", "led_stream_rate"), 0.1)
+
+        def generate():
+            sent_frame = None
+            sent_brightness = None
+            serial = -1
+            while True:
+                serial, brightness, frame = self._led_strip.wait_for_frame(serial, 15)
+                if sent_frame is None:
+                    changed = dict(enumerate(frame))
+                else:
+                    changed = {
+                        led_index: led_color
+                        for led_index, led_color in enumerate(frame)
+                        if sent_frame[led_index] != led_color
+                    }
+                if not changed and brightness == sent_brightness:
+                    # Keep idle connections (and proxies) alive
+                    yield ": keepalive\n\n"
+                    continue
+                event = {"s": serial, "b": brightness, "p": changed}
+                yield f"data: {json.dumps(event, separators=(',', ':'))}\n\n"
+                sent_frame = frame
+                sent_brightness = brightness
+                # Throttle ; intermediate frames are folded into the next delta
+                time.sleep(min_interval)
+
+        return self.app.response_class(
+            generate(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    def getmetrics(self):
+        """Flask Route: /metrics - Thread instrumentation ; Prometheus text or JSON."""
+        if (
+            request.args.get("format") == "json"
+            or request.accept_mimetypes.best == "application/json"
+        ):
+            return self.app.response_class(
+                json.dumps(metrics.snapshot()), mimetype="application/json"
+            )
+        return self.app.response_class(
+            metrics.prometheus_text(), mimetype="text/plain; version=0.0.4"
+        )
+
     def airport_boundary_calc(self):
         """Scan airport lat/lon data and work out Airport Map boundaries."""
         # TODO: Handle boot-up scenario where airport list isn't loaded yet
@@ -354,7 +423,7 @@ class WebViews:
             lat_list.append(lat)
             lon = float(airport_obj.longitude())
             lon_list.append(lon)
-            debugging.dprint(f"boundary:{icao}:{lat}:{lon}:")
+            debugging.dprint("boundary:%s:%s:%s:", icao, lat, lon)
         if len(lat_list) >= 1:
             self.max_lat = max(lat_list)
         else:
@@ -404,9 +473,9 @@ class WebViews:
         airports = self._airport_database.get_airport_dict_led()
         for icao, airport_obj in airports.items():
             if not airport_obj.active():
-                debugging.info(f"LED MAP: Skipping rendering {icao}")
+                debugging.info("LED MAP: Skipping rendering %s", icao)
                 continue
-            debugging.info(f"LED MAP: Rendering {icao}")
+            debugging.info("LED MAP: Rendering %s", icao)
             if airport_obj.flightcategory() == "VFR":
                 loc_color = "green"
             elif airport_obj.flightcategory() == "MVFR":
@@ -439,18 +508,21 @@ class WebViews:
         for icao, airport_obj in airports.items():
             if not airport_obj.active():
                 # Inactive airports likely don't have valid lat/lon data
-                debugging.info(f"LED MAP: Skipping rendering inactive {icao}")
+                debugging.info("LED MAP: Skipping rendering inactive %s", icao)
                 continue
             if not airport_obj.valid_coordinates():
                 debugging.info(
-                    f"LED MAP: Skipping rendering {icao} invalid coordinates"
+                    "LED MAP: Skipping rendering %s invalid coordinates", icao
                 )
                 continue
             # Add lines between airports. Must make lat/lons
             # floats otherwise recursion error occurs.
             pin_index = int(airport_obj.get_led_index())
             debugging.info(
-                f"icao {icao} Lat:{airport_obj.latitude()}/Lon:{airport_obj.longitude()}"
+                "icao %s Lat:%s/Lon:%s",
+                icao,
+                airport_obj.latitude(),
+                airport_obj.longitude(),
             )
             points.insert(pin_index, [airport_obj.latitude(), airport_obj.longitude()])
             ######
@@ -587,8 +659,10 @@ class WebViews:
         airports = self._airport_database.get_airport_dict_led()
         for icao, airport_obj in airports.items():
             debugging.info(
-                f"Heatmap: {airport_obj.icaocode()} : Active: {airport_obj.active()} :"
-                f" Coords: {airport_obj.valid_coordinates()}"
+                "Heatmap: %s : Active: %s : Coords: %s",
+                airport_obj.icaocode(),
+                airport_obj.active(),
+                airport_obj.valid_coordinates(),
             )
             if not airport_obj.active():
                 # Inactive airports likely don't have valid lat/lon data
@@ -599,7 +673,11 @@ class WebViews:
             # floats otherwise recursion error occurs.
             pin_index = int(airport_obj.get_led_index())
             debugging.info(
-                f"HeatMap: {airport_obj.icaocode()} :{airport_obj.latitude()}:{airport_obj.longitude()}:{pin_index}:"
+                "HeatMap: %s :%s:%s:%s:",
+                airport_obj.icaocode(),
+                airport_obj.latitude(),
+                airport_obj.longitude(),
+                pin_index,
             )
             points.insert(pin_index, [airport_obj.latitude(), airport_obj.longitude()])
 
@@ -732,7 +810,9 @@ class WebViews:
             wx_data["get_wx_dir_degrees"] = airport_obj.winddir_degrees()
             wx_data["get_wx_windspeed"] = airport_obj.get_wx_windspeed()
         except Exception as err:
-            debugging.error(f"Attempt to get wx for failed for :{airport}: ERR:{err}")
+            debugging.error(
+                "Attempt to get wx for failed for :%s: ERR:%s", airport, err
+            )
 
         return json.dumps(wx_data)
 
@@ -740,7 +820,7 @@ class WebViews:
         """Flask Route: /metar - Get METAR for Airport."""
         template_data = self.standardtemplate_data()
 
-        debugging.info(f"getmetar: airport = :{airport}:")
+        debugging.info("getmetar: airport = :%s:", airport)
         template_data["airport"] = airport
 
         airport = airport.lower()
@@ -761,12 +841,12 @@ class WebViews:
             try:
                 debugging.info("Get Metar 1")
                 airport_obj = self._airport_database.get_airport(airport)
-                debugging.info(f"Get Metar 2: {airport_obj.get_raw_metar()}")
+                debugging.info("Get Metar 2: %s", airport_obj.get_raw_metar())
                 # debugging.info(airport_entry)
                 template_data["metar"] = airport_obj.get_raw_metar()
             except Exception as err:
                 debugging.error(
-                    f"Attempt to get metar for failed for :{airport}: ERR:{err}"
+                    "Attempt to get metar for failed for :%s: ERR:%s", airport, err
                 )
                 template_data["metar"] = "ERR - Not found"
 
@@ -776,7 +856,7 @@ class WebViews:
         """Flask Route: /taf - Get TAF for Airport."""
         template_data = self.standardtemplate_data()
 
-        debugging.info(f"getmetar: airport = {airport}")
+        debugging.info("getmetar: airport = %s", airport)
         template_data["airport"] = airport
 
         airport = airport.lower()
@@ -784,7 +864,7 @@ class WebViews:
         if airport == "debug":
             # Debug request - dumping DB info
             with open("logs/airport_database.txt", "w", encoding="ascii") as outfile:
-                airportdb = self._airport_database.get_airportxmldb()
+                airportdb = self._airport_database.get_airportdb()
                 counter = 0
                 for icao, airport_obj in airportdb.items():
                     airport_metar = airport_obj.get_raw_metar()
@@ -796,7 +876,7 @@ class WebViews:
             template_data["taf"] = airport_obj.taf()
         except Exception as err:
             debugging.error(
-                f"Attempt to get metar for failed for :{airport}: ERR:{err}"
+                "Attempt to get metar for failed for :%s: ERR:%s", airport, err
             )
             template_data["taf"] = "ERR - Not found"
 
@@ -853,18 +933,19 @@ class WebViews:
             form_data = request.form.to_dict()
             # debugging.dprint(data)  # debug
 
-            # This will update the data for all airports.
-            # So we should iterate through the airport data set.
-            airports = self._airport_database.get_airport_dict_led()
-            for icao, airport_obj in airports.items():
-                if not airport_obj.active():
+            # Only the submitted airports need looking up
+            led_map = self._airport_database.get_led_map()
+            heatmap_dict = {}
+            for icao, form_value in form_data.items():
+                if not led_map.is_active(icao):
                     continue
-                if icao in form_data:
-                    hm_value = int(form_data[icao])
-                    airport_obj.set_heatmap_index(hm_value)
-                    debugging.debug(f"hmpost: key {icao} : value {hm_value}")
+                hm_value = int(form_value)
+                heatmap_dict[icao] = hm_value
+                debugging.debug("hmpost: key %s : value %s", icao, hm_value)
+            self._airport_database.set_heatmap_index(heatmap_dict)
 
-        self._airport_database.save_airport_db()
+        # Written in the background ; rapid edits are coalesced into one write
+        self._airport_database.request_save()
 
         flash("Heat Map Data applied")
         return redirect("hmedit")
@@ -931,71 +1012,69 @@ class WebViews:
         debugging.info("Controlling LED's on/off")
 
         if request.method == "POST":
+            # LED numbers are limited to the strip ; 0 - num_pixels-1
+            led_count = self._led_strip.num_pixels()
+            # set_led_color takes HEX colors
+            led_on = utils_colors.hexcode(155, 155, 155)
+            led_off = utils_colors.black()
             if "buton" in request.form:
-                num = int(request.form["lednum"])
+                num = min(max(int(request.form["lednum"]), 0), led_count - 1)
                 debugging.info("LED " + str(num) + " On")
-                self._led_strip.set_led_color(num, Color(155, 155, 155))
+                self._led_strip.set_led_color(num, led_on)
                 self._led_strip.show()
                 flash("LED " + str(num) + " On")
 
             elif "butoff" in request.form:
-                num = int(request.form["lednum"])
+                num = min(max(int(request.form["lednum"]), 0), led_count - 1)
                 debugging.info("LED " + str(num) + " Off")
-                self._led_strip.set_led_color(num, Color(0, 0, 0))
+                self._led_strip.set_led_color(num, led_off)
                 self._led_strip.show()
                 flash("LED " + str(num) + " Off")
 
             elif "butup" in request.form:
                 debugging.info("LED UP")
-                num = int(request.form["lednum"])
-                self._led_strip.set_led_color(num, Color(0, 0, 0))
-                num = num + 1
-
-                # FIXME: self.airports retired
-                if num > len(self.airports):
-                    num = len(self.airports)
+                num = min(max(int(request.form["lednum"]), 0), led_count - 1)
+                self._led_strip.set_led_color(num, led_off)
+                num = min(max(num + 1, 0), led_count - 1)
 
-                self._led_strip.set_led_color(num, Color(155, 155, 155))
+                self._led_strip.set_led_color(num, led_on)
                 self._led_strip.show()
                 flash("LED " + str(num) + " should be On")
 
             elif "butdown" in request.form:
                 debugging.info("LED DOWN")
-                num = int(request.form["lednum"])
-                self._led_strip.set_led_color(num, Color(0, 0, 0))
+                num = min(max(int(request.form["lednum"]), 0), led_count - 1)
+                self._led_strip.set_led_color(num, led_off)
 
-                num = num - 1
-                num = max(num, 0)
+                num = min(max(num - 1, 0), led_count - 1)
 
-                self._led_strip.set_led_color(num, Color(155, 155, 155))
+                self._led_strip.set_led_color(num, led_on)
                 self._led_strip.show()
                 flash("LED " + str(num) + " should be On")
 
             elif "butall" in request.form:
                 debugging.info("LED All ON")
-                num = int(request.form["lednum"])
+                num = min(max(int(request.form["lednum"]), 0), led_count - 1)
 
-                # FIXME: self.airports retired
-                for num in range(len(self.airports)):
-                    self._led_strip.set_led_color(num, Color(155, 155, 155))
+                for num in range(led_count):
+                    self._led_strip.set_led_color(num, led_on)
                 self._led_strip.show()
                 flash("All LEDs should be On")
                 num = 0
 
             elif "butnone" in request.form:
                 debugging.info("LED All OFF")
-                num = int(request.form["lednum"])
+                num = min(max(int(request.form["lednum"]), 0), led_count - 1)
 
-                # FIXME: self.airports retired
-                for num in range(len(self.airports)):
-                    self._led_strip.set_led_color(num, Color(0, 0, 0))
+                for num in range(led_count):
+                    self._led_strip.set_led_color(num, led_off)
                 self._led_strip.show()
                 flash("All LEDs should be Off")
                 num = 0
 
             else:  # if tab is pressed
                 debugging.info("LED Edited")
-                num = int(request.form["lednum"])
+                num = min(max(int(request.form["lednum"]), 0), led_count - 1)
                 flash("LED " + str(num) + " Edited")
 
         template_data = self.standardtemplate_data()
@@ -1304,7 +1383,7 @@ class WebViews:
     def handle_mapturnoff(self):
         """Flask Route: /mapturnoff - Trigger process shutdown."""
         url = request.referrer
-        debugging.info(f"Shutoff Map from {url}")
+        debugging.info("Shutoff Map from %s", url)
         self._led_strip.set_ledmode(LedMode.OFF)
         flash("Map Turned Off")
         return redirect("/")
@@ -1315,7 +1394,7 @@ class WebViews:
     def handle_mapturnon(self):
         """Flask Route: /mapturnon - Trigger process shutdown."""
         url = request.referrer
-        debugging.info(f"Turn Map ON from {url}")
+        debugging.info("Turn Map ON from %s", url)
         self._led_strip.set_ledmode(LedMode.METAR)
         flash("Map Turned On")
         return redirect("/")